@@ -0,0 +1,73 @@
+"""Bars per second of building PRICE messages, pandas indexing vs the columnar Feed.
+
+Usage:
+    python benchmarks/feed_benchmark.py [-n BARS]
+
+The data is synthetic 1m OHLCV with the columns of the Binance collectors,
+so nothing is downloaded.
+"""
+from argparse import ArgumentParser
+from time import perf_counter
+import os
+import sys
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src'))
+from _feed import Feed
+
+COLUMNS = ['open', 'high', 'low', 'close', 'volume', 'close time', 'quote asset volume',
+           'number of trades', 'taker buy base asset volume', 'taker buy quote asset volume', 'ignore']
+
+
+def synthetic_data(bars: int) -> pd.DataFrame:
+    rng = np.random.default_rng(0)
+    close = 30000 * np.exp(np.cumsum(rng.normal(0, 0.002, bars)))
+    open_ = np.r_[close[0], close[:-1]]
+    volume = rng.uniform(1, 10, bars)
+    dates = pd.date_range('2023-01-01', periods=bars, freq='1min').astype(str)
+    df = pd.DataFrame({'open': open_,
+                       'high': np.maximum(open_, close) * 1.001,
+                       'low': np.minimum(open_, close) * 0.999,
+                       'close': close,
+                       'volume': volume,
+                       'close time': np.arange(bars) * 60000 + 59999,
+                       'quote asset volume': volume * close,
+                       'number of trades': rng.integers(10, 100, bars),
+                       'taker buy base asset volume': volume / 2,
+                       'taker buy quote asset volume': volume * close / 2,
+                       'ignore': 0}, index=pd.Index(dates, name='date'))
+    return df[COLUMNS]
+
+
+def pandas_bar(df: pd.DataFrame, tick: int) -> dict:
+    # Backtester.bar before the columnar feed
+    return {'price' : df['close'].iloc[tick],
+            'tick' : tick,
+            'time':str(df.index[tick])[:-3],
+            'message' : 'PRICE', 'size' : len(df),
+            'data' : df.iloc[tick].to_dict()}
+
+
+def measure(name: str, bar, bars: int) -> float:
+    start = perf_counter()
+    for tick in range(bars):
+        bar(tick)
+    elapsed = perf_counter() - start
+    print(f"{name:<8} {bars:>9} bars {elapsed:8.3f} s {bars / elapsed:12.0f} bars/s")
+    return bars / elapsed
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('-n', '--bars', type=int, default=1000000, help='Number of bars to feed.')
+    args = parser.parse_args()
+    df = synthetic_data(args.bars)
+    # pandas indexing is slow, time it on a slice and report the rate
+    before = measure('pandas', lambda tick: pandas_bar(df, tick), min(args.bars, 100000))
+    start = perf_counter()
+    feed = Feed(df)
+    print(f"Feed built in {perf_counter() - start:.3f} s")
+    after = measure('feed', feed.bar, args.bars)
+    assert pandas_bar(df, args.bars - 1) == feed.bar(args.bars - 1)
+    print(f"Speedup: {after / before:.1f}x")
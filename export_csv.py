@@ -4,7 +4,9 @@ import re
 from datetime import datetime
 # Sample paths: SimTest/results/BinanceFutures/FibonacciRetracements/*/*/results.json
 #               SimTest/results/BinanceFutures/*
-REGEX_PATTERN = ".* Saving results to .*\/simtest-(.*)\/"
+# Results folders are results/<exchange>_<market>/<strategy>/simtest-<date>/,
+# a Full Backtest logs the results of every strategy in one log
+REGEX_PATTERN = ".* Saving results to .*\/([^\/]+)\/simtest-(.*)\/"
 
 def fetch_logs():
     logs = {}
@@ -12,21 +14,21 @@ def fetch_logs():
         for file in files:
             if file.endswith(".log"):
                 with open(os.path.join(root, file), "r") as f:
-                    # Read first line
-                    lines = f.readlines()
-                    log_line = lines[1]
-                    if "Model kwargs: " not in log_line:
-                        print("Model kwargs not found in log file")
-                    model_kwargs = log_line.split("Model kwargs: ")[-1]
-                    alg_name = file.split("-")[0]
-                    # Get date from log file
-                    date = None    
-                    for line in lines:
+                    # The results of a run follow the kwargs it logged last,
+                    # a parameter sweep logs the kwargs of every run
+                    model_kwargs = None
+                    for line in f:
+                        if "Model kwargs: " in line:
+                            model_kwargs = line.split("Model kwargs: ")[-1]
                         if "Saving results to" in line:
-                            date = re.match(REGEX_PATTERN, line).group(1)
-                            break
-                    # print(date)
-                    logs[date] = model_kwargs.replace("\n", "").replace(",", ' ')
+                            match = re.match(REGEX_PATTERN, line)
+                            if not match or match.groups() in logs:
+                                continue
+                            if model_kwargs is None:
+                                print(f"Model kwargs not found in log file {file}")
+                                logs[match.groups()] = ""
+                            else:
+                                logs[match.groups()] = model_kwargs.replace("\n", "").replace(",", ' ')
     return logs
 
 
@@ -34,7 +36,8 @@ def get_csv_paths():
     csv_paths = []
     for root, dirs, files in os.walk("results"):
         for file in files:
-            if file.endswith(".json"):
+            # transport.json holds IPC statistics, not backtest results
+            if file.endswith(".json") and file != "transport.json":
                 csv_paths.append(os.path.join(root, file))
     return csv_paths
 
@@ -51,7 +54,7 @@ def generate_csv(csv_paths):
             simtest_date = csv_path.split("/")[-3].split("simtest-")[-1]
             # print(logs[simtest_date])
             data["name"] = alg_name
-            kwargs = logs[simtest_date]
+            kwargs = logs[(alg_name, simtest_date)]
             # for key, value in kwargs.items():
             #     data[key] = value)
             data["kwargs"] = kwargs
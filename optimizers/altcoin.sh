@@ -11,8 +11,8 @@ end_dates="2023-10-22"
 
 
 # CHANGE BELOW LINES
-# The number of backtests will be equal to the product of the number of elements in each array
-# i.e. for 3 algorithms, 4 timeframes and 3 symbols, the number of backtests will be 3*4*3 = 36
+# The number of backtests will be equal to the product of the number of strategies and timeframes
+# i.e. for 3 algorithms, 4 timeframes and 3 symbols, the number of backtests will be 3*4 = 12 portfolios of 3 symbols
 ##########################################################################################
 # DEFINE THE STRATEGY TO BE TESTED
 strategies=("FibonacciRetracements") # ADD MORE HERE If you want
@@ -26,22 +26,22 @@ symbols=("XLMUSDT" "UNIUSDT" "SOLUSDT" ) # ADD MORE HERE
 # DO NOT CHANGE BELOW LINES
 ##########################################################################################
 python archive.py -y;
+# All symbols are backtested as one portfolio sharing the balance, single pair
+# strategies run on every symbol on their own
+pairs=$(IFS=,; echo "${symbols[*]}")
 for s in "${!strategies[@]}"; do
     for t in "${!timeframes[@]}"; do
-        for u in "${!symbols[@]}"; do
-            # Add more for loops here if you want to test more parameters
-            # i.e. for u in "${!model_parameter_2_range[@]}"; do
-            # then add -mp "model_parameter_2 ${model_parameter_2_range[u]}";
+        # Add more for loops here if you want to test more parameters
+        # i.e. for u in "${!model_parameter_2_range[@]}"; do
+        # then add -mp "model_parameter_2 ${model_parameter_2_range[u]}";
 
-            # Set your parameters here
-            strategy = strategies[s];
-            timeframe = timeframes[t]; 
-            symbol = symbols[u];
+        # Set your parameters here
+        strategy=${strategies[s]};
+        timeframe=${timeframes[t]};
 
-            # Run the script
-            python src/main.py -s ${strategy} -e ${exchanges} -m ${markets} \
-                -t ${timeframe} -b ${start_dates} -ed ${end_dates} -p ${symbol};
-        done
+        # Run the script
+        python src/main.py -s ${strategy} -e ${exchanges} -m ${markets} \
+            -t ${timeframe} -b ${start_dates} -ed ${end_dates} -p ${pairs};
     done
 done
 python export_csv.py;
@@ -38,29 +38,29 @@ take_profit_range=(None 5 6 7 8 9 10 11 12.5 14 15 17 20 30)
 python archive.py -y;
 
 total=$((${#stop_loss_range[@]} * ${#take_profit_range[@]} * ${#symbols[@]}))
-count=0
 
 for i in "${!symbols[@]}"; do
     symbol=${symbols[i]}
+    # Every parameter set of a symbol is run by one strategy process
+    model_parameters=()
     for s in "${!stop_loss_range[@]}"; do
         for t in "${!take_profit_range[@]}"; do
             # Add more for loops here if you want to test more parameters
             # i.e. for u in "${!model_parameter_2_range[@]}"; do
-            # then add -mp "model_parameter_2 ${model_parameter_2_range[u]}";
-            ((count++))
-            echo "Running simulation [$count] of [$total]"
+            # then add model_parameter_2 ${model_parameter_2_range[u]} below;
             # Stop loss and take profit
             stop_loss=${stop_loss_range[s]}
             take_profit=${take_profit_range[t]}
             pos_size=${position_sizes[i]}
-            
-
-            # Run the script
-            python src/main.py -s ${strategies} -e ${exchanges} -m ${markets} \
-                -t ${timeframes} -b ${start_dates} -ed ${end_dates} -p ${symbol} \
-                -mp "stop_loss ${stop_loss} take_profit ${take_profit} position_size ${pos_size}" > /dev/null 2>&1;
+            model_parameters+=(-mp "stop_loss ${stop_loss} take_profit ${take_profit} position_size ${pos_size}")
         done
     done
+
+    # Run the script, every finished run logs where it saved its results
+    # and that line moves the progress bar
+    python src/main.py -s ${strategies} -e ${exchanges} -m ${markets} \
+        -t ${timeframes} -b ${start_dates} -ed ${end_dates} -p ${symbol} \
+        "${model_parameters[@]}" 2>&1 | grep --line-buffered "Saving results to";
 done | pv -l -s $total > /dev/null
 python export.py;
 ##########################################################################################
@@ -0,0 +1,164 @@
+import asyncio
+import logging
+import secrets
+import json
+from time import perf_counter
+from _protocol import HEADER
+
+
+class StreamConnection:
+    """Adapts an asyncio StreamWriter to the socket calls of Server and Client.
+
+    sendall only queues the bytes on the transport, they are flushed when the
+    owning coroutine awaits drain().
+    """
+    def __init__(self, writer):
+        self.writer = writer
+
+    def sendall(self, payload):
+        self.writer.write(payload)
+
+    def close(self):
+        self.writer.close()
+
+
+class JsonStreamReader:
+    """Reads back to back JSON objects from a StreamReader (protocol v1)."""
+    def __init__(self, reader):
+        self.reader = reader
+        self.buffer = ''
+        self.decoder = json.JSONDecoder()
+        # Characters taken by the last message
+        self.size = 0
+
+    async def read(self):
+        while True:
+            self.buffer = self.buffer.lstrip()
+            if self.buffer:
+                try:
+                    message, end = self.decoder.raw_decode(self.buffer)
+                    self.buffer = self.buffer[end:]
+                    self.size = end
+                    return message
+                except json.decoder.JSONDecodeError:
+                    pass
+            chunk = await self.reader.read(1 << 16)
+            if not chunk:
+                raise asyncio.IncompleteReadError(self.buffer.encode(), None)
+            self.buffer += chunk.decode()
+
+
+async def read_frame(reader):
+    header = await reader.readexactly(HEADER.size)
+    (length,) = HEADER.unpack(header)
+    return await reader.readexactly(length)
+
+
+class AsyncServer:
+    """Hosts many Server sessions on a single asyncio event loop.
+
+    Every Server (e.g. a Backtester created with bind=False) is registered
+    under a session token. Clients send the token in their START message and
+    are routed to the matching session; messages of all sessions are then
+    dispatched to Server.on_receive by the event loop, one coroutine per
+    connection and no threads.
+    """
+    def __init__(self, host='127.0.0.1', port=0):
+        self.logger = logging.getLogger('SimTest')
+        self.host = host
+        self.port = port
+        self.server = None
+        self.sessions = {}
+        self.finished = {}
+
+    def register(self, server) -> str:
+        token = secrets.token_hex(16)
+        self.sessions[token] = server
+        self.finished[token] = asyncio.get_running_loop().create_future()
+        return token
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle, self.host, self.port)
+        self.port = self.server.sockets[0].getsockname()[1]
+        self.logger.info("Async server is listening on {}:{}".format(self.host, self.port))
+
+    async def handle(self, reader, writer):
+        json_reader = JsonStreamReader(reader)
+        try:
+            start = await json_reader.read()
+        except asyncio.IncompleteReadError:
+            writer.close()
+            return
+        token = start.get('session')
+        server = self.sessions.pop(token, None)
+        if server is None:
+            self.logger.warning(f"Rejected connection with unknown session: {token}")
+            writer.close()
+            return
+        server.client_socket = StreamConnection(writer)
+        server.is_running = True
+        server.negotiate(start)
+        try:
+            server.deliver(start)
+            await writer.drain()
+            while server.is_running:
+                if server.protocol >= 2:
+                    body = await read_frame(reader)
+                    begin = perf_counter()
+                    message = server.decoder.decode(body)
+                    server.stats.received(HEADER.size + len(body), perf_counter() - begin)
+                else:
+                    message = await json_reader.read()
+                    server.stats.received(json_reader.size, 0.0)
+                if message is not None:
+                    server.deliver(message)
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionResetError):
+            self.logger.info("Client has disconnected.")
+            server.stop()
+        finally:
+            self.finished[token].set_result(server)
+
+    async def join(self):
+        """Wait until every registered session is finished and close the listener."""
+        await asyncio.gather(*self.finished.values())
+        self.server.close()
+        await self.server.wait_closed()
+
+
+class AsyncClient:
+    """Runs a strategy (a Client subclass) over an asyncio connection."""
+    def __init__(self, strategy):
+        self.strategy = strategy
+
+    async def run(self, host, port, session=None):
+        strategy = self.strategy
+        reader, writer = await asyncio.open_connection(host, port)
+        # The blocking socket of the strategy is never used
+        strategy.client_socket.close()
+        strategy.client_socket = StreamConnection(writer)
+        strategy.session = session
+        strategy.is_running = True
+        strategy.on_connect()
+        await writer.drain()
+        # The START above asked for protocol v2, the server answers framed
+        strategy._use_frames(strategy.client_socket)
+        try:
+            while strategy.is_running:
+                body = await read_frame(reader)
+                begin = perf_counter()
+                message = strategy.decoder.decode(body)
+                strategy.stats.received(HEADER.size + len(body), perf_counter() - begin)
+                if message is None:
+                    continue
+                if message['message'] == 'END':
+                    strategy.report()
+                    await writer.drain()
+                    break
+                strategy.dispatch(message)
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionResetError):
+            strategy.logger.info("Server has disconnected.")
+        strategy.is_running = False
+        writer.close()
+        strategy.on_disconnect()
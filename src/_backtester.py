@@ -1,9 +1,17 @@
-from _orders import OrderBook, Order, NoOrder
-from _base_socket import Server
+from _orders import OrderBook, Order, NoOrder, OpenLong, OpenShort, CloseLong, CloseShort
+from _metrics import TradingMetrics
+from _base_socket import Server, epoch_seconds
+from _stats import TransportStats
+from _feed import Feed, StreamFeed
+from _timeframes import BarBuilder, interval_seconds
 from time import time, ctime, sleep
 from datetime import datetime
+from collections import deque
+from bisect import bisect_left
+import copy
 import os 
 import pandas as pd
+import numpy as np
 from matplotlib import pyplot as plt
 import logging
 import yaml
@@ -11,8 +19,8 @@ import yaml
 
 
 class Backtester(Server):
-    def __init__(self, interval, start_date, final_date, pair):
-        super().__init__()
+    def __init__(self, interval, start_date, final_date, pair, bind=True):
+        super().__init__(bind=bind)
         # Available exchanges
         # - Binance Spot
         # - Binance Futures
@@ -25,6 +33,9 @@ class Backtester(Server):
             with open(os.path.join(os.path.dirname(os.path.dirname(__file__)), 'config.yaml')) as f:
                 config = yaml.load(f, Loader=yaml.FullLoader)
                 speed = config['speed']
+                batch_size = config.get('batch_size', 1)
+                window = config.get('window', 1)
+                chunk_size = config.get('chunk_size', 0)
                 exchange = config['exchange']
                 market_type = config['market_type']
         except yaml.YAMLError as exc:
@@ -46,6 +57,27 @@ class Backtester(Server):
 
         self.is_running = False
         self.speed = 10**(-speed)
+        # Bars per PRICEBATCH message, only used if the strategy supports it
+        self.max_batch_size = batch_size
+        self.batch_size = 1
+        # PRICEBATCH messages sent ahead of the replies of the strategy
+        self.max_window = window
+        self.window = 1
+        # Bars read at a time from the dataset, 0 reads it all at once
+        self.chunk_size = chunk_size
+        self.in_flight = deque()
+        # Wake condition of the strategy, bars before it are skipped
+        self.wake = None
+        # Higher timeframes subscribed by the strategy and the next bar they
+        # have not seen yet
+        self.interval = interval
+        self.start_date = start_date
+        self.bar_builders = []
+        self.built = 0
+        # Set once END is sent, the order book is closed when the session stops
+        self.ending = False
+        # Error the session stopped on, raised by disconnect()
+        self.error = None
         self.OrderBook = OrderBook(pair=pair)
         self.logger.info(f"Dataset summary: from {start_date} to {final_date} with {interval} interval with pair {pair}.")
         self.collector = DataCollector(start_date, final_date, interval, pair)
@@ -55,37 +87,195 @@ class Backtester(Server):
         self.cumulative_profit = 0
 
     def load_data(self):
+        if self.chunk_size:
+            # Only the time and close of every bar stay in memory, the
+            # DataFrame is never built
+            self.df = None
+            self.feed = StreamFeed(self.data_path, self.collector.get_columns(), self.chunk_size)
+            self.tick = 0
+            self.logger.info(f"Data streamed in chunks of {self.chunk_size}: Size: {len(self.feed)}")
+            return True
         # load data from data_path  
         self.df = pd.read_csv(self.data_path)
         # rename columns=['date', 'open', 'high', 'low', 'close', 'volume']
         self.df.columns = self.collector.get_columns()
         # set the date column as the indexl
         self.df.set_index('date', inplace=True)
+        self.feed = Feed(self.df)
         self.tick = 0
-        self.logger.info(f"Data loaded successfully: Size: {len(self.df)}")
+        self.logger.info(f"Data loaded successfully: Size: {len(self.feed)}")
         return True
 
+    def view(self, start_date):
+        """Backtester over the loaded bars from start_date on, sharing their arrays.
+
+        Benchmark windows end with the data of the longest one, so they are
+        views of it instead of datasets of their own. The bars are the ones
+        load_data reads from the dataset of the window.
+        """
+        if self.df is None:
+            raise ValueError("Windows need the whole dataset in memory, set chunk_size to 0")
+        start = 0
+        if start_date != self.start_date:
+            start = bisect_left(self.feed.times, str(self.collector.day_start(start_date)))
+            if not self.collector.has_header():
+                # load_data takes the first row of a csv without a header row as its header
+                start += 1
+        window = copy.copy(self)
+        window.df = self.df.iloc[start:]
+        window.feed = self.feed.view(start)
+        window.OrderBook = OrderBook(pair=self.OrderBook.pair)
+        window.stats = TransportStats()
+        window.in_flight = deque()
+        window.bar_builders, window.built = [], 0
+        window.wake = None
+        window.tick = 0
+        return window
+
+    def bar(self, tick):
+        bar = self.feed.bar(tick)
+        if self.bar_builders:
+            bar['timeframes'] = self.build_timeframes(tick, bar['data'])
+        return bar
+
+    def subscribe(self, timeframes):
+        """Build bars of the given higher timeframes and send them with every bar."""
+        base_seconds = interval_seconds(self.interval)
+        for timeframe in timeframes:
+            if timeframe in [builder.timeframe for builder in self.bar_builders]:
+                continue
+            try:
+                seconds = interval_seconds(timeframe)
+            except (KeyError, ValueError):
+                self.logger.error(f"Unknown timeframe {timeframe}, not subscribed")
+                continue
+            if seconds <= base_seconds or seconds % base_seconds:
+                self.logger.error(f"Timeframe {timeframe} is not a multiple of the {self.interval} interval, not subscribed")
+                continue
+            self.bar_builders.append(BarBuilder(timeframe, base_seconds))
+
+    def build_timeframes(self, tick, ohlcv):
+        # Bars skipped by a wake condition or by strategies asleep in
+        # run_many are added first, the builders never see a later bar
+        if tick < self.built:
+            self.bar_builders = [BarBuilder(builder.timeframe, builder.base_seconds) for builder in self.bar_builders]
+            self.built = 0
+        for skipped in range(self.built, tick):
+            row = self.feed.row(skipped)
+            for builder in self.bar_builders:
+                builder.update(int(self.feed.times[skipped]), row)
+        for builder in self.bar_builders:
+            builder.update(int(self.feed.times[tick]), ohlcv)
+        self.built = tick + 1
+        return {builder.timeframe: builder.snapshot() for builder in self.bar_builders}
+
+    def next_bar(self):
+        """Build the PRICE message for the current tick and advance the stream.
+
+        Returns:
+            dict: message for the strategy, None once the dataset is exhausted.
+        """
+        if self.tick >= len(self.feed):
+            return None
+        data = self.bar(self.tick)
+        self.OrderBook.update_price(data['data'],data['time'])
+        data['open_orders'] = len(self.OrderBook.get_open_orders())
+        self.tick += 1
+        return data
+
+    def next_batch(self):
+        """Build a PRICEBATCH message with the next batch_size bars.
+
+        SL/TP handling of these bars is deferred to apply_batch so that it
+        runs in tick order with the orders of the strategy. Bars in a batch
+        carry no 'open_orders' since the order book has not seen them yet.
+        The tick of the first bar is the sequence number of the batch.
+        """
+        end = min(self.tick + self.batch_size, len(self.feed))
+        batch = [self.bar(tick) for tick in range(self.tick, end)]
+        self.in_flight.append(batch)
+        self.tick = end
+        return {'message' : 'PRICEBATCH', 'seq' : batch[0]['tick'], 'data' : batch}
+
+    def apply_batch(self, data):
+        """Replay the oldest batch in flight against the OrderBook.
+
+        For every bar SL/TP is handled first and then the orders tagged with
+        its tick are added, exactly as if the bars had been sent one by one.
+        Replies must come back in the order the batches were sent, otherwise
+        orders could be filled at prices the strategy had not seen yet. A
+        reply out of order stops the session, disconnect() raises it.
+        """
+        batch = self.in_flight.popleft()
+        if data.get('seq') != batch[0]['tick']:
+            # Raised here it would only end the receive thread and leave
+            # both sides waiting
+            self.error = ValueError(f"Orders for batch {data.get('seq')} received, expected batch {batch[0]['tick']}")
+            self.logger.error(f"Stopping the backtest: {self.error}")
+            self.stop()
+            return
+        orders = {}
+        for order in data.get('data', []):
+            orders.setdefault(order['tick'], []).append(order)
+        for bar in batch:
+            self.OrderBook.update_price(bar['data'], bar['time'])
+            for order in orders.get(bar['tick'], ()):
+                self.OrderBook.add_order(Order(order['order_id'], order['order_type'], order['order_time'], order['order_price'], order['order_size'],order['order_SL'],order['order_TP']))
+
+    def close_orderbook(self):
+        # A streamed dataset leaves the metrics its time and close columns
+        df = self.df if self.df is not None else self.feed.summary
+        self.OrderBook.close_orderbook(df['close'].iloc[-1],str(df.index[-1])[:-3],df)
+        self.OrderBook.transport_stats = self.stats
+
+    def stop(self):
+        if self.ending:
+            # END was sent, nothing the strategy sends can change the order book
+            self.ending = False
+            self.close_orderbook()
+        super().stop()
+
     def feed_data(self):
-        if self.tick >= len(self.df):
+        if self.wake is not None:
+            self.skip_ahead()
+        if self.tick >= len(self.feed):
+            if self.in_flight:
+                # Wait for the replies of the batches still in flight
+                return
             self.send({'message' : 'END'})
-            self.OrderBook.close_orderbook(self.df['close'].iloc[-1],str(self.df.index[-1])[:-3],self.df)
-            self.stop()
+            self.ending = True
+            if self.protocol < 2:
+                self.stop()
+            # Framed strategies answer END with their STATS
             return
-        data = {'price' : self.df['close'].iloc[self.tick], 
-                'tick' : self.tick,
-                'time':str(self.df.index[self.tick])[:-3], 
-                'message' : 'PRICE', 'size' : len(self.df),
-                'data' : self.df.iloc[self.tick].to_dict()}
-        self.OrderBook.update_price(data['data'],data['time'])
-        data['open_orders'] = len(self.OrderBook.get_open_orders())
-        self.send(data)
+        if self.batch_size > 1 or self.window > 1:
+            # Keep up to window batches in flight, the strategy works on the
+            # oldest one while the others are already on their way
+            while len(self.in_flight) < self.window and self.tick < len(self.feed):
+                self.send(self.next_batch())
+        else:
+            self.send(self.next_bar())
         # print("Bt: sent:", data)
-        self.tick += 1
         sleep(self.speed)
-    
-    def on_receive(self, data):
+
+    def handle_message(self, data):
         if data['message'] == 'START':
             self.tick = 0
+            self.batch_size = self.max_batch_size if data.get('batch') else 1
+            self.window = self.max_window if data.get('batch') else 1
+            self.in_flight.clear()
+            self.wake = None
+            self.subscribe(data.get('timeframes', []))
+            self.OrderBook.set_leverage(data.get('leverage'))
+        elif data['message'] == 'WAKE':
+            # Batches are already on their way, only bar by bar runs skip
+            if self.batch_size == 1 and self.window == 1:
+                try:
+                    if data.get('at') is not None:
+                        data = dict(data, at=epoch_seconds(data['at']))
+                    self.wake = data
+                except ValueError as e:
+                    self.logger.error(f"Ignoring WAKE: {e}")
         elif data['message'] == 'NO_ORDER':
             self.OrderBook.add_order(NoOrder(data['order_time']))
         elif data['message'] == 'ORDER':
@@ -93,23 +283,283 @@ class Backtester(Server):
         elif data['message'] == 'ORDERLIST':
             for order in data['data']:
                 self.OrderBook.add_order(Order(order['order_id'], order['order_type'], order['order_time'], order['order_price'], order['order_size'],order['order_SL'],order['order_TP']))
+
+    def on_receive(self, data):
+        if data['message'] == 'STATS':
+            self.stats.peer = data['data']
+            self.stop()
+            return
+        if data['message'] == 'WAKE':
+            # Not a reply, the bar is answered by the message that follows
+            self.handle_message(data)
+            return
+        if self.in_flight:
+            self.apply_batch(data)
+        else:
+            self.handle_message(data)
         if self.is_running:
             self.feed_data()
 
+    def run(self, strategy, checkpoint=None, final=None):
+        """Run the backtest with the strategy in the calling thread.
+
+        The strategy is attached to the backtester, so every bar is handed to
+        strategy.on_receive directly and its orders are applied to the
+        OrderBook without going through the socket.
+
+        Args:
+            strategy (BaseStrategy): strategy instance to drive
+            checkpoint (Checkpoint): resume from it if it exists and save to it periodically
+            final (Checkpoint): extend the finished backtest saved in it and save the new final state
+
+        Returns:
+            OrderBook: order book of the finished backtest
+        """
+        return self.run_many([strategy], checkpoint, final)[0]
+
+    def run_many(self, strategies, checkpoint=None, final=None):
+        """Run several strategies in the calling thread over one pass of the data.
+
+        Each bar is read from the DataFrame once and handed to every strategy,
+        each of which trades against its own OrderBook. The first strategy
+        uses self.OrderBook. Bars skipped by the wake conditions of all
+        strategies are not read at all.
+
+        Args:
+            strategies (list): strategy instances to drive
+            checkpoint (Checkpoint): resume from it if it exists and save to it periodically
+            final (Checkpoint): extend the finished backtest saved in it and save the new final state
+
+        Returns:
+            list: order books, in the order of the strategies
+
+        A finished backtest is extended when the data starts with all the bars
+        it ran on; only the bars after them are run. Strategies asleep on a
+        wake condition at its end wake up on the first new bar.
+        """
+        order_books = [self.OrderBook] + [OrderBook(pair=self.OrderBook.pair) for _ in strategies[1:]]
+        sessions = list(zip(strategies, order_books))
+        self.is_running = True
+        for strategy, order_book in sessions:
+            # handle_message applies orders to the current self.OrderBook
+            self.OrderBook = order_book
+            strategy.attach(self)
+            strategy.on_connect()
+        # First bar each strategy wants to see, later than the current one
+        # while it sleeps on a wake condition
+        resume = [0] * len(sessions)
+        tick = 0
+        # Continue an interrupted run of this backtest, else a finished one
+        # ending earlier
+        state = None
+        for saved in (checkpoint, final):
+            state = saved.load() if saved is not None else None
+            if state is not None and self.continues(state, strategies):
+                saved.restore(state, order_books)
+                break
+            state = None
+        if final is not None and (state is None or saved is not final):
+            # Its history file no longer matches the order books
+            final.remove()
+        if state is not None:
+            tick, resume = state['tick'], state['resume']
+            self.bar_builders, self.built = state['bar_builders'], state['built']
+            for strategy, strategy_state in zip(strategies, state['strategies']):
+                strategy.set_state(strategy_state)
+        while tick < len(self.feed):
+            bar = self.bar(tick)
+            for i, (strategy, order_book) in enumerate(sessions):
+                if tick < resume[i]:
+                    continue
+                self.OrderBook = order_book
+                order_book.update_price(bar['data'], bar['time'])
+                strategy.dispatch(dict(bar, data=dict(bar['data']), open_orders=len(order_book.get_open_orders())))
+                if self.wake is not None:
+                    # The order books are independent, the skipped bars of
+                    # this one are settled right away
+                    self.tick = tick + 1
+                    self.skip_ahead()
+                    resume[i] = self.tick
+            tick = max(tick + 1, min(resume))
+            if checkpoint is not None and checkpoint.due():
+                checkpoint.save(self.run_state(tick, resume, strategies), order_books)
+        self.tick = len(self.feed)
+        if final is not None:
+            # Before the order books close the open positions, with the
+            # metrics of what they hold so far
+            for order_book in order_books:
+                TradingMetrics(order_book, verbose=False).settle()
+            final.save(self.run_state(self.tick, resume, strategies), order_books)
+        for strategy, order_book in sessions:
+            self.OrderBook = order_book
+            self.close_orderbook()
+            # No transport in between, only the strategy side has statistics
+            strategy.stats.stop()
+            order_book.transport_stats = TransportStats()
+            order_book.transport_stats.peer = strategy.stats.to_dict()
+            strategy.on_disconnect()
+        self.OrderBook = order_books[0]
+        self.is_running = False
+        return order_books
+
+    def run_state(self, tick, resume, strategies):
+        # State of run_many before bar tick, saved in checkpoints
+        return {'tick': tick, 'time': self.feed.times[tick - 1], 'resume': resume,
+                'bar_builders': self.bar_builders, 'built': self.built,
+                'strategies': [strategy.get_state() for strategy in strategies]}
+
+    def continues(self, state, strategies):
+        """Whether a saved run_many state belongs to these strategies and to the first bars of the data."""
+        tick = state['tick']
+        return (len(state['strategies']) == len(strategies) and 0 < tick <= len(self.feed)
+                and self.feed.times[tick - 1] == state['time'])
+
+    def run_signals(self, strategy):
+        """Run a strategy that implements generate_signals without calling it bar by bar.
+
+        A signal-driven event engine: the decisions of the strategy are
+        computed once over the whole DataFrame, the fills are not. NumPy
+        searches find the bars where the strategy trades or where the SL/TP
+        of an open order is hit and only those bars go through the
+        OrderBook, one at a time. Every other bar would leave it unchanged,
+        so fills, fees and margin checks are exactly those of the OrderBook.
+        The time saved is that of on_receive and of the bars without
+        events, a strategy that trades on most bars runs about as fast as
+        with the inprocess engine.
+
+        Args:
+            strategy (BaseStrategy): strategy instance implementing generate_signals
+
+        Returns:
+            OrderBook: order book of the finished backtest
+        """
+        if self.df is None:
+            raise ValueError("generate_signals needs the whole DataFrame, set chunk_size to 0 in config.yaml to use the signals engine")
+        size = len(self.feed)
+        signals = strategy.generate_signals(self.df)
+        self.OrderBook.set_leverage(strategy.leverage)
+        flags = {}
+        for key in ('long_entries', 'short_entries', 'long_exits', 'short_exits'):
+            flags[key] = np.broadcast_to(np.asarray(signals.get(key, False), dtype=bool), (size,))
+        order_size = np.broadcast_to(np.asarray(signals['size'], dtype=float), (size,))
+        SL = np.broadcast_to(np.asarray(signals.get('SL', np.nan), dtype=float), (size,))
+        TP = np.broadcast_to(np.asarray(signals.get('TP', np.nan), dtype=float), (size,))
+        active = np.flatnonzero(flags['long_entries'] | flags['short_entries'] | flags['long_exits'] | flags['short_exits'])
+        close = self.feed.column('close')
+        times = self.feed.times
+        order_id = 0
+        # Orders opened since the last exit of each side, like a strategy
+        # keeping its own ids. Those already closed by SL/TP are left to
+        # the OrderBook, which skips their close.
+        opened = {'long_exits': [], 'short_exits': []}
+        self.is_running = True
+        for bar in active.tolist() + [size]:
+            self.skip_to(bar)
+            if bar == size:
+                break
+            time, price = times[bar], close[bar].item()
+            self.OrderBook.update_price(self.feed.row(bar), time)
+            orders = []
+            for key, Close in (('long_exits', CloseLong), ('short_exits', CloseShort)):
+                if flags[key][bar]:
+                    orders += [Close(id, time, price, amount) for id, amount in opened[key]]
+                    opened[key] = []
+            for key, exits, Open in (('long_entries', 'long_exits', OpenLong), ('short_entries', 'short_exits', OpenShort)):
+                if flags[key][bar]:
+                    order_id += 1
+                    amount = order_size[bar].item()
+                    opened[exits].append((order_id, amount))
+                    orders.append(Open(order_id, time, price, amount,
+                                       None if np.isnan(SL[bar]) else SL[bar].item(),
+                                       None if np.isnan(TP[bar]) else TP[bar].item()))
+            for order in orders:
+                self.OrderBook.add_order(order)
+            self.tick = bar + 1
+        self.close_orderbook()
+        self.is_running = False
+        return self.OrderBook
+
+    def skip_to(self, end):
+        """Advance self.tick to end, visiting only the bars where an SL/TP is hit.
+
+        Every other bar would leave the OrderBook unchanged.
+        """
+        while self.tick < end:
+            trigger = self.next_trigger(self.tick, end)
+            # The open orders are the same over the bars skipped, the last
+            # bar of the data is left to the END orders as when it is run
+            self.OrderBook.mark_bars(self.feed.slice('close', self.tick, min(trigger, len(self.feed) - 1)))
+            if trigger == end:
+                break
+            self.OrderBook.update_price(self.feed.row(trigger), self.feed.times[trigger])
+            self.tick = trigger + 1
+        self.tick = end
+
+    def skip_ahead(self, stop=None):
+        """Skip the bars before the wake condition of the strategy.
+
+        The next bar sent is the first one where the condition holds or,
+        with on_fill, where an SL/TP of an open order is hit. SL/TP hit on
+        the skipped bars are applied as if the strategy had seen them. No
+        bar from stop on is skipped.
+        """
+        condition, self.wake = self.wake, None
+        end = self.wake_tick(condition, self.tick)
+        if stop is not None:
+            end = min(end, stop)
+        if condition.get('on_fill', True):
+            end = self.next_trigger(self.tick, end)
+        self.skip_to(end)
+
+    def wake_tick(self, condition, start):
+        """First bar from start where the close or time condition of a WAKE holds, the end of the data if none."""
+        end = len(self.feed)
+        if condition.get('at') is not None:
+            # Bar times are epoch seconds in strings, compared as numbers
+            end = max(start, min(end, bisect_left(self.feed.times, condition['at'], key=int)))
+        levels = [('close', condition.get('above'), False), ('close', condition.get('below'), True)]
+        return self.first_hit(start, end, [level for level in levels if level[1] is not None])
+
+    def next_trigger(self, start, end):
+        """First bar in [start, end) where an SL/TP or liquidation price of an open order is hit, end if none."""
+        # The order closest to the price is the first to be hit
+        next_levels = self.OrderBook.next_levels()
+        levels = [('low', next_levels['long_SL'], True), ('high', next_levels['long_TP'], False),
+                  ('high', next_levels['short_SL'], False), ('low', next_levels['short_TP'], True),
+                  ('low', next_levels['long_liq'], True), ('high', next_levels['short_liq'], False)]
+        return self.first_hit(start, end, [level for level in levels if level[1] is not None])
+
+    def first_hit(self, start, end, levels):
+        """First bar in [start, end) where a column is <= level (below) or >= level for any of levels, end if none."""
+        if not levels:
+            return end
+        # Search in growing chunks, a hit is usually close. The growth is
+        # capped so a streamed dataset keeps few bars in memory.
+        step = 256
+        while start < end:
+            stop = min(end, start + step)
+            hit = np.zeros(stop - start, dtype=bool)
+            for name, level, below in levels:
+                prices = self.feed.slice(name, start, stop)
+                hit |= prices <= level if below else prices >= level
+            if hit.any():
+                return start + int(hit.argmax())
+            start = stop
+            step = min(step * 2, 1 << 16)
+        return end
+
     def disconnect(self):
         super().disconnect()
+        if self.error is not None:
+            raise self.error
         return self.OrderBook
         
 if __name__ == '__main__':
     logger = logging.getLogger('Backtester Main')
-    try:
-        backtester = Backtester('1m','2023-06-01','2023-06-02')
-        backtester.load_data()
-        backtester.start()
-    except ConnectionRefusedError:
-        backtester.port += 1
-        logger.warning("Connection refused. Using another port: ", backtester.port)
-        backtester.start()
+    backtester = Backtester('1m','2023-06-01','2023-06-02','BTCUSDT')
+    backtester.load_data()
+    logger.info(f"Session: {backtester.session}")
+    backtester.start()
     backtester.disconnect()
     logger.info("\nBacktester stopped")
     backtester.plot()
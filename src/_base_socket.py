@@ -4,14 +4,62 @@ import json
 import logging
 import os 
 import yaml
-from time import sleep
+import secrets
+from time import sleep, perf_counter
+from datetime import datetime, timezone
 from _orders import NoOrder
+from _protocol import PROTOCOL_VERSION, HEADER, Encoder, Decoder, FrameReader
+from _stats import TransportStats
+
+# Seconds a new connection has to send its START message
+START_TIMEOUT = 10
+
+
+def epoch_seconds(at) -> int:
+    """Time of a WAKE condition as epoch seconds, the unit of the 'time' of a bar.
+
+    Args:
+        at (int | str): epoch seconds, or a date such as 'YYYY-mm-dd HH:MM'
+            (UTC unless it names a timezone)
+
+    Returns:
+        int: epoch seconds
+    """
+    if isinstance(at, (int, float)) and not isinstance(at, bool):
+        return int(at)
+    if isinstance(at, str):
+        if at.isdigit():
+            return int(at)
+        try:
+            date = datetime.fromisoformat(at)
+        except ValueError:
+            pass
+        else:
+            if date.tzinfo is None:
+                date = date.replace(tzinfo=timezone.utc)
+            return int(date.timestamp())
+    raise ValueError(f"Wake time must be epoch seconds or a 'YYYY-mm-dd HH:MM' date, got {at!r}")
 
 
 class Node:
     def __init__(self):
         pass
 
+    @staticmethod
+    def _no_delay(sock):
+        # Messages are small and every one is waited for by the other end (a
+        # bar, its orders, a WAKE followed by NoOrder). Nagle's algorithm
+        # holds a message back until the previous one is acknowledged, which
+        # stalls every other round trip by the delayed ACK timeout.
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def _use_frames(self, sock):
+        # Switch this end of the connection to the framed binary protocol
+        self.protocol = PROTOCOL_VERSION
+        self.encoder = Encoder()
+        self.decoder = Decoder()
+        self.reader = FrameReader(sock)
+
     def _separate_jsons(self,input_string):
         result = []
         current_str = ""
@@ -34,76 +82,187 @@ class Node:
         return result
 
 class Server(Node):
-    def __init__(self, host='127.0.0.1', port=5001):
+    def __init__(self, host='127.0.0.1', port=0, bind=True):
         # Set self.logger name to server
         self.logger = logging.getLogger('SimTest')
         self.host = host
-        self.available_ports = range(50505, 50521, 3)
-        self.port_index = 0
 
         try:
             # read config.yaml
             with open(os.path.join(os.path.dirname(os.path.dirname(__file__)), 'config.yaml')) as f:
                 config = yaml.load(f, Loader=yaml.FullLoader)
-                self.port = config['port']
+                self.port = config.get('port', port)
         except yaml.YAMLError as exc:
             self.port = port
-        self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        while True:
-            try:
-                self.server_socket.bind((self.host, self.port))
-                break
-            except OSError:
-                self.port = self.available_ports[self.port_index]
-                self.port_index += 1
-                if self.port_index == len(self.available_ports):
-                    self.port_index = 0
-                self.logger.info(f"Port is already in use. Using another port: {self.port}")
+        self.server_socket = None
         self.client_socket = None
         self.is_running = False
+        self.protocol = 1
+        self.stats = TransportStats()
+        # Set when the connection outlives this server, e.g. a StrategySession
+        self.keep_connection = False
+        # Handed to the strategy with the port, clients must send it with START
+        self.session = secrets.token_hex(16)
+        # Strategies started by hand on a fixed port can't know the token
+        self.fixed_port = bool(self.port)
+        # In-process engine drives the strategy directly, no socket needed
+        if not bind:
+            return
+        self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            self.server_socket.bind((self.host, self.port))
+        except OSError:
+            self.logger.info(f"Port {self.port} is already in use. Using an ephemeral port.")
+            self.server_socket.bind((self.host, 0))
+            self.fixed_port = False
+        self.port = self.server_socket.getsockname()[1]
+        # Listen right away, a client connecting before start() waits in the backlog
+        self.server_socket.listen(16)
+        self.logger.info("Server is listening on {}:{}".format(self.host, self.port))
 
 
-    def start(self):
-        self.server_socket.listen(1)
-        self.logger.info("Server is listening on {}:{}".format(self.host, self.port))
-        self.client_socket, address = self.server_socket.accept()
-        self.logger.info(f"Connected to client: {address}")
-        self.is_running = True
+    def start(self, channel=None):
+        if channel is not None:
+            # Shared memory endpoint of a strategy process, framed from the start
+            self.client_socket = channel
+            self._use_frames(channel)
+            self.logger.info("Connected to client over shared memory")
+            self.is_running = True
+        else:
+            self.client_socket, address, start = self.accept()
+            self.logger.info(f"Connected to client: {address}")
+            self.is_running = True
+            self.negotiate(start)
+            self.deliver(start)
 
         self.receive_thread = threading.Thread(target=self.receive)
         self.receive_thread.start()
 
+    def accept(self):
+        """Accept connections until a client opens the session of this server.
+
+        Returns:
+            tuple: client socket, its address and its START message
+        """
+        while True:
+            client_socket, address = self.server_socket.accept()
+            start = self._read_start(client_socket)
+            if start is not None and self.authorize(start):
+                self._no_delay(client_socket)
+                return client_socket, address, start
+            self.logger.warning(f"Rejected connection from {address}: wrong session")
+            client_socket.close()
+
+    def _read_start(self, client_socket):
+        # START is always plain JSON and the client waits for the reply,
+        # so nothing follows it on the socket
+        decoder = json.JSONDecoder()
+        data = ''
+        client_socket.settimeout(START_TIMEOUT)
+        try:
+            while True:
+                chunk = client_socket.recv(4096)
+                if not chunk:
+                    return None
+                data += chunk.decode()
+                try:
+                    start, _ = decoder.raw_decode(data.lstrip())
+                    break
+                except json.decoder.JSONDecodeError:
+                    continue
+        except (socket.timeout, ConnectionResetError, UnicodeDecodeError):
+            return None
+        client_socket.settimeout(None)
+        if not isinstance(start, dict) or start.get('message') != 'START':
+            return None
+        return start
+
+    def authorize(self, start : json) -> bool:
+        token = start.get('session')
+        if token == self.session:
+            return True
+        return token is None and self.fixed_port
 
     def receive(self):
         while self.is_running:
             try:
+                if self.protocol >= 2:
+                    body = self.reader.read()
+                    if body is None:
+                        self.logger.info("Client has disconnected.")
+                        self.stop()
+                        continue
+                    start = perf_counter()
+                    deserialized_data = self.decoder.decode(body)
+                    self.stats.received(HEADER.size + len(body), perf_counter() - start)
+                    if deserialized_data is not None:
+                        self.deliver(deserialized_data)
+                    continue
                 data = self.client_socket.recv(1024*1024).decode()
                 if data:
                     try:
                         #print(deserialized_data)
+                        start = perf_counter()
                         deserialized_data = json.loads(data)
+                        self.stats.received(len(data), perf_counter() - start)
                     except json.decoder.JSONDecodeError:
                         json_list = self._separate_jsons(data)
                         for json_str in json_list:
                             try:
+                                start = perf_counter()
                                 deserialized_data = json.loads(json_str)
-                                self.on_receive(deserialized_data)
+                                self.stats.received(len(json_str), perf_counter() - start)
+                                self.negotiate(deserialized_data)
+                                self.deliver(deserialized_data)
                             except json.decoder.JSONDecodeError:
                                 self.logger.info(f"Could not deserialize data: {json_str}")
                         continue
-                    self.on_receive(deserialized_data)
+                    self.negotiate(deserialized_data)
+                    self.deliver(deserialized_data)
             except ConnectionResetError:
                 self.logger.info("Client has disconnected.")
                 self.stop()
 
+    def negotiate(self, data : json):
+        """Pick the wire protocol from the START message of the client.
+
+        Clients that do not announce a protocol keep talking plain JSON.
+        """
+        if data.get('message') == 'START' and data.get('protocol', 1) >= 2:
+            self._use_frames(self.client_socket)
+            self.logger.info(f"Using wire protocol v{self.protocol}")
+
+    def deliver(self, message : json):
+        """Hand a message of the client to on_receive, timing the handler.
+
+        Every message but START, STATS and WAKE answers the oldest bar in flight.
+        """
+        if message.get('message') not in ('START', 'STATS', 'WAKE'):
+            self.stats.reply()
+        start = perf_counter()
+        self.on_receive(message)
+        self.stats.handled(perf_counter() - start)
+
     def send(self, message : json):
-        serialized_message = json.dumps(message)
-        self.client_socket.sendall(serialized_message.encode())
+        start = perf_counter()
+        if self.protocol >= 2:
+            payload = self.encoder.encode(message)
+        else:
+            payload = json.dumps(message).encode()
+        self.stats.sent(len(payload), perf_counter() - start)
+        if message['message'] == 'PRICE':
+            self.stats.request(1)
+        elif message['message'] == 'PRICEBATCH':
+            self.stats.request(len(message['data']))
+        self.client_socket.sendall(payload)
 
     def stop(self):
         self.is_running = False
-        self.server_socket.close()
-        self.client_socket.close()
+        self.stats.stop()
+        if self.server_socket is not None:
+            self.server_socket.close()
+        if self.client_socket is not None and not self.keep_connection:
+            self.client_socket.close()
 
     def disconnect(self):
         self.receive_thread.join()
@@ -113,69 +272,122 @@ class Server(Node):
         # Raise not implemented error if you don't
         raise NotImplementedError("You must override the on_receive method in your subclass.")
 
+    def handle_message(self, data : json):
+        # Override this method in your subclass
+        # Called for strategy messages when the strategy is attached in-process
+        raise NotImplementedError("You must override the handle_message method in your subclass.")
+
 class Client(Node):
-    def __init__(self, host='127.0.0.1', port=5001):
+    def __init__(self, host='127.0.0.1', port=0):
         # Set self.logger name to strategy
         self.logger = logging.getLogger('Strategy')
         self.host = host
-        self.available_ports = range(50505, 50521, 3)
-        self.port_index = 0
         try:
             # read config.yaml
             with open(os.path.join(os.path.dirname(os.path.dirname(__file__)), 'config.yaml')) as f:
                 config = yaml.load(f, Loader=yaml.FullLoader)
-                self.port = config['port']
+                self.port = config.get('port', port)
         except yaml.YAMLError as exc:
             self.port = port
         self.flipper = -1
         self.client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.is_running = False
         self.is_sent = False
+        self.protocol = 1
+        self.stats = TransportStats()
+        # Orders collected while a PRICEBATCH is being processed
+        self.batch = None
+        self.batch_tick = None
+        # Set by attach() when the strategy runs inside the server's thread
+        self.server = None
+        # Token of the server session to join, sent with START
+        self.session = None
+        # Set by adopt() when the connection belongs to a persistent worker
+        self.keep_connection = False
 
-    def connect(self):
-        while True:
+    def connect(self, channel=None, port=None, session=None):
+        """Connect to the server and send START.
+
+        Args:
+            channel (ShmEndpoint): shared memory endpoint used instead of TCP
+            port (int): port of the server, defaults to the port in config.yaml
+            session (str): session token handed out by the server
+        """
+        if port is not None:
+            self.port = port
+        if session is not None:
+            self.session = session
+        if channel is not None:
+            # Shared memory endpoint handed over by the server process
+            self.client_socket.close()
+            self.client_socket = channel
+            self._use_frames(channel)
+            self.logger.info("Connected to server over shared memory")
+        while channel is None:
             try:
                 self.client_socket.connect((self.host, self.port))
+                self._no_delay(self.client_socket)
                 self.logger.info("Connected to server on {}:{}".format(self.host, self.port))
                 break
-            except ConnectionRefusedError:
-                self.port = self.available_ports[self.port_index]
-                self.port_index += 1
-                if self.port_index == len(self.available_ports):
-                    self.port_index = 0
-                # cancel previous attempt
+            except OSError:
+                # Only strategies started by hand can get here before the server
                 self.client_socket.close()
                 self.client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
                 self.logger.info(f"\nServer is not available. Retrying(port={self.port})...")
-                sleep(2)
-            except OSError:
-                self.logger.info("\nServer is not available. Retrying...")
-                sleep(2)
+                sleep(1)
         self.is_running = True
 
         self.receive_thread = threading.Thread(target=self.receive)
         self.receive_thread.start()
         self.on_connect()
-        self.is_sent = False
 
     def receive(self):
+        try:
+            # The server answers START in the protocol it agreed to,
+            # a reply starting with '{' means it only speaks JSON
+            if self.protocol < 2:
+                first = self.client_socket.recv(1, socket.MSG_PEEK)
+                if first and first != b'{':
+                    self._use_frames(self.client_socket)
+        except ConnectionResetError:
+            pass
         while self.is_running:
             try:
-                decoded_data = self.client_socket.recv(1024).decode()
+                if self.protocol >= 2:
+                    body = self.reader.read()
+                    if body is None:
+                        self.logger.info("Server has disconnected.")
+                        self.stop()
+                        continue
+                    start = perf_counter()
+                    deserialized_data = self.decoder.decode(body)
+                    self.stats.received(HEADER.size + len(body), perf_counter() - start)
+                    if deserialized_data is None:
+                        continue
+                    if deserialized_data['message'] == 'END':
+                        self.report()
+                        self.stop()
+                        return
+                    try:
+                        print("[{}]/[{}]".format(deserialized_data['tick'],deserialized_data['size']), end="\r")
+                    except KeyError:
+                        pass
+                    self.dispatch(deserialized_data)
+                    continue
+                decoded_data = self.client_socket.recv(1024*1024).decode()
                 if decoded_data:
                     try:
+                        start = perf_counter()
                         deserialized_data = json.loads(decoded_data)
+                        self.stats.received(len(decoded_data), perf_counter() - start)
                     except json.decoder.JSONDecodeError:
                         json_list = self._separate_jsons(decoded_data)
                         for json_str in json_list:
                             try:
+                                start = perf_counter()
                                 deserialized_data = json.loads(json_str)
-                                self.on_receive(deserialized_data)
-                                if self.is_sent:
-                                    self.is_sent = False
-                                else:
-                                    self.send(NoOrder(deserialized_data['time']).to_dict())
-                                    self.is_sent = False
+                                self.stats.received(len(json_str), perf_counter() - start)
+                                self.dispatch(deserialized_data)
                             except json.decoder.JSONDecodeError:
                                 self.logger.info("Could not deserialize data: ", json_str)
                         continue
@@ -186,30 +398,144 @@ class Client(Node):
                         print("[{}]/[{}]".format(deserialized_data['tick'],deserialized_data['size']), end="\r")
                     except KeyError:
                         pass
-                    self.on_receive(deserialized_data)
-                    if self.is_sent:
-                        self.is_sent = False
-                    else:
-                        self.send(NoOrder(deserialized_data['time']).to_dict())
-                        self.is_sent = False
+                    self.dispatch(deserialized_data)
             except ConnectionResetError:
                 self.logger.info("Server has disconnected.")
                 self.stop()
 
+    def dispatch(self, data):
+        """Hand a bar to on_receive and answer with NoOrder if the strategy sent nothing.
+
+        A PRICEBATCH is unpacked bar by bar and answered with one ORDERLIST in
+        which every order is tagged with the tick it was sent for.
+        """
+        if data['message'] == 'PRICEBATCH':
+            self.batch = []
+            for bar in data['data']:
+                self.batch_tick = bar['tick']
+                start = perf_counter()
+                self.on_receive(bar)
+                self.stats.handled(perf_counter() - start)
+                self.is_sent = False
+            self.stats.bars += len(data['data'])
+            orders, self.batch = self.batch, None
+            # The sequence number tells the server which batch these orders answer
+            self._write({'message': 'ORDERLIST', 'seq': data['seq'], 'data': orders})
+            return
+        start = perf_counter()
+        self.on_receive(data)
+        self.stats.handled(perf_counter() - start)
+        self.stats.bars += 1
+        if self.is_sent:
+            self.is_sent = False
+        else:
+            self.send(NoOrder(data['time']).to_dict())
+            self.is_sent = False
+
+    def adopt(self, link):
+        """Run on the framed connection of link instead of opening one.
+
+        Used by persistent workers, which create a fresh strategy for every
+        backtest on the same connection. The connection is left open when
+        the backtest ends.
+        """
+        self.client_socket.close()
+        self.client_socket = link.client_socket
+        self.protocol = link.protocol
+        self.encoder = link.encoder
+        self.decoder = link.decoder
+        self.reader = link.reader
+        self.keep_connection = True
+
+    def attach(self, server):
+        """Bind the strategy to a server running in the same thread.
+
+        Messages passed to send() are handed to server.handle_message instead
+        of being serialized over the socket.
+        """
+        self.server = server
+        self.client_socket.close()
+        self.is_running = True
+
     def send(self, message):
-        self.is_sent = True
+        # START is not the reply to a bar. Counting it as one swallowed the
+        # NoOrder of the first bar whenever the bar came in before on_connect
+        # returned, or was handed in right after it by an in-process engine.
+        self.is_sent = message['message'] != 'START'
         try:
             if message['data'] == []:
                 self.is_sent = False
                 return
         except KeyError:
             pass 
-        serialized_message = json.dumps(message)
-        self.client_socket.sendall(serialized_message.encode())
+        if self.batch is not None:
+            self.collect(message)
+            return
+        self._write(message)
+
+    def wake(self, above=None, below=None, at=None, on_fill=True):
+        """Skip the coming bars until one of them is worth looking at.
+
+        The server stops sending bars until the close reaches above or
+        below, the time of a bar reaches at or, with on_fill, an SL/TP of an
+        open order is hit. Skipped bars are answered with NoOrder by the server
+        and SL/TP are still applied on them. The condition is dropped by
+        servers that send batches or do not speak protocol v2.
+
+        Args:
+            above (float): wake when close >= above
+            below (float): wake when close <= below
+            at (int | str): wake at the first bar at or after this time, in
+                epoch seconds as the 'time' of a PRICE message or as a
+                'YYYY-mm-dd HH:MM' date in UTC
+            on_fill (bool): wake on the bar where an SL/TP is hit
+        """
+        if at is not None:
+            at = epoch_seconds(at)
+        if self.batch is not None or (self.server is None and self.protocol < 2):
+            return
+        # Not a reply, the bar is still answered with orders or NoOrder
+        self._write({'message': 'WAKE', 'above': above, 'below': below, 'at': at, 'on_fill': on_fill})
+
+    def collect(self, message):
+        # Orders of a PRICEBATCH are tagged with their tick and sent together
+        if message['message'] == 'ORDER':
+            self.batch.append(dict(message, tick=self.batch_tick))
+        elif message['message'] == 'ORDERLIST':
+            self.batch.extend(dict(order, tick=self.batch_tick) for order in message['data'])
+
+    def _write(self, message):
+        if self.server is not None:
+            self.server.handle_message(message)
+            return
+        if message.get('message') == 'START':
+            # Ask the server for the framed protocol, and for batched bars
+            # if the strategy does without 'open_orders'
+            message = dict(message, protocol=PROTOCOL_VERSION)
+            if self.batching:
+                message['batch'] = True
+            if self.session is not None:
+                message['session'] = self.session
+        start = perf_counter()
+        if self.protocol >= 2:
+            payload = self.encoder.encode(message)
+        else:
+            payload = json.dumps(message).encode()
+        self.stats.sent(len(payload), perf_counter() - start)
+        self.client_socket.sendall(payload)
+
+    def report(self):
+        # A framed server waits for the statistics of the strategy after END
+        self.stats.stop()
+        try:
+            self._write({'message': 'STATS', 'data': self.stats.to_dict()})
+        except OSError:
+            pass
 
     def stop(self):
         self.is_running = False
-        self.client_socket.close()
+        if not self.keep_connection:
+            self.client_socket.close()
 
     def disconnect(self):
         self.receive_thread.join()
@@ -2,8 +2,33 @@ from _base_socket import Client
 import json 
 
 class BaseStrategy(Client):
+    # Higher timeframes built from the backtest interval and sent with every
+    # bar under 'timeframes', e.g. ['1h', '4h'] (see _timeframes.py)
+    timeframes = []
+    # Bars of history the decisions of the strategy depend on while it holds
+    # no order. Strategies that set it can be split in time over several
+    # processes by the parallel engine (see _parallel.py)
+    warmup = None
+    # Leverage of the futures positions of the strategy, None for the one in
+    # config.yaml. Set it from a parameter to sweep leverages.
+    leverage = None
+    # Set by strategies that never read 'open_orders' to let the socket
+    # engine send them bars in batches (batch_size and window in
+    # config.yaml). Batched bars carry no 'open_orders', so the results of
+    # other strategies would change.
+    batching = False
+    # Set by strategies that trade every pair of a portfolio backtest from its
+    # SNAPSHOT messages. Others are run on each pair on their own, against
+    # the balance shared by all pairs (see _portfolio.py)
+    portfolio = False
+    # Names of the attributes saved in checkpoints of long backtests, None
+    # for every attribute the strategy sets itself (see get_state)
+    state_attributes = None
+
     def __init__(self):
         super().__init__()
+        # Everything set up to here belongs to the connection, not the strategy
+        self._client_attributes = frozenset(vars(self)) | {'_client_attributes'}
 
     def on_disconnect(self):
         """
@@ -29,8 +54,60 @@ class BaseStrategy(Client):
         """
         # Send start signal to get the data stream
         payload = {'message': 'START'}
+        if self.timeframes:
+            payload['timeframes'] = list(self.timeframes)
+        if self.leverage is not None:
+            payload['leverage'] = self.leverage
         self.send(payload)
 
+    def get_state(self):
+        """
+        Summary: State of the strategy saved in checkpoints of long backtests.
+                The attributes listed in state_attributes, by default every
+                attribute set by the strategy itself. List the ones the
+                decisions depend on, or override it (and set_state), if some
+                of them can't be pickled or are too large to save every time.
+        Args:
+            None
+
+        Returns:
+            Picklable object handed back to set_state on resume.
+        """
+        if self.state_attributes is not None:
+            return {name: getattr(self, name) for name in self.state_attributes}
+        return {name: value for name, value in vars(self).items() if name not in self._client_attributes}
+
+    def set_state(self, state):
+        """
+        Summary: Restore the state returned by get_state when a backtest resumes
+                from a checkpoint.
+        Args:
+            state: object returned by get_state
+
+        Returns:
+            None
+        """
+        vars(self).update(state)
+
+    def generate_signals(self, df):
+        """
+        Summary: Optional hook for strategies that are pure functions of indicator arrays.
+                Used by the signals engine, which calls it once instead of
+                calling on_receive for every bar.
+
+        Args:
+            df: DataFrame of the whole backtest, indexed by date.
+
+        Returns:
+            dict of arrays (or scalars) with one value per row of df:
+                long_entries, short_entries: open a position at the close of the bar
+                long_exits, short_exits: close every open long/short at the close of the bar
+                size: order size (required)
+                SL, TP: stop loss and take profit in percent, NaN for none (optional)
+            Exits of a bar are sent before its entries.
+        """
+        raise NotImplementedError("You must override the generate_signals method to use the signals engine.")
+
     def on_receive(self, data: json) :
         """
         Summary: This method is called when the strategy receives data from the server.
@@ -0,0 +1,110 @@
+from _orders import EventStore
+from time import perf_counter
+import logging
+import pickle
+import shutil
+import os
+
+# Checkpoints of in-process backtests. A checkpoint directory holds
+#
+#   state.pkl        next tick, order books without their history, strategy
+#                    states and the number of history entries of each book
+#   history-<i>.pkl  order history of order book i
+#
+# The order history only grows, so every checkpoint appends the entries
+# added since the previous one to history-<i>.pkl instead of writing it
+# again. state.pkl is written last and replaced atomically; entries appended
+# after it by a checkpoint that did not finish are dropped on load, the
+# file is truncated after the last entry of the checkpoint.
+#
+# The same format keeps the final state of finished backtests, taken before
+# the order book closes the open positions, so that a later backtest with
+# the same start and a later end only runs the new bars. The order books
+# carry the running metrics of their orders and trades up to that state,
+# the metrics of the later backtest only add the new ones.
+
+
+class Checkpoint:
+    """Periodic checkpoints of a backtest, saved at most every interval seconds.
+
+    Args:
+        path (str): checkpoint directory
+        interval (float): seconds between checkpoints
+    """
+    def __init__(self, path: str, interval: float):
+        self.logger = logging.getLogger('Checkpoint')
+        self.path = path
+        self.interval = interval
+        self.last = perf_counter()
+        # History entries of every order book already on disk
+        self.saved = []
+
+    def due(self) -> bool:
+        return perf_counter() - self.last >= self.interval
+
+    def _history_path(self, index: int) -> str:
+        return os.path.join(self.path, f'history-{index}.pkl')
+
+    def save(self, state: dict, order_books: list):
+        """Save state, the order books and the history added since the last checkpoint."""
+        os.makedirs(self.path, exist_ok=True)
+        self.saved += [0] * (len(order_books) - len(self.saved))
+        for index, order_book in enumerate(order_books):
+            history = order_book.order_history
+            with open(self._history_path(index), 'ab') as f:
+                pickle.dump(history[self.saved[index]:], f, pickle.HIGHEST_PROTOCOL)
+            self.saved[index] = len(history)
+        state = dict(state, order_books=[order_book.get_state() for order_book in order_books], history=list(self.saved))
+        temporary = os.path.join(self.path, 'state.pkl.tmp')
+        try:
+            with open(temporary, 'wb') as f:
+                pickle.dump(state, f, pickle.HIGHEST_PROTOCOL)
+        except (pickle.PicklingError, TypeError, AttributeError) as e:
+            os.remove(temporary)
+            # The history appended above is dropped on load, the backtest
+            # goes on without checkpoints
+            self.interval = float('inf')
+            self.logger.error(f"Checkpoints disabled, {self.unpicklable(state['strategies'])} can't be pickled ({e}). "
+                              f"List the attributes to save in state_attributes or override get_state and set_state.")
+            return
+        os.replace(temporary, os.path.join(self.path, 'state.pkl'))
+        self.last = perf_counter()
+        self.logger.info(f"Checkpoint saved at tick {state['tick']}")
+
+    @staticmethod
+    def unpicklable(strategies: list) -> str:
+        """Describe the first attribute of the strategy states that can't be pickled."""
+        for index, strategy_state in enumerate(strategies):
+            for name, value in (strategy_state.items() if isinstance(strategy_state, dict) else [('state', strategy_state)]):
+                try:
+                    pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+                except Exception:
+                    return f"attribute '{name}' of strategy {index}"
+        return "the state of the order books"
+
+    def load(self) -> dict:
+        """State of the checkpoint, None if there is none."""
+        try:
+            with open(os.path.join(self.path, 'state.pkl'), 'rb') as f:
+                return pickle.load(f)
+        except FileNotFoundError:
+            return None
+
+    def restore(self, state: dict, order_books: list):
+        """Restore the order books from the checkpoint of state."""
+        for index, (order_book, length) in enumerate(zip(order_books, state['history'])):
+            history = EventStore()
+            with open(self._history_path(index), 'rb') as f:
+                while len(history) < length:
+                    history.extend(pickle.load(f))
+                end = f.tell()
+            order_book.set_state(state['order_books'][index])
+            order_book.order_history = history[:length]
+            # Later appends go after the entries of this checkpoint only
+            os.truncate(self._history_path(index), end)
+        self.saved = list(state['history'])
+        self.logger.info(f"Continuing from the checkpoint at tick {state['tick']}")
+
+    def remove(self):
+        shutil.rmtree(self.path, ignore_errors=True)
+        self.saved = []
@@ -0,0 +1,154 @@
+from collections import deque
+from collections.abc import Sequence
+import copy
+import numpy as np
+import pandas as pd
+
+
+class Feed:
+    """Columnar copy of the OHLCV DataFrame of a backtest.
+
+    The columns are converted to one NumPy array and the timestamps to the
+    strings sent with every bar once, when the data is loaded. Building a
+    PRICE message is then a row lookup instead of several pandas indexing
+    calls and a Series to dict conversion per tick.
+    """
+    def __init__(self, df):
+        self.columns = list(df.columns)
+        # Same common dtype as df.iloc[tick], so bars carry the same values
+        self.values = df.to_numpy()
+        self.close_index = self.columns.index('close')
+        self.times = [str(index)[:-3] for index in df.index]
+        self.columns_cache = {}
+
+    def __len__(self):
+        return len(self.times)
+
+    def column(self, name: str) -> np.ndarray:
+        # Searched again on every skip, converted once
+        if name not in self.columns_cache:
+            self.columns_cache[name] = self.values[:, self.columns.index(name)].astype(float)
+        return self.columns_cache[name]
+
+    def slice(self, name: str, start: int, stop: int) -> np.ndarray:
+        """Values of a column for the bars in [start, stop)."""
+        return self.column(name)[start:stop]
+
+    def view(self, start: int) -> 'Feed':
+        """Feed of the bars from start on, sharing the arrays of this one."""
+        feed = copy.copy(self)
+        feed.values = self.values[start:]
+        feed.times = self.times[start:]
+        feed.columns_cache = {name: column[start:] for name, column in self.columns_cache.items()}
+        return feed
+
+    def _row(self, tick: int) -> list:
+        return self.values[tick].tolist()
+
+    def row(self, tick: int) -> dict:
+        return dict(zip(self.columns, self._row(tick)))
+
+    def bar(self, tick: int) -> dict:
+        """PRICE message of the bar at tick, without 'open_orders'."""
+        row = self._row(tick)
+        return {'price' : row[self.close_index],
+                'tick' : tick,
+                'time': self.times[tick],
+                'message' : 'PRICE', 'size' : len(self.times),
+                'data' : dict(zip(self.columns, row))}
+
+
+class TimeIndex(Sequence):
+    """Bar times as sent in PRICE messages, formatted when they are read.
+
+    A list of strings costs far more memory than the dates it is made of.
+    """
+    def __init__(self, dates):
+        self.dates = dates
+
+    def __len__(self):
+        return len(self.dates)
+
+    def __getitem__(self, tick):
+        if isinstance(tick, slice):
+            return [str(date)[:-3] for date in self.dates[tick].tolist()]
+        return str(self.dates[tick])[:-3]
+
+
+class StreamFeed(Feed):
+    """Feed reading the CSV of a backtest in chunks instead of all at once.
+
+    Only the time and close of every bar stay in memory (summary), they are
+    what the metrics and closing the order book need. The other columns are
+    read chunk_size bars at a time as the backtest moves forward and chunks
+    behind the bars being read are dropped, so memory does not grow with the
+    date range. Going back to a dropped bar reads the file again from the
+    start.
+
+    Args:
+        path (str): processed CSV of the dataset
+        names (list): column names of the CSV, one of them is 'date'
+        chunk_size (int): bars read at a time
+    """
+    def __init__(self, path: str, names: list, chunk_size: int):
+        self.path = path
+        self.names = names
+        self.chunk_size = chunk_size
+        self.columns = [name for name in names if name != 'date']
+        self.close_index = self.columns.index('close')
+        summary = pd.read_csv(path, usecols=[names.index('date'), names.index('close')])
+        summary.columns = [name for name in names if name in ('date', 'close')]
+        self.summary = summary.set_index('date')
+        self.times = TimeIndex(self.summary.index.to_numpy())
+        self.close = self.summary['close'].to_numpy(dtype=float)
+        self.reader = None
+        # (first tick, values) of the chunks in memory, oldest first
+        self.chunks = deque()
+        self.loaded = 0
+
+    def _rewind(self):
+        if self.reader is not None:
+            self.reader.close()
+        self.reader = pd.read_csv(self.path, chunksize=self.chunk_size)
+        self.chunks.clear()
+        self.loaded = 0
+
+    def _load(self, start: int, stop: int):
+        # Keep the chunks holding [start, stop), reading forward if needed
+        first = self.chunks[0][0] if self.chunks else self.loaded
+        if self.reader is None or start < first:
+            self._rewind()
+        while self.chunks and self.chunks[0][0] + len(self.chunks[0][1]) <= start:
+            self.chunks.popleft()
+        while self.loaded < stop:
+            chunk = next(self.reader)
+            chunk.columns = self.names
+            values = chunk.set_index('date').to_numpy()
+            self.chunks.append((self.loaded, values))
+            self.loaded += len(values)
+            while self.chunks and self.chunks[0][0] + len(self.chunks[0][1]) <= start:
+                self.chunks.popleft()
+
+    def column(self, name: str) -> np.ndarray:
+        if name != 'close':
+            raise ValueError(f"Only the close column of a StreamFeed is in memory, use slice for {name}")
+        return self.close
+
+    def slice(self, name: str, start: int, stop: int) -> np.ndarray:
+        if name == 'close':
+            return self.close[start:stop]
+        stop = min(stop, len(self))
+        if start >= stop:
+            return np.empty(0)
+        self._load(start, stop)
+        index = self.columns.index(name)
+        parts = [values[max(start - first, 0):stop - first, index]
+                 for first, values in self.chunks if first < stop and first + len(values) > start]
+        return np.concatenate(parts).astype(float)
+
+    def _row(self, tick: int) -> list:
+        self._load(tick, tick + 1)
+        for first, values in self.chunks:
+            if first <= tick < first + len(values):
+                return values[tick - first].tolist()
+        raise IndexError(f"Bar {tick} is out of the {len(self)} bars of the dataset")
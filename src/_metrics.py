@@ -1,24 +1,32 @@
-from _orders import OrderBook, OpenLong, OpenShort, CloseLong, CloseShort, NoOrder
+from _orders import OrderBook, OpenLong, OpenShort, CloseLong, CloseShort, NoOrder, LONG, SHORT
 from matplotlib import pyplot as plt
 from datetime import datetime
 from tqdm import tqdm
 import pandas as pd
+import numpy as np
 import os
 import yaml
 import logging
 import json
-# import groupby
-from itertools import groupby
+import copy
 
 class TradingMetrics:
+    # Everything the metrics are built from as the orders and trades come
+    # in, kept on the OrderBook by settle() so that an extended backtest only
+    # adds its new orders and trades
+    RUNNING = ('open_orders', 'prices', 'longs', 'shorts', 'win_rate', 'pnl', 'profit_factor', 'drawdown', 'rrr',
+               'average_pnl', 'total_position_size', 'position_count', 'profits', 'losses', 'winning_count',
+               'losing_count', 'winning_count_long', 'winning_count_short', 'losing_count_long', 'losing_count_short',
+               'profits_long', 'profits_short', 'losses_long', 'losses_short', 'peak', 'max_drawdown', 'best_win',
+               'worst_loss', 'consec_wins', 'consec_losses', 'max_consec_wins', 'max_consec_losses', 'orders', 'trades')
+
     def __init__(self, order_book, verbose=True):
         self.verbose = verbose
         # set logger name to TradingMetrics
         self.logger = logging.getLogger('TradingMetrics')
+        # The logger is shared, a quiet instance must not silence the next one
+        self.logger.setLevel(logging.NOTSET if self.verbose else logging.ERROR)
         self.logger.info("TradingMetrics initialized.")
-        if not self.verbose:
-            # set logging level to ERROR
-            self.logger.setLevel(logging.ERROR)
         self.order_book = order_book
         if self.order_book is None:
             self.logger.error("Error in TradingMetrics: order_book is None. Quitting.")
@@ -26,6 +34,11 @@ class TradingMetrics:
         if self.order_book.win == 0 and self.order_book.loss == 0:
             self.logger.warning("Warning in TradingMetrics: Win and Loss are both 0. Either strategy did NOT trade (this may be due to the frequency of the strategy and the backtesting period) or possible error in strategy. Please double check.")
         self.open_orders = {}
+        # Prices of the bars orders were filled at, their fill prices
+        self.prices = {}
+        # Orders and trades of the OrderBook already added
+        self.orders = 0
+        self.trades = 0
         self.num_trades = len(self.order_book.order_history)
         ########### define metrics to be tracked
         self.longs = []
@@ -45,6 +58,16 @@ class TradingMetrics:
         self.losses = 0
         self.winning_count = 0
         self.losing_count = 0
+        self.peak = 0
+        # First trade with the deepest drawdown, best and worst trades and
+        # the current and longest runs of wins and losses
+        self.max_drawdown = None
+        self.best_win = float('-inf')
+        self.worst_loss = float('inf')
+        self.consec_wins = 0
+        self.consec_losses = 0
+        self.max_consec_wins = 0
+        self.max_consec_losses = 0
 
         self.largest_open_position_size = 0
         self.largest_open_position_size_usd = 0
@@ -63,15 +86,9 @@ class TradingMetrics:
 
         ########## define metrics to be tracked
 
-        # Order Book price information
+        # Order Book price information, filled in by calculate_metrics
         self.df = self.order_book.df
         self.price_dict = {}
-        try:
-            for i in tqdm(range(len(self.df)), desc="Creating price dictionary"):
-                self.price_dict[str(self.df.iloc[i].name)[:-3]] = self.df.iloc[i].close
-        except Exception as e:
-            self.logger.error(e)
-            self.logger.error("Error in TradingMetrics: Either df is None or df is not in the correct format")
         # config.yaml path is relative to the main.py file
         with open(os.path.join(os.path.dirname(os.path.dirname(__file__)), 'config.yaml')) as f:
             self.config = yaml.load(f, Loader=yaml.FullLoader)
@@ -86,10 +103,23 @@ class TradingMetrics:
         if self.num_trades == 0:
             self.logger.warning("Warning in TradingMetrics: Number of trades is 0")
         else:
-            for order_index in tqdm(range(self.num_trades),desc="Adding orders to TradingMetrics"):
-                self.add_order(self.order_book.order_history[order_index])
-                tick_price = self.price_dict[str(self.order_book.order_history[order_index].order_time)]
-                self.calculate_maximum_unrealized_loss(tick_price)
+            try:
+                # One pass over the columns, with the fill prices of the bars traded at
+                self.price_dict = dict(zip((str(index)[:-3] for index in self.df.index), self.df['close'].tolist()))
+            except Exception as e:
+                self.logger.error(e)
+                self.logger.error("Error in TradingMetrics: Either df is None or df is not in the correct format")
+            # Only the orders and trades after those settled before an
+            # extension are added
+            if self.order_book.metrics_state is not None:
+                self.set_state(self.order_book.metrics_state)
+            self.advance()
+            self.price_dict.update(self.prices)
+            # The largest position and unrealized loss come from the net
+            # positions the OrderBook kept
+            self.largest_open_position_size_usd = self.order_book.max_position_cost
+            self.largest_open_position_size = self.order_book.max_position_size
+            self.maximum_unrealized_loss = self.order_book.max_unrealized_loss
             
             self.post_process()
 
@@ -122,66 +152,59 @@ class TradingMetrics:
                     self.logger.error(e)
         return self._core
     
-    def calculate_largest_position_size(self,price):
-        money_spent = 0
-        for order in self.open_orders.values():
-            money_spent += order.order_price * order.order_size
-        if money_spent > self.largest_open_position_size_usd:
-            self.largest_open_position_size_usd = money_spent
-            self.largest_open_position_size = money_spent / price
-
-    def calculate_maximum_unrealized_loss(self,price):
-        """This function calculates the maximum unrealized loss of the strategy
-        in order to calculate the suggested leverage and stop loss.
-
-        Args:
-            price (_type_): price
-        """
-        curr_pnl = 0
-        for order in self.open_orders.values():
-            if "LONG" in order.order_type:
-                curr_pnl += (price - order.order_price) * order.order_size
-            elif "SHORT" in order.order_type:
-                curr_pnl += (order.order_price - price) * order.order_size
-        if curr_pnl < self.maximum_unrealized_loss:
-            self.maximum_unrealized_loss = curr_pnl
+    def get_state(self) -> dict:
+        return {name: copy.copy(getattr(self, name)) for name in self.RUNNING}
+
+    def set_state(self, state: dict):
+        for name, value in state.items():
+            setattr(self, name, copy.copy(value))
+
+    def advance(self):
+        """Add the orders and the trades of the OrderBook added since the last call."""
+        history, ledger = self.order_book.order_history, self.order_book.ledger
+        for order in tqdm(history[self.orders:], total=len(history) - self.orders, desc="Adding orders to TradingMetrics"):
+            self.add_order(order)
+        # The closed trades come from the ledger
+        self.add_trades(ledger, self.trades)
+        self.orders, self.trades = len(history), len(ledger)
+        self.calculate_all()
+
+    def settle(self):
+        """Keep the metrics of the orders and trades so far on the OrderBook,
+        saved with its final state before the open positions are closed."""
+        if self.order_book.metrics_state is not None:
+            self.set_state(self.order_book.metrics_state)
+        self.advance()
+        self.order_book.metrics_state = self.get_state()
 
-    
     def add_order(self, order):
         try:
             if OpenLong.isinstance(order) or OpenShort.isinstance(order):
                 self.total_position_size += order.order_size
                 self.position_count += 1
                 self.open_orders[order.order_id] = order
-                self.calculate_largest_position_size(order.order_price)
             elif CloseLong.isinstance(order) or CloseShort.isinstance(order):
                 open_order = self.open_orders.pop(order.order_id)
-                self._pnl(open_order, order)
+                self.prices[open_order.order_time] = open_order.order_price
+                self.prices[order.order_time] = order.order_price
         except KeyError as e:
             self.logger.error(e)
             exit()
 
-    def _pnl(self, open_order, close_order):
-        if CloseLong.isinstance(close_order):
-            # pnl = (close_order.order_price - open_order.order_price) * open_order.order_size
-            pnl = close_order.order_price * close_order.order_size - open_order.order_price * open_order.order_size
-            # if self.order_book.fee_included:
-            #     pnl -= open_order.order_price * open_order.order_size * self.order_book.fee_percent
-            #     pnl -= close_order.order_price * open_order.order_size * self.order_book.fee_percent
-            self.pnl.append((pnl,open_order.order_time,close_order.order_time,open_order.order_type))
-            self.price_dict[open_order.order_time] = open_order.order_price
-            self.price_dict[close_order.order_time] = close_order.order_price
-            self.longs.append((open_order.order_time,close_order.order_time))
-        elif CloseShort.isinstance(close_order):
-            # pnl = (open_order.order_price - close_order.order_price) * open_order.order_size
-            pnl = open_order.order_price * open_order.order_size - close_order.order_price * open_order.order_size
-            # if self.order_book.fee_included:
-            #     pnl -= open_order.order_price * open_order.order_size * self.order_book.fee_percent
-            #     pnl -= close_order.order_price * open_order.order_size * self.order_book.fee_percent
-            self.pnl.append((pnl,open_order.order_time,close_order.order_time,open_order.order_type))
-            self.price_dict[open_order.order_time] = open_order.order_price
-            self.price_dict[close_order.order_time] = close_order.order_price
-            self.shorts.append((open_order.order_time,close_order.order_time))
+    def add_trades(self, ledger, start=0):
+        for index in range(start, len(ledger)):
+            open_time, close_time = ledger.open_time[index], ledger.close_time[index]
+            open_price, open_size = ledger.open_price[index], ledger.open_size[index]
+            if ledger.side[index] == LONG:
+                # pnl = (close_price - open_price) * open_size
+                pnl = ledger.close_price[index] * ledger.close_size[index] - open_price * open_size
+                self.pnl.append((pnl,open_time,close_time,LONG))
+                self.longs.append((open_time,close_time))
+            else:
+                # pnl = (open_price - close_price) * open_size
+                pnl = open_price * open_size - ledger.close_price[index] * open_size
+                self.pnl.append((pnl,open_time,close_time,SHORT))
+                self.shorts.append((open_time,close_time))
 
     def post_process(self):
         self.calculate_all()
@@ -268,6 +291,7 @@ class TradingMetrics:
             'Fee Included': self.order_book.fee_included,
             'Fee Percent': self.order_book.fee_percent,
             'Stop Loss': self.order_book.stop_loss,
+            'Leverage': self.order_book.leverage,
             'ROI%': 0,
             'Win Rate': 0,
             'Profit Factor': 0,
@@ -282,7 +306,7 @@ class TradingMetrics:
             'Total Win': 0,
             'Total Loss': 0,
             'Total Fee Paid': -1*self.order_book.paid_fee,
-            'Final Balance': self.order_book.balance,
+            'Final Balance': self.order_book.own_balance,
             'Average Fee Paid': self.order_book.paid_fee / len(self.pnl)*2 if len(self.pnl)*2 > 0 else 0,
             'Average Win': 0,
             'Average Loss': 0,
@@ -299,6 +323,7 @@ class TradingMetrics:
             'Sugg. Leverage': 0,
             'Sugg. Stop Loss': 0,
             '# of SL Triggered': self.order_book.sl_triggered_order_count,
+            '# of Liquidations': self.order_book.liquidated_order_count,
             'SL/Total Trades(%)': 0,
             'Long PF': 0,
             'Long Win Rate': 0,
@@ -318,34 +343,31 @@ class TradingMetrics:
 
             # NUMERICS
             # 1. Calculate max drawdown
-            result_dict['Max. DD'] = min(self.drawdown)[0] 
+            drawdown = self.max_drawdown
+            result_dict['Max. DD'] = drawdown[0]
 
             # 2. Calculate max drawdown duration
-            max_drawdown_duration = 0
-            for drawdown in self.drawdown:
-                if drawdown[0] == result_dict['Max. DD']:
-                    # drawdown[2] is the timestamp of the end of the drawdown as string
-                    # drawdown[1] is the timestamp of the start of the drawdown as string
-                    close = int(drawdown[2])
-                    open = int(drawdown[1])
-                    max_drawdown_duration = close - open # as seconds
-                    # convert timestamp difference to minutes
-                    max_drawdown_duration = max_drawdown_duration / 60 # minutes
-                    break
+            # drawdown[2] is the timestamp of the end of the drawdown as string
+            # drawdown[1] is the timestamp of the start of the drawdown as string
+            close = int(drawdown[2])
+            open = int(drawdown[1])
+            max_drawdown_duration = close - open # as seconds
+            # convert timestamp difference to minutes
+            max_drawdown_duration = max_drawdown_duration / 60 # minutes
             result_dict['Max. DD Duration'] = max_drawdown_duration
 
             # Total number of trades
             result_dict['Total Trades'] = len(self.pnl)
 
             # Total number of winning trades
-            result_dict['Winning Trades'] = len([pnl for pnl in self.pnl if pnl[0] > 0])
-            result_dict['Losing Trades'] = len([pnl for pnl in self.pnl if pnl[0] < 0])
+            result_dict['Winning Trades'] = self.winning_count
+            result_dict['Losing Trades'] = self.losing_count
 
             # Total win amount 
-            result_dict['Total Win'] = sum([pnl[0] for pnl in self.pnl if pnl[0] > 0])
+            result_dict['Total Win'] = self.profits
 
             # Total loss amount
-            result_dict['Total Loss'] = sum([pnl[0] for pnl in self.pnl if pnl[0] < 0])
+            result_dict['Total Loss'] = self.losses
 
             # Average win amount
             result_dict['Average Win'] = result_dict['Total Win'] / result_dict['Winning Trades'] if result_dict['Winning Trades'] > 0 else 0
@@ -363,19 +385,19 @@ class TradingMetrics:
             result_dict['Average PnL'] = self.average_pnl[-1][0] / result_dict['Average Position Size'] if result_dict['Average Position Size'] != 0 else 0
 
             # Best win
-            result_dict['Best Win'] = max([pnl[0] for pnl in self.pnl])
+            result_dict['Best Win'] = self.best_win
 
             # Worst loss
-            result_dict['Worst Loss'] = min([pnl[0] for pnl in self.pnl])
+            result_dict['Worst Loss'] = self.worst_loss
 
             # Max money spent
             result_dict['Max. USD in Position'] = self.largest_open_position_size_usd
 
             # Max Consecutive Wins
-            result_dict['Max. Consec. Wins'] = max([len(list(group)) for key, group in groupby(self.pnl, lambda x: x[0] > 0) if key]) if len(list(filter(lambda x: x[0]>0,self.pnl))) != 0 else 0
+            result_dict['Max. Consec. Wins'] = self.max_consec_wins
 
             # Max Consecutive Losses
-            result_dict['Max. Consec. Losses'] = max([len(list(group)) for key, group in groupby(self.pnl, lambda x: x[0] < 0) if key]) if len(list(filter(lambda x: x[0]<0,self.pnl))) != 0 else 0
+            result_dict['Max. Consec. Losses'] = self.max_consec_losses
 
             # Max Unreal. Loss
             result_dict['Max. Unreal. Loss'] = self.maximum_unrealized_loss
@@ -423,13 +445,14 @@ class TradingMetrics:
         return result_dict
     
     def calculate_all(self):
-        peak = 0
-        for pnl_index in tqdm(range(len(self.pnl)),desc="Calculating metrics"):
+        # From the first trade not calculated yet
+        for pnl_index in tqdm(range(len(self.win_rate), len(self.pnl)),desc="Calculating metrics"):
             self.calculate_win_rate(pnl_index)
             self.calculate_profit_factor(pnl_index)
-            peak = self.calculate_drawdown(pnl_index,peak=peak)
+            self.peak = self.calculate_drawdown(pnl_index,peak=self.peak)
             self.calculate_average_pnl(pnl_index)
             self.calculate_risk_reward_ratio(pnl_index)
+            self.calculate_streaks(pnl_index)
         
 
     def calculate_win_rate(self,pnl_index):
@@ -449,6 +472,8 @@ class TradingMetrics:
         except ZeroDivisionError:
             drawdown = 0
         self.drawdown.append((drawdown, pnl[1], pnl[2]))
+        if self.max_drawdown is None or drawdown < self.max_drawdown[0]:
+            self.max_drawdown = self.drawdown[-1]
         return peak
 
     def calculate_profit_factor(self, pnl_index):
@@ -461,17 +486,26 @@ class TradingMetrics:
         self.profit_factor.append((profit_factor, self.pnl[pnl_index][1], self.pnl[pnl_index][2]))
         # Calculate long and short specific metrics
         if self.pnl[pnl_index][0] > 0:
-            self.winning_count_long += 1 if "LONG" in self.pnl[pnl_index][3] else 0
-            self.winning_count_short += 1 if "SHORT" in self.pnl[pnl_index][3] else 0
-            self.profits_long += pnl if "LONG" in self.pnl[pnl_index][3] else 0
-            self.profits_short += pnl if "SHORT" in self.pnl[pnl_index][3] else 0
+            self.winning_count_long += 1 if self.pnl[pnl_index][3] == LONG else 0
+            self.winning_count_short += 1 if self.pnl[pnl_index][3] == SHORT else 0
+            self.profits_long += pnl if self.pnl[pnl_index][3] == LONG else 0
+            self.profits_short += pnl if self.pnl[pnl_index][3] == SHORT else 0
         elif self.pnl[pnl_index][0] < 0:
-            self.losing_count_long += 1 if "LONG" in self.pnl[pnl_index][3] else 0
-            self.losing_count_short += 1 if "SHORT" in self.pnl[pnl_index][3] else 0
-            self.losses_long += pnl if "LONG" in self.pnl[pnl_index][3] else 0
-            self.losses_short += pnl if "SHORT" in self.pnl[pnl_index][3] else 0
+            self.losing_count_long += 1 if self.pnl[pnl_index][3] == LONG else 0
+            self.losing_count_short += 1 if self.pnl[pnl_index][3] == SHORT else 0
+            self.losses_long += pnl if self.pnl[pnl_index][3] == LONG else 0
+            self.losses_short += pnl if self.pnl[pnl_index][3] == SHORT else 0
 
 
+    def calculate_streaks(self, pnl_index):
+        pnl = self.pnl[pnl_index][0]
+        self.best_win = max(self.best_win, pnl)
+        self.worst_loss = min(self.worst_loss, pnl)
+        self.consec_wins = self.consec_wins + 1 if pnl > 0 else 0
+        self.consec_losses = self.consec_losses + 1 if pnl < 0 else 0
+        self.max_consec_wins = max(self.max_consec_wins, self.consec_wins)
+        self.max_consec_losses = max(self.max_consec_losses, self.consec_losses)
+
     def calculate_average_pnl(self, pnl_index):
         total_pnl = self.profits + self.losses
         average_pnl = total_pnl / (pnl_index+1)
@@ -766,6 +800,8 @@ class TradingMetrics:
                 f.write("data,timestamp\n")
                 for item in self.pnl:
                     f.write(f"{item[0]},{item[2]}\n")
+            # Save the closed trades
+            self.order_book.ledger.to_frame().to_csv(os.path.join(save_path, 'trades.csv'), index=False)
             # Save the price_dict
             with open(os.path.join(save_path, 'price.csv'), 'w') as f:
                 f.write("data,timestamp\n")
@@ -775,6 +811,10 @@ class TradingMetrics:
             # Save the result_dict as json
             with open(os.path.join(save_path, 'result.json'), 'w') as f:
                 json.dump(self._core, f)
+            # Save the transport statistics of the backtest next to it
+            if self.order_book.transport_stats is not None:
+                with open(os.path.join(save_path, 'transport.json'), 'w') as f:
+                    json.dump(self.order_book.transport_stats.to_dict(), f)
 
             
             self.logger.info(f"Results successfully saved to csv files under {abs_save_path}")
@@ -1,10 +1,26 @@
 # Order types:
 from matplotlib import pyplot as plt
+from array import array
+import pandas as pd
 import logging
-import copy
+import heapq
 import os,yaml
 
+# Integer codes of the order types, the framed protocol sends the same ones
+NO_ORDER, OPEN_LONG, OPEN_SHORT, CLOSE_LONG, CLOSE_SHORT = range(5)
+ORDER_TYPES = ('NO_ORDER', 'OPEN_LONG', 'OPEN_SHORT', 'CLOSE_LONG', 'CLOSE_SHORT')
+ORDER_CODES = {name: code for code, name in enumerate(ORDER_TYPES)}
+# Sides of the orders and positions by order type code, unknown types (-1) last
+LONG, SHORT = 1, -1
+SIDES = (0, LONG, SHORT, LONG, SHORT, 0)
+
+
 class Order:
+    # order_type stays the name strategies send, code and side are what the
+    # order book and the metrics compare
+    __slots__ = ('message', 'order_id', 'order_type', 'order_time', 'order_price', 'order_size',
+                 'order_SL', 'order_TP', 'order_SL_price', 'order_TP_price', 'code', 'side')
+
     def __init__(self, order_id, order_type, order_time, order_price, order_size, SL=None, TP=None):
         self.message = 'ORDER'
         self.order_id = order_id
@@ -12,21 +28,24 @@ class Order:
         self.order_time = order_time
         self.order_price = order_price
         self.order_size = order_size
-        
         self.order_SL = SL
         self.order_TP = TP
-
-        self.order_SL_price = None
-        self.order_TP_price = None
+        # Unknown types match none of the codes and are ignored
+        self.code = code = ORDER_CODES.get(order_type, -1)
+        self.side = SIDES[code]
 
         # Calculate SL and TP prices
-        if self.order_type == 'OPEN_LONG':
-            self.order_SL_price = self.order_price * (1 - abs(SL)/100) if self.order_SL is not None else None
-            self.order_TP_price = self.order_price * (1 + abs(TP)/100) if self.order_TP is not None else None
+        if code == OPEN_LONG:
+            self.order_SL_price = order_price * (1 - abs(SL)/100) if SL is not None else None
+            self.order_TP_price = order_price * (1 + abs(TP)/100) if TP is not None else None
+
+        elif code == OPEN_SHORT:
+            self.order_SL_price = order_price * (1 + abs(SL)/100) if SL is not None else None
+            self.order_TP_price = order_price * (1 - abs(TP)/100) if TP is not None else None
 
-        elif self.order_type == 'OPEN_SHORT':
-            self.order_SL_price = self.order_price * (1 + abs(SL)/100) if self.order_SL is not None else None
-            self.order_TP_price = self.order_price * (1 - abs(TP)/100) if self.order_TP is not None else None
+        else:
+            self.order_SL_price = None
+            self.order_TP_price = None
 
 
     def __str__(self):
@@ -57,65 +76,82 @@ class Order:
     
     @classmethod
     def from_dict(cls, order_dict):
-        return cls(
-            message = order_dict['message'],
-            order_id=order_dict['order_id'],
-            order_type=order_dict['order_type'],
-            order_time=order_dict['order_time'],
-            order_price=order_dict['order_price'],
-            order_size=order_dict['order_size'],
-            SL=order_dict['order_SL'],
-            TP=order_dict['order_TP']
-        )
+        """Order of the class of its type from the dict of to_dict, NoOrder for NO_ORDER."""
+        code = ORDER_CODES.get(order_dict['order_type'], -1)
+        if order_dict['message'] == 'NO_ORDER' or code == NO_ORDER:
+            return NoOrder(order_dict['order_time'])
+        fields = (order_dict['order_id'], order_dict['order_time'], order_dict['order_price'], order_dict['order_size'],
+                  order_dict.get('order_SL'), order_dict.get('order_TP'))
+        if code < 0:
+            return Order(fields[0], order_dict['order_type'], *fields[1:])
+        return ORDER_CLASSES[code](*fields)
     
     @classmethod
     def isinstance(cls, other):
         return cls.order_id == other.order_id
 
 class OpenLong(Order):
+    __slots__ = ()
+
     def __init__(self, order_id, order_time, order_price, order_size,SL = None, TP = None):
         super().__init__(order_id, 'OPEN_LONG', order_time, order_price, order_size, SL, TP)
 
     @classmethod
     def isinstance(cls, other):
-        return other.order_type == 'OPEN_LONG'
+        return other.code == OPEN_LONG
 
 class OpenShort(Order):
+    __slots__ = ()
+
     def __init__(self, order_id, order_time, order_price, order_size,SL = None, TP = None):
         super().__init__(order_id, 'OPEN_SHORT', order_time, order_price, order_size, SL, TP)
 
     @classmethod
     def isinstance(cls, other):
-        return other.order_type == 'OPEN_SHORT'
+        return other.code == OPEN_SHORT
 
 class CloseLong(Order):
+    __slots__ = ()
+
     def __init__(self, order_id, order_time, order_price, order_size,SL = None, TP = None):
         super().__init__(order_id, 'CLOSE_LONG', order_time, order_price, order_size, SL, TP)
 
     @classmethod
     def isinstance(cls, other):
-        return other.order_type == 'CLOSE_LONG'
+        return other.code == CLOSE_LONG
 
 class CloseShort(Order):
+    __slots__ = ()
+
     def __init__(self, order_id, order_time, order_price, order_size,SL = None, TP = None):
         super().__init__(order_id, 'CLOSE_SHORT', order_time, order_price, order_size, SL, TP)
 
     @classmethod
     def isinstance(cls, other):
-        return other.order_type == 'CLOSE_SHORT'
+        return other.code == CLOSE_SHORT
 
 class NoOrder(Order):
+    __slots__ = ()
+
     def __init__(self,time):
         super().__init__(None, 'NO_ORDER', time, None, None, None, None)
         self.message = 'NO_ORDER'
 
 
+# Class of every order type code
+ORDER_CLASSES = (NoOrder, OpenLong, OpenShort, CloseLong, CloseShort)
+
+
 class Position:
+    __slots__ = ('margin', 'message')
+
     def __init__(self, margin) -> None:
         self.margin = margin 
 
 
 class Long(Position):
+    __slots__ = ()
+
     def __init__(self, margin) -> None:
         super().__init__(margin)
         self.message = 'LONG'
@@ -134,16 +170,15 @@ class Long(Position):
     
     @classmethod
     def from_dict(cls, position_dict):
-        return cls(
-            message = position_dict['message'],
-            margin=position_dict['margin']
-        )
+        return cls(margin=position_dict['margin'])
     
     @classmethod
     def isinstance(cls, other):
         return other.message == 'LONG'
     
 class Short(Position):
+    __slots__ = ()
+
     def __init__(self, margin) -> None:
         super().__init__(margin)
         self.message = 'SHORT'
@@ -162,29 +197,219 @@ class Short(Position):
     
     @classmethod
     def from_dict(cls, position_dict):
-        return cls(
-            message = position_dict['message'],
-            margin=position_dict['margin']
-        )
+        return cls(margin=position_dict['margin'])
     
     @classmethod
     def isinstance(cls, other):
         return other.message == 'SHORT'
 
 
+class Wallet():
+    """Balance of an account, shared by the order books of a portfolio."""
+    def __init__(self, balance) -> None:
+        self.balance = balance
+        self.initial_balance = balance
+
+
+class NetPosition:
+    """Open orders of one side added up, kept up to date on every fill.
+
+    Args:
+        side (int): LONG or SHORT
+    """
+    __slots__ = ('side', 'size', 'cost', 'count')
+
+    def __init__(self, side: int) -> None:
+        self.side = side
+        self.size = 0.0
+        # Sum of entry price times size, the USD put in the positions
+        self.cost = 0.0
+        self.count = 0
+
+    def add(self, price: float, size: float):
+        self.size += size
+        self.cost += price * size
+        self.count += 1
+
+    def remove(self, price: float, size: float):
+        self.count -= 1
+        if self.count == 0:
+            # No rounding left over once flat
+            self.size = self.cost = 0.0
+        else:
+            self.size -= size
+            self.cost -= price * size
+
+    @property
+    def entry(self):
+        """Volume weighted average entry price, None when flat."""
+        return self.cost / self.size if self.count else None
+
+    def notional(self, price: float) -> float:
+        return price * self.size
+
+    def unrealized(self, price: float) -> float:
+        return self.side * (price * self.size - self.cost)
+
+
+class EventStore:
+    """Order history of an OrderBook, one column per field of the filled orders.
+
+    Bars without an order leave no entry. Entries read back as orders, SL and
+    TP of None are kept as NaN. Order ids and times are kept as given.
+    """
+
+    def __init__(self):
+        self.time = []
+        self.type = bytearray()
+        self.id = []
+        self.price = array('d')
+        self.size = array('d')
+        self.SL = array('d')
+        self.TP = array('d')
+
+    def __len__(self):
+        return len(self.type)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            part = EventStore()
+            for name, column in vars(self).items():
+                setattr(part, name, column[index])
+            return part
+        if index < 0:
+            index += len(self)
+        SL, TP = self.SL[index], self.TP[index]
+        return ORDER_CLASSES[self.type[index]](self.id[index], self.time[index], self.price[index], self.size[index],
+                                               None if SL != SL else SL, None if TP != TP else TP)
+
+    def __iter__(self):
+        return (self[index] for index in range(len(self)))
+
+    def append(self, order: Order):
+        if order.code <= NO_ORDER:
+            return
+        self.time.append(order.order_time)
+        self.type.append(order.code)
+        self.id.append(order.order_id)
+        self.price.append(order.order_price)
+        self.size.append(order.order_size)
+        self.SL.append(float('nan') if order.order_SL is None else order.order_SL)
+        self.TP.append(float('nan') if order.order_TP is None else order.order_TP)
+
+    def extend(self, orders):
+        """Append another EventStore, or orders."""
+        if isinstance(orders, EventStore):
+            for name, column in vars(self).items():
+                column.extend(getattr(orders, name))
+            return
+        for order in orders:
+            self.append(order)
+
+
+class Ledger:
+    """Closed trades of an OrderBook, one row per position in the order it was closed.
+
+    pnl is the profit the balance is credited with, fee the fees of opening
+    and closing the position. side is 1 for longs and -1 for shorts.
+    """
+    REASONS = ('CLOSE', 'SL', 'TP', 'END', 'LIQ')
+
+    def __init__(self):
+        self.id = []
+        self.open_time = []
+        self.close_time = []
+        self.open_price = array('d')
+        self.close_price = array('d')
+        self.open_size = array('d')
+        self.close_size = array('d')
+        self.side = array('b')
+        self.pnl = array('d')
+        self.fee = array('d')
+        self.reason = bytearray()
+
+    def __len__(self):
+        return len(self.reason)
+
+    def __getitem__(self, index: slice):
+        part = Ledger()
+        for name, column in vars(self).items():
+            setattr(part, name, column[index])
+        return part
+
+    def append(self, open_order: Order, close_order: Order, pnl: float, fee: float, reason: str):
+        self.id.append(open_order.order_id)
+        self.open_time.append(open_order.order_time)
+        self.close_time.append(close_order.order_time)
+        self.open_price.append(open_order.order_price)
+        self.close_price.append(close_order.order_price)
+        self.open_size.append(open_order.order_size)
+        self.close_size.append(close_order.order_size)
+        self.side.append(open_order.side)
+        self.pnl.append(pnl)
+        self.fee.append(fee)
+        self.reason.append(self.REASONS.index(reason))
+
+    def extend(self, other: 'Ledger'):
+        for name, column in vars(self).items():
+            column.extend(getattr(other, name))
+
+    def to_frame(self):
+        """The trades as a DataFrame, exit reasons by name."""
+        frame = pd.DataFrame({name: list(column) for name, column in vars(self).items()})
+        frame['reason'] = [self.REASONS[reason] for reason in self.reason]
+        return frame
+
+
 class OrderBook():
-    def __init__(self, pair : str = None) -> None:
+    # Heap keys are the SL/TP and liquidation levels times these signs, the
+    # smallest key is the level the price reaches first
+    KEY_SIGNS = {'long_SL': -1, 'long_TP': 1, 'short_SL': 1, 'short_TP': -1, 'long_liq': -1, 'short_liq': 1}
+
+    def __init__(self, pair : str = None, wallet : Wallet = None) -> None:
         # Logger
         self.logger = logging.getLogger('OrderBook')
         self.logger.setLevel(logging.DEBUG)
-        # Orders
-        self.order_history = list()
+        # Orders, the history has no entry for bars without an order
+        self.order_history = EventStore()
+        self.ledger = Ledger()
         self.open_orders = dict()
+        # Fee paid to open every open order, the ledger books it at the close
+        self.open_fees = dict()
+        # Open orders added up by side
+        self.positions = {LONG: NetPosition(LONG), SHORT: NetPosition(SHORT)}
+        # Most USD put in the open orders at once, their size at that moment
+        # and the lowest unrealized pnl of the open orders, marked after
+        # every fill and at the close of every bar
+        self.max_position_cost = 0.0
+        self.max_position_size = 0.0
+        self.max_unrealized_loss = 0.0
+        # Price fills are marked at, the close of the current bar or the
+        # price of the last close on it
+        self.mark_price = None
+        # Running state of the metrics up to the final state of the backtest
+        # it extends, see TradingMetrics.settle
+        self.metrics_state = None
+        # Open orders by SL/TP and liquidation level, in heaps of (key,
+        # sequence, order) with the level hit first on top: long SL, short TP
+        # and long liquidation the highest, long TP, short SL and short
+        # liquidation the lowest. Closed orders are dropped once they are on
+        # top or when a heap is compacted.
+        self.triggers = {name: [] for name in self.KEY_SIGNS}
+        # Margin posted, amount borrowed and liquidation price (None if
+        # never reached) of every open order
+        self.margins = dict()
+        self.liquidated_order_count = 0
+        self.filled = 0
         self.sl_tp_triggered_orders = set()
         self.sl_triggered_order_count = 0
         self.sl_triggered_order_count_long = 0
         self.sl_triggered_order_count_short = 0
         self.margin_failed_orders = set()
+        # Least balance a margin check left and most it fell short by, a
+        # balance shifted by less would not have changed any of them
+        self.min_margin_left = float('inf')
+        self.max_margin_short = float('-inf')
         # Orderbook 
         self.pair = pair
         self.price = None
@@ -193,9 +418,17 @@ class OrderBook():
         self.fee_percent = 0.0 
         self.paid_fee = 0.0
         self.stop_loss = None
+        # Leverage of futures positions, spot markets trade without
+        self.leverage = 1
+        self.maintenance_margin = 0.0
+        self.futures = False
+        # TransportStats of the session that produced this order book
+        self.transport_stats = None
 
         self.win = 0
         self.loss = 0
+        # What the fills of this order book added to the balance of its wallet
+        self.balance_change = 0.0
 
         # Margin
         # Read from config.yaml
@@ -203,38 +436,121 @@ class OrderBook():
         try:
             with open(os.path.join(os.path.dirname(os.path.dirname(__file__)), 'config.yaml')) as f:
                 config = yaml.load(f, Loader=yaml.FullLoader)
-                self.balance = config['balance']
+                # Order books of a portfolio trade against one balance
+                self.shared_wallet = wallet is not None
+                self.wallet = wallet if wallet is not None else Wallet(config['balance'])
                 self.check_fee = config['check_fee']
                 if self.check_fee:
                     self.fee_percent = config['fee_percent']
                     self.fee_included = config['include_fee']
                 self.check_margin = config['margin_check']
+                self.futures = config['market_type'].lower() == 'futures'
+                if self.futures:
+                    self.leverage = config.get('leverage', 1)
+                    self.maintenance_margin = config.get('maintenance_margin', 0.0)
         except Exception as e:
             self.logger.error(f'Error reading config.yaml: {e}')
             exit()
         # Data to be saved
         self.df = None
 
+    @property
+    def balance(self):
+        return self.wallet.balance
+
+    @balance.setter
+    def balance(self, balance):
+        self.balance_change += balance - self.wallet.balance
+        self.wallet.balance = balance
+
+    @property
+    def own_balance(self):
+        """Balance of the order book had it traded on a wallet of its own."""
+        if not self.shared_wallet:
+            return self.balance
+        return self.wallet.initial_balance + self.balance_change
+
     def get_open_orders(self):
         return [x.order_id for x in self.open_orders.values()]
 
+    def unrealized_pnl(self, price: float) -> float:
+        """Unrealized pnl of all open orders at price."""
+        return self.positions[LONG].unrealized(price) + self.positions[SHORT].unrealized(price)
+
+    def position_cost(self) -> float:
+        """USD put in all open orders at their entry prices."""
+        return self.positions[LONG].cost + self.positions[SHORT].cost
+
+    def mark(self, price: float):
+        """Keep the lowest unrealized pnl of the open orders, valued at price."""
+        pnl = self.unrealized_pnl(price)
+        if pnl < self.max_unrealized_loss:
+            self.max_unrealized_loss = pnl
+
+    def mark_bars(self, closes):
+        """Mark the open orders, unchanged over bars with these closes.
+
+        The unrealized pnl is linear in the price, the lowest and highest
+        close are the only ones that can set a new low.
+        """
+        if len(closes) and (self.positions[LONG].count or self.positions[SHORT].count):
+            self.mark(closes.min().item())
+            self.mark(closes.max().item())
+
+    def get_state(self) -> dict:
+        """Everything but the order history, which checkpoints save incrementally."""
+        return {key: value for key, value in vars(self).items()
+                if key not in ('logger', 'order_history', 'df', 'transport_stats')}
+
+    def set_state(self, state: dict):
+        vars(self).update(state)
+
     def set_stop_loss(self, stop_loss):
         if stop_loss is not None:
             self.stop_loss = stop_loss
 
+    def set_leverage(self, leverage):
+        """Leverage of the orders opened from now on, ignored for spot markets and if None."""
+        if leverage is None or not self.futures:
+            return
+        if leverage < 1:
+            raise ValueError(f'Leverage must be at least 1, got {leverage}')
+        self.leverage = leverage
+
+    def liquidation_price(self, order: Order, size: float, margin: float):
+        """
+        Price at which the margin of an order is down to the maintenance margin.
+
+        Args:
+            order (Order): open order
+            size (float): size the margin was posted for
+            margin (float): margin posted
+
+        Returns:
+            float: liquidation price, None if it is never reached. Orders
+            without leverage are fully paid for and never liquidated.
+        """
+        if not self.futures or self.leverage <= 1:
+            return None
+        cost = order.order_price * size
+        if order.code == OPEN_LONG:
+            price = (cost - margin) / (size * (1 - self.maintenance_margin))
+        else:
+            price = (cost + margin) / (size * (1 + self.maintenance_margin))
+        return price if price > 0 else None
+
     def close_orderbook(self, close_price, time, df):
         # Close all open orders
         self.logger.info("Closing orderbook")
-        open_orders_copy = copy.deepcopy(self.open_orders)
-        for id, order in open_orders_copy.items():
-            if order.order_type == 'OPEN_LONG':
+        for id, order in list(self.open_orders.items()):
+            if order.code == OPEN_LONG:
                 close_order = CloseLong(id,time, close_price, order.order_size)
-                close_order = self.fill_close_order(close_order)
+                close_order = self.fill_close_order(close_order, 'END')
                 self.order_history.append(close_order)
                 self.logger.debug(f'{close_order}')
-            elif order.order_type == 'OPEN_SHORT':
+            elif order.code == OPEN_SHORT:
                 close_order = CloseShort(id,time, close_price, order.order_size)
-                close_order = self.fill_close_order(close_order)
+                close_order = self.fill_close_order(close_order, 'END')
                 self.order_history.append(close_order)
                 self.logger.debug(f'{close_order}')
         self.logger.info(f"Win: {self.win} | Loss: {self.loss if self.loss != 0 else 1e-10} | Profit Factor: {self.win/abs(self.loss) if self.loss != 0 else self.win}")
@@ -242,25 +558,41 @@ class OrderBook():
 
     def update_price(self, ohlcv, time):
         # data = {'open', 'high', 'low', 'close', 'volume'}
+        # The open orders held over the previous bar, at its close
+        if self.price is not None and (self.positions[LONG].count or self.positions[SHORT].count):
+            self.mark(self.price)
+        self.price = self.mark_price = ohlcv['close']
         self.handle_SL_TP(ohlcv, time)
-        self.handle_margin_call(ohlcv["close"])
 
     def handle_SL_TP(self, ohlcv, time) -> None:
         """
-        Handle stop loss and take profit orders
+        Handle stop loss, take profit and liquidation of open orders
 
         Args:
             price (_type_): Updated price every tick by backtester and simulator.
         """
         open_price, high_price, low_price, close_price = ohlcv['open'], ohlcv['high'], ohlcv['low'], ohlcv['close']
 
-        # Iterate open orders to check if SL/TP
-        open_orders_copy = copy.deepcopy(self.open_orders)
-        for id, order in open_orders_copy.items():
-            if order.order_type == 'OPEN_LONG':
-                if order.order_SL_price is not None and low_price <= order.order_SL_price:
+        # Only the orders with a level crossed by the bar are taken off the
+        # heaps, they are closed in the order they were opened
+        hit = {}
+        self.pop_triggers('long_SL', -low_price, hit)
+        self.pop_triggers('long_TP', high_price, hit)
+        self.pop_triggers('short_SL', high_price, hit)
+        self.pop_triggers('short_TP', -low_price, hit)
+        self.pop_triggers('long_liq', -low_price, hit)
+        self.pop_triggers('short_liq', high_price, hit)
+        for _, order in sorted(hit.items()):
+            id = order.order_id
+            liquidation = self.margins[id][2]
+            if order.code == OPEN_LONG:
+                # The price falls through the higher of SL and liquidation first
+                if liquidation is not None and low_price <= liquidation and \
+                        (order.order_SL_price is None or liquidation > order.order_SL_price):
+                    self.handle_margin_call(order, time)
+                elif order.order_SL_price is not None and low_price <= order.order_SL_price:
                     close_order = CloseLong(id, time, order.order_SL_price, order.order_size)
-                    close_order = self.fill_close_order(close_order)
+                    close_order = self.fill_close_order(close_order, 'SL')
                     self.order_history.append(close_order)
                     self.sl_tp_triggered_orders.add(id)
                     self.sl_triggered_order_count += 1
@@ -268,15 +600,19 @@ class OrderBook():
                     self.logger.debug(f'SL:{close_order}')
                 elif order.order_TP_price is not None and high_price >= order.order_TP_price:
                     close_order = CloseLong(id, time, order.order_TP_price, order.order_size)
-                    close_order = self.fill_close_order(close_order)
+                    close_order = self.fill_close_order(close_order, 'TP')
                     self.order_history.append(close_order)
                     self.sl_tp_triggered_orders.add(id)
                     
                     self.logger.debug(f'TP:{close_order}')
-            elif order.order_type == 'OPEN_SHORT':
-                if order.order_SL_price is not None and high_price >= order.order_SL_price:
+            elif order.code == OPEN_SHORT:
+                # The price rises through the lower of SL and liquidation first
+                if liquidation is not None and high_price >= liquidation and \
+                        (order.order_SL_price is None or liquidation < order.order_SL_price):
+                    self.handle_margin_call(order, time)
+                elif order.order_SL_price is not None and high_price >= order.order_SL_price:
                     close_order = CloseShort(id,time, order.order_SL_price, order.order_size)
-                    close_order = self.fill_close_order(close_order)
+                    close_order = self.fill_close_order(close_order, 'SL')
                     self.order_history.append(close_order)
                     self.sl_tp_triggered_orders.add(id)
                     self.sl_triggered_order_count += 1
@@ -284,13 +620,48 @@ class OrderBook():
                     self.logger.debug(f'SL:{close_order}')
                 elif order.order_TP_price is not None and low_price <= order.order_TP_price:
                     close_order = CloseShort(id,time, order.order_TP_price, order.order_size)
-                    close_order = self.fill_close_order(close_order)
+                    close_order = self.fill_close_order(close_order, 'TP')
                     self.order_history.append(close_order)
                     self.sl_tp_triggered_orders.add(id)
                     
                     self.logger.debug(f'TP:{close_order}')
 
 
+    def push_triggers(self, order: Order):
+        self.filled += 1
+        liquidation = self.margins[order.order_id][2]
+        if order.code == OPEN_LONG:
+            levels = (('long_SL', order.order_SL_price), ('long_TP', order.order_TP_price), ('long_liq', liquidation))
+        else:
+            levels = (('short_SL', order.order_SL_price), ('short_TP', order.order_TP_price), ('short_liq', liquidation))
+        for name, price in levels:
+            # A NaN level is never hit and would break the heap order
+            if price is None or price != price:
+                continue
+            heap = self.triggers[name]
+            if len(heap) > 2 * len(self.open_orders) + 64:
+                # Mostly orders closed by the strategy, keep the open ones
+                heap[:] = [entry for entry in heap if self.open_orders.get(entry[2].order_id) is entry[2]]
+                heapq.heapify(heap)
+            heapq.heappush(heap, (self.KEY_SIGNS[name] * price, self.filled, order))
+
+    def pop_triggers(self, name: str, bound: float, hit: dict):
+        # Take the open orders with a key up to bound off a heap into hit, by sequence
+        heap = self.triggers[name]
+        while heap and heap[0][0] <= bound:
+            _, sequence, order = heapq.heappop(heap)
+            if self.open_orders.get(order.order_id) is order:
+                hit[sequence] = order
+
+    def next_levels(self) -> dict:
+        """Level of the open order hit first for every heap, None if there is none."""
+        levels = {}
+        for name, heap in self.triggers.items():
+            while heap and self.open_orders.get(heap[0][2].order_id) is not heap[0][2]:
+                heapq.heappop(heap)
+            levels[name] = self.KEY_SIGNS[name] * heap[0][0] if heap else None
+        return levels
+
     def margin_check(self,price,order_size, order_id) -> bool:
         """
         Check if there is enough margin to open order.
@@ -301,22 +672,34 @@ class OrderBook():
         if not self.check_margin:
             return True
         
-        if self.balance < price * order_size * (1 + self.fee_percent):
-            self.logger.debug(f'Insufficient margin to open order. Balance: {self.balance} | Order: {price * order_size * (1 + self.fee_percent)}')
+        # The margin of the order and the fee on its whole size
+        left = self.balance - price * order_size * (1 / self.leverage + self.fee_percent)
+        if left < 0:
+            self.logger.debug(f'Insufficient margin to open order. Balance: {self.balance} | Order: {price * order_size * (1 / self.leverage + self.fee_percent)}')
             self.margin_failed_orders.add(order_id)
+            self.max_margin_short = max(self.max_margin_short, left)
             return False
+        self.min_margin_left = min(self.min_margin_left, left)
         return True
 
-    def handle_margin_call(self, price) -> None:
+    def handle_margin_call(self, order: Order, time) -> None:
         """
-        Handle margin call. Close all open orders if margin call is triggered.
-
+        Liquidate an open order whose liquidation price the bar reached, it
+        is closed at its liquidation price.
 
         Args:
-            price (_type_): Updated price every tick by backtester and simulator.
+            order (Order): open order
+            time (str): time of the bar
         """
-        # No leverage applied, no needed for now.
-        pass
+        id = order.order_id
+        Close = CloseLong if order.code == OPEN_LONG else CloseShort
+        close_order = Close(id, time, self.margins[id][2], order.order_size)
+        close_order = self.fill_close_order(close_order, 'LIQ')
+        self.order_history.append(close_order)
+        # A close sent by the strategy later on is skipped
+        self.sl_tp_triggered_orders.add(id)
+        self.liquidated_order_count += 1
+        self.logger.debug(f'LIQ:{close_order}')
 
 
     def fill_open_order(self, order: Order):
@@ -324,28 +707,47 @@ class OrderBook():
         fee_taken_order_size = order.order_size * (1 - self.fee_percent)
         order.order_size = fee_taken_order_size if self.fee_included else actual_order_size
         self.open_orders[order.order_id] = order
+        self.positions[order.side].add(order.order_price, order.order_size)
+        cost = self.position_cost()
+        if cost > self.max_position_cost:
+            self.max_position_cost = cost
+            self.max_position_size = cost / order.order_price
+        self.mark(self.mark_price if self.mark_price is not None else order.order_price)
+        # Only the margin leaves the balance, the rest is borrowed
+        notional = order.order_price * actual_order_size
+        margin = notional / self.leverage
+        self.margins[order.order_id] = (margin, notional - margin, self.liquidation_price(order, actual_order_size, margin))
+        self.push_triggers(order)
         open_order_fee = order.order_price * actual_order_size * self.fee_percent
+        self.open_fees[order.order_id] = open_order_fee
         self.paid_fee += open_order_fee
-        self.balance -= order.order_price * actual_order_size 
+        self.balance -= margin
         return order
 
 
-    def fill_close_order(self, order: Order):
-        actual_order_size = self.open_orders[order.order_id].order_size
-        fee_taken_order_size = self.open_orders[order.order_id].order_size * (1 - self.fee_percent)
+    def fill_close_order(self, order: Order, reason: str = 'CLOSE'):
+        open_order = self.open_orders[order.order_id]
+        actual_order_size = open_order.order_size
+        fee_taken_order_size = open_order.order_size * (1 - self.fee_percent)
         order.order_size = fee_taken_order_size if self.fee_included else actual_order_size
         close_order_fee = order.order_price * actual_order_size * self.fee_percent   
         self.paid_fee += close_order_fee
-        self.balance += self.open_orders[order.order_id].order_price  * fee_taken_order_size 
-        profit = self.calculate_profit(self.open_orders[order.order_id], order)
+        self.balance += open_order.order_price  * fee_taken_order_size 
+        self.positions[open_order.side].remove(open_order.order_price, open_order.order_size)
+        self.mark_price = order.order_price
+        self.mark(self.mark_price)
+        profit = self.calculate_profit(open_order, order)
         self.balance += profit
+        # Pay back what was borrowed to open it
+        self.balance -= self.margins.pop(order.order_id)[1]
+        self.ledger.append(open_order, order, profit, self.open_fees.pop(order.order_id, 0.0) + close_order_fee, reason)
         return order
 
     def add_order(self, order: Order):
         try:
-            # if no order add
-            if order.order_type == 'NO_ORDER':
-                self.order_history.append(order)
+            # Bars without an order leave the history as it is
+            if order.code == NO_ORDER:
+                return
             elif OpenLong.isinstance(order) or OpenShort.isinstance(order):
                 if order.order_id in self.open_orders.keys():
                     self.logger.error(f'Order already exists in orderbook. {order}')
@@ -356,18 +758,15 @@ class OrderBook():
                     self.logger.debug(f'{order}')
                 else:
                     self.logger.warning(f'Insufficient margin to open order. {order}')
-                    self.order_history.append(NoOrder(order.order_time))
             elif CloseLong.isinstance(order) or CloseShort.isinstance(order):
                 # It might be possible that the order is already closed by SL/TP
                 if order.order_id in self.sl_tp_triggered_orders:
                     self.logger.debug(f'Order unable to close due to SL/TP. {order}')
                     self.sl_tp_triggered_orders.remove(order.order_id)
-                    self.order_history.append(NoOrder(order.order_time))
                 # It might be unopend order due to margin call
                 elif order.order_id in self.margin_failed_orders:
                     self.logger.debug(f'Order unable to close due to failed opening as of margin call. {order}')
                     self.margin_failed_orders.remove(order.order_id)
-                    self.order_history.append(NoOrder(order.order_time))
                 elif order.order_id not in self.open_orders.keys():
                     self.logger.error(f'Order does not exist in orderbook. Moving on... (PLEASE CHECK YOUR CODE FOR POSSIBLE ERRORS){order}')
                 else:
@@ -378,19 +777,19 @@ class OrderBook():
             self.logger.error(f'KeyError: {e}')
             self.logger.error(f'Dumping order book.')
             for key,value in self.open_orders.items():
-                if value.order_type != 'NO_ORDER':
+                if value.code != NO_ORDER:
                     self.logger.error(f'[{key}]{value}')
             exit()
         except Exception as e:
             self.logger.error(f'Exception: {e}')
             self.logger.error(f'Dumping order book.')
             for key,value in self.open_orders.items():
-                if value.order_type != 'NO_ORDER':
+                if value.code != NO_ORDER:
                     self.logger.error(f'[{key}]{value}')
             exit()
             
     def calculate_profit(self, open_order: Order, close_order: Order):
-        if open_order.order_type == 'OPEN_LONG' and close_order.order_type == 'CLOSE_LONG':
+        if open_order.code == OPEN_LONG and close_order.code == CLOSE_LONG:
             profit = (close_order.order_price - open_order.order_price) * open_order.order_size
             if profit > 0:
                 # 0.35 - 0.2 * 2 = -0.05 
@@ -399,7 +798,7 @@ class OrderBook():
                 self.loss += profit 
             self.open_orders.pop(open_order.order_id)
             return profit
-        elif open_order.order_type == 'OPEN_SHORT' and close_order.order_type == 'CLOSE_SHORT':
+        elif open_order.code == OPEN_SHORT and close_order.code == CLOSE_SHORT:
             profit = (open_order.order_price - close_order.order_price)*open_order.order_size
             if profit > 0:
                 self.win += profit 
@@ -0,0 +1,277 @@
+from _backtester import Backtester
+from _orders import OrderBook, EventStore, Ledger
+from concurrent.futures import ProcessPoolExecutor
+from bisect import bisect_left
+import multiprocessing
+import numpy as np
+import logging
+import math
+import os
+
+# Backtests split in time. A long backtest of a strategy that declares a
+# warmup (BaseStrategy.warmup) runs as one chunk of the bars per process:
+#
+#   chunk k   |-- warmup --|====== bars of chunk k ======|-- overlap --|
+#
+# Every chunk starts flat warmup bars before its own bars, so the strategy
+# has seen the history its decisions depend on, and runs on into the next
+# chunk. A chunk takes over from the one before it at the first bar where
+# neither holds an order: from there on both make the same decisions. The
+# order histories and the counters of the order books are stitched at those
+# bars. Where two chunks never meet flat, the earlier one runs on to the end
+# of the data, so the result is the serial one whenever the strategy keeps
+# to its warmup.
+#
+# Order ids start over in every chunk. The balance of a chunk is not the one
+# of the serial run, strategies sizing orders by it or stopped by the margin
+# check must not declare a warmup. parallel_verify in config.yaml checks a
+# sample against a serial run first.
+
+# Backtesters with their data loaded in this process, forked workers
+# inherit them instead of reading the data again
+_loaded = {}
+
+
+def _load(quad):
+    if quad not in _loaded:
+        interval, start_date, final_date, pair = quad
+        backtester = Backtester(interval=interval, start_date=start_date, final_date=final_date, pair=pair, bind=False)
+        backtester.load_data()
+        _loaded[quad] = backtester
+    return _loaded[quad]
+
+
+class Slice:
+    """Order history of one chunk and the state of its order book before every bar it can take over at.
+
+    Args:
+        start (int): first bar run, the order book is flat before it
+        record (int): first bar the chunk can take over at
+        stop (int): bar the run stops before
+    """
+    COUNTERS = ('balance', 'paid_fee', 'win', 'loss', 'sl_triggered_order_count',
+                'sl_triggered_order_count_long', 'sl_triggered_order_count_short', 'liquidated_order_count')
+    EXTREMES = ('max_position_cost', 'max_position_size', 'max_unrealized_loss')
+    MARGINS = ('min_margin_left', 'max_margin_short')
+
+    def __init__(self, start: int, record: int, stop: int):
+        self.start = start
+        self.record = record
+        self.stop = stop
+        # One entry per bar from record to stop, the counters, the
+        # extremes and margin checks since the previous flat bar and the
+        # history and ledger lengths are only kept for flat bars and stop
+        self.flat = np.zeros(stop - record + 1, dtype=bool)
+        self.lengths = np.zeros(stop - record + 1, dtype=np.int64)
+        self.trades = np.zeros(stop - record + 1, dtype=np.int64)
+        self.counters = np.zeros((stop - record + 1, len(self.COUNTERS)))
+        self.extremes = np.zeros((stop - record + 1, len(self.EXTREMES)))
+        self.margins = np.tile([np.inf, -np.inf], (stop - record + 1, 1))
+        self.history = None
+        self.book = None
+
+    def save(self, tick: int, order_book: OrderBook, flat: bool):
+        index = tick - self.record
+        self.flat[index] = flat
+        if flat or tick == self.stop:
+            self.lengths[index] = len(order_book.order_history)
+            self.trades[index] = len(order_book.ledger)
+            self.counters[index] = [getattr(order_book, name) for name in self.COUNTERS]
+            self.extremes[index] = [getattr(order_book, name) for name in self.EXTREMES]
+            self.margins[index] = [getattr(order_book, name) for name in self.MARGINS]
+            # Nothing is held at a flat bar, the extremes start over from it
+            if flat:
+                for name in self.EXTREMES:
+                    setattr(order_book, name, 0.0)
+                order_book.min_margin_left, order_book.max_margin_short = np.inf, -np.inf
+
+
+def run_slice(quad: tuple, strategy: any, model_kwargs: dict, start: int, record: int, stop: int, last: int) -> Slice:
+    """Run a strategy over the bars in [start, stop), closing the order book if stop is the last bar."""
+    backtester = _load(quad)
+    backtester.OrderBook = order_book = OrderBook(pair=quad[3])
+    backtester.bar_builders, backtester.built = [], 0
+    result = Slice(start, record, stop)
+    st = strategy(**model_kwargs)
+    st.attach(backtester)
+    st.on_connect()
+    if backtester.bar_builders and start:
+        # The higher timeframe bars at start only need the current and the
+        # previous period of the longest timeframe
+        seconds = max(builder.seconds for builder in backtester.bar_builders)
+        time = int(backtester.feed.times[start])
+        backtester.built = bisect_left(backtester.feed.times, str(time - time % seconds - seconds))
+    awake = start
+    for tick in range(start, stop):
+        if tick >= record:
+            result.save(tick, order_book, tick >= awake and not order_book.open_orders)
+        if tick < awake:
+            continue
+        bar = backtester.bar(tick)
+        order_book.update_price(bar['data'], bar['time'])
+        bar['open_orders'] = len(order_book.get_open_orders())
+        st.dispatch(bar)
+        if backtester.wake is not None:
+            backtester.tick = tick + 1
+            backtester.skip_ahead(stop)
+            awake = backtester.tick
+    if stop == last:
+        feed = backtester.feed
+        order_book.close_orderbook(feed.column('close')[last - 1], feed.times[last - 1], None)
+    result.save(stop, order_book, False)
+    st.stats.stop()
+    st.on_disconnect()
+    result.history = order_book.order_history
+    result.book = order_book.get_state()
+    return result
+
+
+class TimeSlices:
+    """Backtest of one strategy split in time over several processes.
+
+    Args:
+        quad (tuple): interval, start date, final date and pair
+        processes (int): chunks run at once, one per CPU if 0
+    """
+    def __init__(self, quad, processes=0):
+        self.logger = logging.getLogger('TimeSlices')
+        self.quad = quad
+        self.processes = processes or os.cpu_count()
+        self.backtester = _load(quad)
+
+    def run(self, strategy, model_kwargs, verify=0):
+        """Backtest a strategy in chunks of the data.
+
+        Args:
+            strategy (any): strategy class with a warmup
+            model_kwargs (dict): keyword arguments of the strategy
+            verify (int): bars checked against a serial run first, 0 for none
+
+        Returns:
+            OrderBook: order book of the whole backtest
+        """
+        if strategy.warmup is None:
+            raise ValueError(f"{strategy.__name__} declares no warmup, it can not be split in time")
+        last = len(self.backtester.feed)
+        # Forked workers start with the data loaded
+        context = multiprocessing.get_context('fork') if 'fork' in multiprocessing.get_all_start_methods() else None
+        try:
+            with ProcessPoolExecutor(max_workers=self.processes, mp_context=context) as pool:
+                if verify:
+                    self.verify(pool, strategy, model_kwargs, min(verify, last))
+                order_book = self.run_to(pool, strategy, model_kwargs, last)
+        finally:
+            _loaded.pop(self.quad, None)
+        df = self.backtester.df if self.backtester.df is not None else self.backtester.feed.summary
+        order_book.df = df
+        self.logger.info(f"Win: {order_book.win} | Loss: {order_book.loss} | Balance: {order_book.balance}")
+        return order_book
+
+    def run_to(self, pool, strategy, model_kwargs, last):
+        """Order book of the strategy over the bars before last, run in chunks."""
+        warmup = strategy.warmup
+        size = math.ceil(last / self.processes)
+        overlap = max(warmup, size // 10)
+        futures = [pool.submit(run_slice, self.quad, strategy, model_kwargs, max(begin - warmup, 0), begin,
+                               min(begin + size + overlap, last), last)
+                   for begin in range(0, last, size)]
+        slices = [future.result() for future in futures]
+        segments, unfinished = self.segments(slices, last)
+        while unfinished is not None:
+            run = slices[unfinished]
+            self.logger.info(f"Chunk {unfinished} never meets the next one flat, running it on to the end")
+            slices[unfinished] = pool.submit(run_slice, self.quad, strategy, model_kwargs,
+                                             run.start, run.record, last, last).result()
+            segments, unfinished = self.segments(slices, last)
+        if not self.margins_hold(segments):
+            # Every chunk starts with the whole wallet
+            self.logger.warning(f"A margin check of a chunk depends on the balance it started with, "
+                                f"running {strategy.__name__} over the bars before {last} in one process")
+            return self.stitch([(pool.submit(run_slice, self.quad, strategy, model_kwargs, 0, 0, last, last).result(), 0, last)])
+        self.logger.info(f"{len(slices)} chunks stitched at bars {[begin for _, begin, _ in segments[1:]]}")
+        return self.stitch(segments)
+
+    @staticmethod
+    def margins_hold(segments):
+        """Whether the margin checks of every part come out the same with the
+        balance of the stitched run at its first bar."""
+        balance = segments[0][0].counters[0][0]
+        for run, begin, stop in segments:
+            begin, stop = begin - run.record, stop - run.record
+            # Balance of the stitched run less that of the chunk
+            shift = balance - run.counters[begin][0]
+            margins = run.margins[begin + 1:stop + 1]
+            if len(margins) and (margins[:, 0].min() + shift < 0 or margins[:, 1].max() + shift >= 0):
+                return False
+            balance += run.counters[stop][0] - run.counters[begin][0]
+        return True
+
+    @staticmethod
+    def switch(run, following, begin):
+        """First bar after begin where both slices are flat, None if there is none."""
+        low, high = max(following.record, begin + 1), min(run.stop, following.stop)
+        if low >= high:
+            return None
+        flat = (run.flat[low - run.record:high - run.record]
+                & following.flat[low - following.record:high - following.record])
+        hits = np.flatnonzero(flat)
+        return low + int(hits[0]) if len(hits) else None
+
+    def segments(self, slices, last):
+        """(slice, first bar, stop) of every part of the stitched run and None,
+        or None and the index of a slice to run on to the last bar."""
+        segments = []
+        current, begin = 0, 0
+        while True:
+            run = slices[current]
+            for following in range(current + 1, len(slices)):
+                switch = self.switch(run, slices[following], begin)
+                if switch is not None:
+                    break
+            else:
+                if run.stop < last:
+                    return None, current
+                segments.append((run, begin, last))
+                return segments, None
+            segments.append((run, begin, switch))
+            current, begin = following, switch
+
+    def stitch(self, segments):
+        order_book = OrderBook(pair=self.quad[3])
+        order_book.set_state(segments[-1][0].book)
+        # Counters of the first chunk before its first bar, a fresh order book
+        values = segments[0][0].counters[0].copy()
+        history, ledger = EventStore(), Ledger()
+        extremes = []
+        for run, begin, stop in segments:
+            begin, stop = begin - run.record, stop - run.record
+            history.extend(run.history[run.lengths[begin]:run.lengths[stop]])
+            ledger.extend(run.book['ledger'][run.trades[begin]:run.trades[stop]])
+            values += run.counters[stop] - run.counters[begin]
+            extremes.append(run.extremes[begin + 1:stop + 1])
+        order_book.order_history = history
+        order_book.ledger = ledger
+        for name, value in zip(Slice.COUNTERS, values.tolist()):
+            setattr(order_book, name, int(value) if '_count' in name else value)
+        # Largest position with its size and the lowest unrealized pnl
+        extremes = np.concatenate(extremes)
+        if len(extremes):
+            largest = extremes[extremes[:, 0].argmax()]
+            order_book.max_position_cost, order_book.max_position_size = largest[0].item(), largest[1].item()
+            order_book.max_unrealized_loss = extremes[:, 2].min().item()
+        return order_book
+
+    def verify(self, pool, strategy, model_kwargs, sample):
+        """Check the chunks stitched over the first sample bars against a serial run of them."""
+        serial = pool.submit(run_slice, self.quad, strategy, model_kwargs, 0, 0, sample, sample)
+        stitched = self.run_to(pool, strategy, model_kwargs, sample)
+        serial = self.stitch([(serial.result(), 0, sample)])
+        # Order ids start over in every chunk
+        orders = lambda order_book: [(order.order_type, order.order_time, order.order_price, order.order_size)
+                                     for order in order_book.order_history]
+        if orders(stitched) != orders(serial) or not all(
+                math.isclose(getattr(stitched, name), getattr(serial, name), rel_tol=1e-9, abs_tol=1e-6)
+                for name in Slice.COUNTERS + Slice.EXTREMES):
+            raise ValueError(f"{strategy.__name__} run in chunks differs from its serial run over the first {sample} bars, "
+                             f"its warmup of {strategy.warmup} bars does not cover what its decisions depend on")
+        self.logger.info(f"Chunks match the serial run over the first {sample} bars")
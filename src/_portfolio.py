@@ -0,0 +1,158 @@
+from _backtester import Backtester
+from _orders import OrderBook, Wallet
+from _stats import TransportStats
+from concurrent.futures import ThreadPoolExecutor
+from itertools import groupby, repeat, count
+from operator import itemgetter
+from time import perf_counter
+import heapq
+import logging
+
+# Portfolio backtests. One strategy trades several pairs at once; every pair
+# has its own Backtester (data and OrderBook) and all order books share one
+# Wallet, so positions of every pair are paid from the same balance.
+#
+# The bars of all pairs are merged by time and the strategy receives one
+# snapshot per timestamp
+#
+#   {'message': 'SNAPSHOT', 'time': time, 'data': {pair: PRICE message, ...}}
+#
+# holding the bar of every pair that has one at that time. Orders must name
+# the pair they are for:
+#
+#   self.send(dict(OpenLong(...).to_dict(), pair='BTCUSDT'))
+#
+# Such strategies set BaseStrategy.portfolio. Single pair strategies are run
+# through PerPair instead, one instance per pair, each receiving the PRICE
+# messages of its pair and sending its orders to that pair's order book.
+
+
+class Portfolio:
+    """Backtest of one strategy over several pairs against a shared balance."""
+    def __init__(self, interval, start_date, final_date, pairs):
+        self.logger = logging.getLogger('Portfolio')
+        self.pairs = list(pairs)
+        # Downloading and reading the data of a pair is mostly waiting on
+        # the network and the disk, every pair gets its own thread
+        with ThreadPoolExecutor(max_workers=len(self.pairs)) as executor:
+            backtesters = list(executor.map(lambda pair: self._load(interval, start_date, final_date, pair), self.pairs))
+        self.backtesters = dict(zip(self.pairs, backtesters))
+        self.wallet = Wallet(backtesters[0].OrderBook.balance)
+        for pair, backtester in self.backtesters.items():
+            backtester.OrderBook = OrderBook(pair=pair, wallet=self.wallet)
+        self.is_running = False
+        self.logger.info(f"Portfolio of {len(self.pairs)} pairs: {', '.join(self.pairs)}")
+
+    @staticmethod
+    def _load(interval, start_date, final_date, pair):
+        backtester = Backtester(interval=interval, start_date=start_date, final_date=final_date, pair=pair, bind=False)
+        backtester.load_data()
+        return backtester
+
+    def snapshots(self):
+        """Yield the time and the (pair, tick) of every bar at that time, in time order."""
+        streams = [zip(self.backtesters[pair].feed.times, repeat(index), count())
+                   for index, pair in enumerate(self.pairs)]
+        for time, bars in groupby(heapq.merge(*streams), key=itemgetter(0)):
+            yield time, [(self.pairs[index], tick) for _, index, tick in bars]
+
+    def run(self, strategy):
+        """Run a strategy in the calling thread over the merged bars of all pairs.
+
+        Args:
+            strategy (BaseStrategy): strategy instance
+
+        Returns:
+            dict: order book of every pair
+        """
+        self.is_running = True
+        strategy.attach(self)
+        strategy.on_connect()
+        for time, bars in self.snapshots():
+            data = {}
+            for pair, tick in bars:
+                backtester = self.backtesters[pair]
+                bar = backtester.bar(tick)
+                backtester.OrderBook.update_price(bar['data'], bar['time'])
+                bar['open_orders'] = len(backtester.OrderBook.get_open_orders())
+                backtester.tick = tick + 1
+                data[pair] = bar
+            strategy.dispatch({'message': 'SNAPSHOT', 'time': time, 'data': data})
+        strategy.stats.stop()
+        for backtester in self.backtesters.values():
+            backtester.close_orderbook()
+            # No transport in between, only the strategy side has statistics
+            backtester.OrderBook.transport_stats = TransportStats()
+            backtester.OrderBook.transport_stats.peer = strategy.stats.to_dict()
+        strategy.on_disconnect()
+        self.is_running = False
+        self.logger.info(f"Portfolio balance: {self.wallet.balance}")
+        return {pair: backtester.OrderBook for pair, backtester in self.backtesters.items()}
+
+    def handle_message(self, data):
+        # Bars without an order leave no history, NO_ORDER and WAKE have no
+        # meaning here
+        if data['message'] == 'START':
+            for backtester in self.backtesters.values():
+                backtester.OrderBook.set_leverage(data.get('leverage'))
+        elif data['message'] == 'ORDER':
+            self._route(data).handle_message(data)
+        elif data['message'] == 'ORDERLIST':
+            orders = {}
+            for order in data['data']:
+                orders.setdefault(self._route(order), []).append(order)
+            for backtester, pair_orders in orders.items():
+                backtester.handle_message({'message': 'ORDERLIST', 'data': pair_orders})
+
+    def _route(self, order):
+        if order.get('pair') not in self.backtesters:
+            raise ValueError(f"Order for unknown pair {order.get('pair')} in a portfolio of {self.pairs}")
+        return self.backtesters[order['pair']]
+
+
+class PerPair:
+    """Single pair strategy run on every pair of a portfolio, one instance per pair.
+
+    Args:
+        strategy (any): strategy class
+        model_kwargs (dict): keyword arguments of the strategy
+        pairs (list): pairs of the portfolio
+    """
+    def __init__(self, strategy, model_kwargs, pairs):
+        self.strategies = {pair: strategy(**model_kwargs) for pair in pairs}
+        self.stats = TransportStats()
+
+    def attach(self, portfolio):
+        for pair, strategy in self.strategies.items():
+            strategy.attach(_PairRoute(portfolio, pair))
+
+    def on_connect(self):
+        for strategy in self.strategies.values():
+            strategy.on_connect()
+
+    def dispatch(self, snapshot):
+        start = perf_counter()
+        for pair, bar in snapshot['data'].items():
+            self.strategies[pair].dispatch(bar)
+        self.stats.handled(perf_counter() - start)
+        self.stats.bars += len(snapshot['data'])
+
+    def on_disconnect(self):
+        for strategy in self.strategies.values():
+            strategy.stats.stop()
+            strategy.on_disconnect()
+
+
+class _PairRoute:
+    # Stands in for the portfolio as the server of one strategy of a PerPair,
+    # its orders are stamped with its pair
+    def __init__(self, portfolio, pair):
+        self.portfolio = portfolio
+        self.pair = pair
+
+    def handle_message(self, data):
+        if data['message'] == 'ORDER':
+            data = dict(data, pair=self.pair)
+        elif data['message'] == 'ORDERLIST':
+            data = dict(data, data=[dict(order, pair=self.pair) for order in data['data']])
+        self.portfolio.handle_message(data)
@@ -0,0 +1,278 @@
+from _orders import ORDER_TYPES, ORDER_CODES
+import struct
+import json
+
+# Wire protocol between Server and Client.
+#
+# Version 1 is plain JSON objects written back to back on the socket.
+# Version 2 frames every message with a 4 byte big-endian length header and
+# packs the hot messages (PRICE, PRICEBATCH, ORDER, ORDERLIST, NO_ORDER, END)
+# as fixed struct records. Anything else is sent as a JSON body inside a frame.
+# The values of the PRICE 'data' columns keep their type: the SCHEMA frame
+# carries the struct format of every column, 'q' for int, '?' for bool and
+# 'd' for anything else.
+#
+# The version is negotiated by the START message, which is always sent as
+# plain JSON: the client adds 'protocol': PROTOCOL_VERSION and the server
+# switches to framing only if the client asked for it. A client that sees a
+# reply starting with '{' knows the server only speaks version 1.
+PROTOCOL_VERSION = 2
+
+HEADER = struct.Struct('!I')
+
+# Body type codes
+JSON = 0
+PRICE = 1
+ORDER = 2
+ORDERLIST = 3
+NO_ORDER = 4
+END = 5
+SCHEMA = 6
+PRICEBATCH = 7
+# ORDERLIST answering a PRICEBATCH, every order carries its tick
+TICKED_ORDERLIST = 8
+
+PRICE_KEYS = frozenset(['message', 'price', 'tick', 'time', 'size', 'data', 'open_orders'])
+BAR_KEYS = PRICE_KEYS - {'open_orders'}
+ORDER_KEYS = frozenset(['message', 'order_id', 'order_type', 'order_time', 'order_price', 'order_size', 'order_SL', 'order_TP'])
+TICKED_ORDER_KEYS = ORDER_KEYS | {'tick'}
+
+# type, tick, size, open_orders, price, len(time), followed by the column
+# values and the time string
+PRICE_HEAD = '!BqqqdH'
+# tick, size, price, len(time), followed by the column values, one per bar
+# of a PRICEBATCH
+BAR_HEAD = '!qqdH'
+# order_id, order_type, price, size, SL/TP flags, SL, TP, len(time)
+ORDER_RECORD = struct.Struct('!qBddBddH')
+ORDERLIST_HEAD = struct.Struct('!BI')
+# type, count and sequence number (tick of the first bar) of a PRICEBATCH
+# and of the TICKED_ORDERLIST answering it
+SEQ_HEAD = struct.Struct('!BIq')
+TICK = struct.Struct('!q')
+TIME_HEAD = struct.Struct('!BH')
+COUNT = struct.Struct('!H')
+NAME_LENGTH = struct.Struct('!B')
+
+_END_FRAME = HEADER.pack(1) + bytes([END])
+
+
+def _format(value) -> str:
+    # Struct format of a column value, values that are no number fail to pack
+    kind = type(value)
+    return 'q' if kind is int else '?' if kind is bool else 'd'
+
+
+def frame(body: bytes) -> bytes:
+    return HEADER.pack(len(body)) + body
+
+
+def _pack_order(order: dict, keys: frozenset = ORDER_KEYS) -> bytes:
+    if order.keys() != keys or order['message'] != 'ORDER':
+        raise ValueError("Order is not a plain ORDER record")
+    order_id = order['order_id']
+    if type(order_id) is not int:
+        raise ValueError("Order id is not an integer")
+    time = order['order_time'].encode()
+    SL, TP = order['order_SL'], order['order_TP']
+    flags = (SL is not None) | (TP is not None) << 1
+    return ORDER_RECORD.pack(order_id, ORDER_CODES[order['order_type']],
+                             order['order_price'], order['order_size'], flags,
+                             SL if SL is not None else 0.0, TP if TP is not None else 0.0,
+                             len(time)) + time
+
+
+def _unpack_order(body: bytes, offset: int) -> tuple:
+    order_id, order_type, price, size, flags, SL, TP, length = ORDER_RECORD.unpack_from(body, offset)
+    offset += ORDER_RECORD.size
+    order = {'message': 'ORDER',
+             'order_id': order_id,
+             'order_type': ORDER_TYPES[order_type],
+             'order_time': body[offset:offset + length].decode(),
+             'order_price': price,
+             'order_size': size,
+             'order_SL': SL if flags & 1 else None,
+             'order_TP': TP if flags & 2 else None}
+    return order, offset + length
+
+
+class Encoder:
+    """Turns messages into version 2 frames.
+
+    The column names and types of the PRICE 'data' field are sent once in a
+    SCHEMA frame and only repeated when they change, so a PRICE record
+    carries nothing but numbers and the timestamp.
+    """
+    def __init__(self):
+        # Columns, formats and PRICE and bar structs of the last SCHEMA sent
+        self.schema = None
+
+    def encode(self, message: dict) -> bytes:
+        try:
+            kind = message['message']
+            if kind == 'PRICE' and message.keys() == PRICE_KEYS:
+                return self._encode_price(message)
+            elif kind == 'ORDER':
+                return frame(bytes([ORDER]) + _pack_order(message))
+            elif kind == 'ORDERLIST' and message.keys() == {'message', 'data'}:
+                records = [_pack_order(order) for order in message['data']]
+                return frame(ORDERLIST_HEAD.pack(ORDERLIST, len(records)) + b''.join(records))
+            elif kind == 'ORDERLIST' and message.keys() == {'message', 'seq', 'data'}:
+                orders = message['data']
+                records = [TICK.pack(order['tick']) + _pack_order(order, TICKED_ORDER_KEYS) for order in orders]
+                return frame(SEQ_HEAD.pack(TICKED_ORDERLIST, len(records), message['seq']) + b''.join(records))
+            elif kind == 'PRICEBATCH' and message.keys() == {'message', 'seq', 'data'}:
+                return self._encode_batch(message['seq'], message['data'])
+            elif kind == 'NO_ORDER' and message['order_id'] is None:
+                time = message['order_time'].encode()
+                return frame(TIME_HEAD.pack(NO_ORDER, len(time)) + time)
+            elif kind == 'END' and len(message) == 1:
+                return _END_FRAME
+        except (KeyError, ValueError, TypeError, AttributeError, struct.error):
+            pass
+        return frame(bytes([JSON]) + json.dumps(message).encode())
+
+    def _schema(self, data: dict) -> tuple:
+        # Schema of data and the SCHEMA frame to send before it, empty if it
+        # was sent already. Nothing is kept here: a bar that fails to pack
+        # goes out as JSON, so the schema is kept only once its frame is built.
+        columns = tuple(data)
+        formats = ''.join(map(_format, data.values()))
+        if self.schema is not None and self.schema[:2] == (columns, formats):
+            return self.schema, b''
+        schema = (columns, formats, struct.Struct(PRICE_HEAD + formats), struct.Struct(BAR_HEAD + formats))
+        names = [name.encode() for name in columns]
+        return schema, frame(bytes([SCHEMA]) + COUNT.pack(len(names)) +
+                             b''.join(NAME_LENGTH.pack(len(name)) + name + kind.encode() for name, kind in zip(names, formats)))
+
+    def _encode_batch(self, seq: int, bars: list) -> bytes:
+        if not bars:
+            raise ValueError("Empty batch")
+        schema, schema_frame = self._schema(bars[0]['data'])
+        columns, formats, _, bar_record = schema
+        records = []
+        for bar in bars:
+            data = bar['data']
+            if bar.keys() != BAR_KEYS or tuple(data) != columns or ''.join(map(_format, data.values())) != formats:
+                raise ValueError("Bar does not match the batch schema")
+            time = bar['time'].encode()
+            records.append(bar_record.pack(bar['tick'], bar['size'], bar['price'], len(time), *data.values()) + time)
+        body = frame(SEQ_HEAD.pack(PRICEBATCH, len(records), seq) + b''.join(records))
+        self.schema = schema
+        return schema_frame + body
+
+    def _encode_price(self, message: dict) -> bytes:
+        data = message['data']
+        schema, schema_frame = self._schema(data)
+        time = message['time'].encode()
+        body = schema[2].pack(PRICE, message['tick'], message['size'], message['open_orders'],
+                              message['price'], len(time), *data.values()) + time
+        self.schema = schema
+        return schema_frame + frame(body)
+
+
+class Decoder:
+    """Turns version 2 frame bodies back into messages.
+
+    decode() returns None for SCHEMA frames, which only update the decoder.
+    """
+    def __init__(self):
+        self.columns = None
+        self.record = None
+        self.bar_record = None
+
+    def decode(self, body: bytes):
+        kind = body[0]
+        if kind == PRICE:
+            record = self.record.unpack_from(body)
+            return {'price': record[4],
+                    'tick': record[1],
+                    'time': body[self.record.size:].decode(),
+                    'message': 'PRICE',
+                    'size': record[2],
+                    'data': dict(zip(self.columns, record[6:])),
+                    'open_orders': record[3]}
+        elif kind == ORDERLIST:
+            _, count = ORDERLIST_HEAD.unpack_from(body)
+            offset = ORDERLIST_HEAD.size
+            orders = []
+            for _ in range(count):
+                order, offset = _unpack_order(body, offset)
+                orders.append(order)
+            return {'message': 'ORDERLIST', 'data': orders}
+        elif kind == NO_ORDER:
+            return {'message': 'NO_ORDER',
+                    'order_id': None,
+                    'order_type': 'NO_ORDER',
+                    'order_time': body[TIME_HEAD.size:].decode(),
+                    'order_price': None,
+                    'order_size': None,
+                    'order_SL': None,
+                    'order_TP': None}
+        elif kind == ORDER:
+            return _unpack_order(body, 1)[0]
+        elif kind == PRICEBATCH:
+            _, count, seq = SEQ_HEAD.unpack_from(body)
+            offset = SEQ_HEAD.size
+            bars = []
+            for _ in range(count):
+                record = self.bar_record.unpack_from(body, offset)
+                offset += self.bar_record.size
+                bars.append({'price': record[2],
+                             'tick': record[0],
+                             'time': body[offset:offset + record[3]].decode(),
+                             'message': 'PRICE',
+                             'size': record[1],
+                             'data': dict(zip(self.columns, record[4:]))})
+                offset += record[3]
+            return {'message': 'PRICEBATCH', 'seq': seq, 'data': bars}
+        elif kind == TICKED_ORDERLIST:
+            _, count, seq = SEQ_HEAD.unpack_from(body)
+            offset = SEQ_HEAD.size
+            orders = []
+            for _ in range(count):
+                (tick,) = TICK.unpack_from(body, offset)
+                order, offset = _unpack_order(body, offset + TICK.size)
+                order['tick'] = tick
+                orders.append(order)
+            return {'message': 'ORDERLIST', 'seq': seq, 'data': orders}
+        elif kind == END:
+            return {'message': 'END'}
+        elif kind == SCHEMA:
+            (count,) = COUNT.unpack_from(body, 1)
+            offset = 1 + COUNT.size
+            columns, formats = [], ''
+            for _ in range(count):
+                (length,) = NAME_LENGTH.unpack_from(body, offset)
+                offset += NAME_LENGTH.size
+                columns.append(body[offset:offset + length].decode())
+                formats += chr(body[offset + length])
+                offset += length + 1
+            self.columns = columns
+            self.record = struct.Struct(PRICE_HEAD + formats)
+            self.bar_record = struct.Struct(BAR_HEAD + formats)
+            return None
+        return json.loads(body[1:])
+
+
+class FrameReader:
+    """Reads length-prefixed frames from a socket without scanning the payload."""
+    def __init__(self, sock):
+        self.sock = sock
+        self.buffer = bytearray()
+
+    def read(self):
+        """Return the next frame body, or None when the peer closed the connection."""
+        buffer = self.buffer
+        while True:
+            if len(buffer) >= HEADER.size:
+                (length,) = HEADER.unpack_from(buffer)
+                end = HEADER.size + length
+                if len(buffer) >= end:
+                    body = bytes(buffer[HEADER.size:end])
+                    del buffer[:end]
+                    return body
+            chunk = self.sock.recv(1 << 16)
+            if not chunk:
+                return None
+            buffer += chunk
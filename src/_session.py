@@ -0,0 +1,96 @@
+from _backtester import Backtester
+from _base_socket import Node
+from _orders import OrderBook
+from _shm import ShmChannel
+from _protocol import Encoder
+import multiprocessing
+import logging
+
+# Persistent strategy sessions. The strategy process is started once and
+# stays connected over a shared memory channel; before every backtest the
+# server sends one of
+#
+#   {'message': 'CONFIGURE', 'model_kwargs': {...}}  new strategy parameters
+#   {'message': 'RESET'}                             same parameters, new run
+#
+# and the worker answers by creating a fresh strategy on the same connection,
+# which sends START and trades until END as usual. Closing the channel stops
+# the worker.
+
+
+def serve_strategy(strategy: any, channel: ShmChannel) -> None:
+    """Worker loop of a StrategySession, the target of the strategy process.
+
+    Args:
+        strategy (any): strategy class
+        channel (ShmChannel): channel created by the server process
+    """
+    link = Node()
+    link.client_socket = channel.client_end()
+    link._use_frames(link.client_socket)
+    model_kwargs = {}
+    while True:
+        body = link.reader.read()
+        if body is None:
+            break
+        message = link.decoder.decode(body)
+        if message is None:
+            continue
+        if message['message'] == 'CONFIGURE':
+            model_kwargs = message['model_kwargs']
+        elif message['message'] != 'RESET':
+            continue
+        st = strategy(**model_kwargs)
+        st.adopt(link)
+        st.is_running = True
+        st.on_connect()
+        st.receive()
+        st.on_disconnect()
+    channel.close()
+
+
+class StrategySession:
+    """A strategy process that is reused for many backtests.
+
+    Starting an interpreter, importing the strategies and connecting is paid
+    once; every run() only sends CONFIGURE or RESET and streams the new
+    dataset over the open channel.
+    """
+    def __init__(self, strategy: any):
+        self.logger = logging.getLogger('IPC')
+        self.channel = ShmChannel()
+        self.process = multiprocessing.Process(target=serve_strategy, args=(strategy, self.channel))
+        self.process.start()
+        self.endpoint = self.channel.server_end(self.process)
+        self.encoder = Encoder()
+        self.model_kwargs = None
+
+    def run(self, quad: tuple, model_kwargs: dict = {}) -> OrderBook:
+        """Backtest the strategy with model_kwargs on the dataset of quad.
+
+        Args:
+            quad (tuple): interval, start date, final date and pair
+            model_kwargs (dict): keyword arguments of the strategy
+
+        Returns:
+            OrderBook: order book
+        """
+        interval, start_date, final_date, pair = quad
+        backtester = Backtester(interval=interval, start_date=start_date, final_date=final_date, pair=pair, bind=False)
+        backtester.load_data()
+        if model_kwargs == self.model_kwargs:
+            message = {'message': 'RESET'}
+        else:
+            message = {'message': 'CONFIGURE', 'model_kwargs': model_kwargs}
+            self.model_kwargs = model_kwargs
+        self.endpoint.sendall(self.encoder.encode(message))
+        backtester.keep_connection = True
+        backtester.start(channel=self.endpoint)
+        return backtester.disconnect()
+
+    def close(self):
+        # The worker exits once it sees the channel closed
+        self.endpoint.close()
+        self.process.join()
+        self.channel.close()
+        self.logger.info("Strategy session closed")
@@ -0,0 +1,180 @@
+from multiprocessing import shared_memory, resource_tracker
+import multiprocessing
+import os
+
+# Shared memory transport between a Server and a Client living in different
+# processes. A ShmChannel holds two single-producer/single-consumer byte
+# rings, one per direction, in one shared memory segment. Each ring has two
+# semaphores: one released on every write and one on every read. Both ends
+# count the writes and reads in the ring header and take exactly one permit
+# per write or read, so permits never pile up. A reader only blocks when its
+# ring is empty, a writer only when it is full, and both wake up regularly
+# to check that the process at the other end is still alive.
+#
+# ShmEndpoint exposes recv/sendall/close like a stream socket, so the framed
+# protocol (Encoder, Decoder, FrameReader) runs on top of it unchanged. A
+# dead peer shows up as it would on a socket, as ConnectionResetError on
+# recv and BrokenPipeError on sendall.
+
+# Ring header: bytes written, bytes read, closed flag, writes, reads (uint64 each)
+WRITTEN, READ, CLOSED, WRITES, READS = range(5)
+HEADER_SIZE = 5 * 8
+DEFAULT_CAPACITY = 1 << 22
+# Seconds a blocked end waits before checking that the other one is alive
+POLL_INTERVAL = 1.0
+
+
+class Ring:
+    def __init__(self, buf, offset, capacity, written, read):
+        self.capacity = capacity
+        self.counters = buf[offset:offset + HEADER_SIZE].cast('Q')
+        self.data = buf[offset + HEADER_SIZE:offset + HEADER_SIZE + capacity]
+        # Released once per write (and on close) and once per read
+        self.signals = {WRITES: written, READS: read}
+        # Permits taken so far, one per write or read counted in the header
+        self.taken = {WRITES: 0, READS: 0}
+        # Process at the other end, None if it is not known
+        self.peer = None
+
+    def _take(self, kind, error):
+        """Take the permit of the next write or read, waiting for it."""
+        while not self.signals[kind].acquire(timeout=POLL_INTERVAL):
+            if self.peer is not None and not self.peer.is_alive():
+                raise error(f"The process at the other end of the ring has exited (exit code {self.peer.exitcode})")
+        self.taken[kind] += 1
+
+    def _catch_up(self, kind, error):
+        """Take the permits of the writes or reads already counted."""
+        while self.taken[kind] < self.counters[kind]:
+            self._take(kind, error)
+
+    def write(self, payload):
+        size = len(payload)
+        if size > self.capacity:
+            raise ValueError(f"Message of {size} bytes does not fit the ring of {self.capacity} bytes")
+        head = self.counters[WRITTEN]
+        # Rings are sized for many messages, wait for the reader if it is full
+        while True:
+            self._catch_up(READS, BrokenPipeError)
+            if self.capacity - (head - self.counters[READ]) >= size:
+                break
+            self._take(READS, BrokenPipeError)
+        position = head % self.capacity
+        first = min(size, self.capacity - position)
+        self.data[position:position + first] = payload[:first]
+        if first < size:
+            self.data[:size - first] = payload[first:]
+        self.counters[WRITTEN] = head + size
+        self.counters[WRITES] += 1
+        self.signals[WRITES].release()
+
+    def read(self, size):
+        while True:
+            self._catch_up(WRITES, ConnectionResetError)
+            head, tail = self.counters[WRITTEN], self.counters[READ]
+            if head != tail:
+                break
+            if self.counters[CLOSED]:
+                return b''
+            self._take(WRITES, ConnectionResetError)
+        size = min(size, head - tail)
+        position = tail % self.capacity
+        first = min(size, self.capacity - position)
+        payload = bytes(self.data[position:position + first])
+        if first < size:
+            payload += bytes(self.data[:size - first])
+        self.counters[READ] = tail + size
+        self.counters[READS] += 1
+        self.signals[READS].release()
+        return payload
+
+    def close(self):
+        self.counters[CLOSED] = 1
+        # Counted as a write, the reader takes its permit like any other
+        self.counters[WRITES] += 1
+        self.signals[WRITES].release()
+
+    def release(self):
+        self.counters.release()
+        self.data.release()
+
+
+class ShmEndpoint:
+    """One side of a ShmChannel, used in place of a connected socket.
+
+    Args:
+        rx (Ring): ring read from
+        tx (Ring): ring written to
+        peer (multiprocessing.Process): process at the other end, None if not known
+    """
+    def __init__(self, rx, tx, peer=None):
+        self.rx = rx
+        self.tx = tx
+        rx.peer = tx.peer = peer
+
+    def recv(self, size, flags=0):
+        return self.rx.read(size)
+
+    def sendall(self, payload):
+        self.tx.write(payload)
+
+    def close(self):
+        self.tx.close()
+
+
+class ShmChannel:
+    """Pair of shared memory rings connecting a server and a client process.
+
+    The server creates the channel and passes it to the client process as an
+    argument; the client side attaches to the same segment by name.
+    """
+    def __init__(self, capacity=DEFAULT_CAPACITY):
+        self.capacity = capacity
+        self.shm = shared_memory.SharedMemory(create=True, size=2 * (HEADER_SIZE + capacity))
+        self.shm.buf[:HEADER_SIZE] = bytes(HEADER_SIZE)
+        self.shm.buf[HEADER_SIZE + capacity:2 * HEADER_SIZE + capacity] = bytes(HEADER_SIZE)
+        # Written and read signals of the ring to the client and of the one to the server
+        self.to_client = (multiprocessing.Semaphore(0), multiprocessing.Semaphore(0))
+        self.to_server = (multiprocessing.Semaphore(0), multiprocessing.Semaphore(0))
+        # Forked children inherit this object, only the creator unlinks
+        self.owner = os.getpid()
+        self.rings = []
+
+    def __getstate__(self):
+        return {'name': self.shm.name, 'capacity': self.capacity,
+                'to_client': self.to_client, 'to_server': self.to_server}
+
+    def __setstate__(self, state):
+        self.capacity = state['capacity']
+        self.shm = shared_memory.SharedMemory(name=state['name'])
+        # The creating process owns the segment, don't let this process unlink it
+        resource_tracker.unregister(self.shm._name, 'shared_memory')
+        self.to_client = state['to_client']
+        self.to_server = state['to_server']
+        self.owner = None
+        self.rings = []
+
+    def _rings(self):
+        buf = self.shm.buf
+        to_client = Ring(buf, 0, self.capacity, *self.to_client)
+        to_server = Ring(buf, HEADER_SIZE + self.capacity, self.capacity, *self.to_server)
+        self.rings += [to_client, to_server]
+        return to_client, to_server
+
+    def server_end(self, client=None):
+        """End of the server, client is the process of the other end if there is one."""
+        to_client, to_server = self._rings()
+        return ShmEndpoint(rx=to_server, tx=to_client, peer=client)
+
+    def client_end(self):
+        """End of the client, in a process started by the server."""
+        to_client, to_server = self._rings()
+        return ShmEndpoint(rx=to_client, tx=to_server, peer=multiprocessing.parent_process())
+
+    def close(self):
+        for ring in self.rings:
+            ring.release()
+        self.rings = []
+        self.shm.close()
+        if self.owner == os.getpid():
+            self.shm.unlink()
@@ -0,0 +1,119 @@
+from collections import deque
+from time import perf_counter
+
+# Transport statistics of one end of a Server/Client connection.
+#
+# Every end counts the messages and bytes it sends and receives and times
+# encoding, decoding and its on_receive handler. The server also times the
+# round trip of every PRICE/PRICEBATCH message, from sending it until the
+# strategy's reply is handed to on_receive. Comparing the round trip with the
+# handler time of the strategy shows how much of a backtest is spent on IPC.
+
+
+class Histogram:
+    """Durations in power of two microsecond buckets."""
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.buckets = {}
+
+    def add(self, seconds: float):
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+        bucket = int(seconds * 1e6).bit_length()
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+
+    def percentile(self, q: float) -> float:
+        """Upper bound in microseconds of the bucket holding the q-th percentile."""
+        rank = q * self.count
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= rank:
+                return float(1 << bucket)
+        return 0.0
+
+    def to_dict(self) -> dict:
+        return {'count': self.count,
+                'total_s': self.total,
+                'mean_us': self.total / self.count * 1e6 if self.count else 0.0,
+                'p50_us': self.percentile(0.5),
+                'p99_us': self.percentile(0.99),
+                'max_us': self.max * 1e6,
+                # key: upper bound of the bucket in microseconds
+                'buckets': {str(1 << bucket): n for bucket, n in sorted(self.buckets.items())}}
+
+
+class TransportStats:
+    """Counters and latency histograms of one end of a connection."""
+    def __init__(self):
+        self.messages_sent = 0
+        self.messages_received = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.bars = 0
+        self.encode = Histogram()
+        self.decode = Histogram()
+        self.handler = Histogram()
+        self.round_trip = Histogram()
+        # Send times of the bars waiting for a reply, oldest first
+        self.pending = deque()
+        self.started = None
+        self.finished = None
+        # Statistics reported by the other end, if it sent any
+        self.peer = None
+
+    def _begin(self):
+        # The clock starts with the first message, not when the end is created
+        if self.started is None:
+            self.started = perf_counter()
+
+    def sent(self, size: int, seconds: float):
+        self._begin()
+        self.messages_sent += 1
+        self.bytes_sent += size
+        self.encode.add(seconds)
+
+    def received(self, size: int, seconds: float):
+        self._begin()
+        self.messages_received += 1
+        self.bytes_received += size
+        self.decode.add(seconds)
+
+    def handled(self, seconds: float):
+        self._begin()
+        self.handler.add(seconds)
+
+    def request(self, bars: int):
+        # A PRICE or PRICEBATCH message went out and waits for its reply
+        self.bars += bars
+        self.pending.append(perf_counter())
+
+    def reply(self):
+        if self.pending:
+            self.round_trip.add(perf_counter() - self.pending.popleft())
+
+    def stop(self):
+        self.finished = perf_counter()
+
+    def to_dict(self) -> dict:
+        elapsed = 0.0
+        if self.started is not None:
+            elapsed = (self.finished or perf_counter()) - self.started
+        stats = {'messages_sent': self.messages_sent,
+                 'messages_received': self.messages_received,
+                 'bytes_sent': self.bytes_sent,
+                 'bytes_received': self.bytes_received,
+                 'bars': self.bars,
+                 'elapsed_s': elapsed,
+                 'bars_per_s': self.bars / elapsed if elapsed else 0.0,
+                 'encode': self.encode.to_dict(),
+                 'decode': self.decode.to_dict(),
+                 'handler': self.handler.to_dict(),
+                 'round_trip': self.round_trip.to_dict()}
+        if self.peer is not None:
+            stats['peer'] = self.peer
+        return stats
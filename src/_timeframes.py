@@ -0,0 +1,63 @@
+# Higher timeframe bars built from the bars of the base interval.
+#
+# A strategy trading 1m bars can subscribe to e.g. 1h and 4h bars by listing
+# them in its START message ('timeframes': ['1h', '4h'], see
+# BaseStrategy.timeframes). Every bar it receives then carries
+#
+#   'timeframes': {'1h': {'closed': {...}, 'partial': {...}}, ...}
+#
+# closed is the last complete bar of the timeframe and partial the one in
+# progress, made of the base bars up to and including the current one (None
+# when the current bar completed a period). Bars hold time, open, high, low,
+# close and volume; time is the start of the period, in the format of the
+# 'time' of a PRICE message. Periods are aligned to the epoch like exchange
+# klines.
+
+UNIT_SECONDS = {'m': 60, 'h': 3600, 'd': 86400, 'w': 604800}
+
+
+def interval_seconds(interval: str) -> int:
+    """Length of an interval such as '15m', '4h' or '1d' in seconds."""
+    return int(interval[:-1]) * UNIT_SECONDS[interval[-1]]
+
+
+class BarBuilder:
+    """Bars of one higher timeframe, updated in O(1) per base bar.
+
+    Args:
+        timeframe (str): interval of the bars built, e.g. '1h'
+        base_seconds (int): length of the base bars in seconds
+    """
+    def __init__(self, timeframe: str, base_seconds: int):
+        self.timeframe = timeframe
+        self.seconds = interval_seconds(timeframe)
+        self.base_seconds = base_seconds
+        self.start = None
+        self.closed = None
+        self.partial = None
+
+    def update(self, time: int, ohlcv: dict):
+        """Add the base bar starting at time (epoch seconds)."""
+        start = time - time % self.seconds
+        if self.partial is not None and start != self.start:
+            # The data has a gap, the period ended without its last bar
+            self.closed, self.partial = self.partial, None
+        if self.partial is None:
+            self.start = start
+            self.partial = {'time': str(start), 'open': ohlcv['open'], 'high': ohlcv['high'],
+                            'low': ohlcv['low'], 'close': ohlcv['close'], 'volume': ohlcv['volume']}
+        else:
+            partial = self.partial
+            if ohlcv['high'] > partial['high']:
+                partial['high'] = ohlcv['high']
+            if ohlcv['low'] < partial['low']:
+                partial['low'] = ohlcv['low']
+            partial['close'] = ohlcv['close']
+            partial['volume'] += ohlcv['volume']
+        if time + self.base_seconds >= start + self.seconds:
+            # Last base bar of the period, the bar is complete now
+            self.closed, self.partial = self.partial, None
+
+    def snapshot(self) -> dict:
+        # partial keeps changing, the strategy gets a copy; closed bars don't
+        return {'closed': self.closed, 'partial': dict(self.partial) if self.partial is not None else None}
@@ -4,20 +4,36 @@ from _montecarlo import MonteCarlo
 from _backtester import Backtester
 from _simulator import Simulator
 from _orders import OrderBook
+from _shm import ShmChannel
+from _session import StrategySession
+from _portfolio import Portfolio, PerPair
+from _checkpoint import Checkpoint
+from _parallel import TimeSlices
+from _async_socket import AsyncServer, AsyncClient
 from matplotlib import pyplot as plt
 from strategy import *
 from time import sleep
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
 
 
 import logging
 import threading
+import queue
+import multiprocessing
+import asyncio
 import datetime
 import os
 import yaml
 import json
+import hashlib
+import inspect
 
 # Set this file logger name to IPC
 logger = logging.getLogger('IPC')
+# Data of the longest benchmark window, inherited by the forked workers
+# backtesting the windows
+_benchmark_data = {}
 
 def backtest(strategy: any, base_path: str) -> OrderBook:
     """Backtest a strategy.
@@ -44,8 +60,8 @@ def backtest_benchmark(strategy: any, base_path: str) -> OrderBook:
     benchmark, pair = get_benchmark()
     ob = []
     mlist = []
-    for interval, start, final in benchmark:
-        M, order_book = _backtest(strategy, base_path, (interval, start, final, pair), verbose=True)
+    for results in _backtest_benchmark([strategy], [base_path], benchmark, pair):
+        M, order_book = results[0]
         ob.append(order_book)
         try:
             mlist.append(M["Performance"])
@@ -55,6 +71,32 @@ def backtest_benchmark(strategy: any, base_path: str) -> OrderBook:
     performance = sum(mlist)/len(mlist)
     return ob, performance
 
+def backtest_benchmark_many(strategies: list, base_paths: list) -> tuple:
+    """Benchmark backtest several strategies at once.
+
+    Every benchmark period is loaded once and fed to all the strategies.
+
+    Args:
+        strategies (list): strategies to backtest
+        base_paths (list): result directory of each strategy
+
+    Returns:
+        tuple: order books and mean performance of each strategy
+    """
+    benchmark, pair = get_benchmark()
+    ob = [[] for _ in strategies]
+    mlist = [[] for _ in strategies]
+    for results in _backtest_benchmark(strategies, base_paths, benchmark, pair):
+        for i, (M, order_book) in enumerate(results):
+            ob[i].append(order_book)
+            try:
+                mlist[i].append(M["Performance"])
+            except:
+                mlist[i].append(0)
+    # return mean of the metrics of each strategy
+    performances = [sum(m)/len(m) for m in mlist]
+    return ob, performances
+
 
 def simulate(strategy: any, base_path: str) -> tuple:
     """Simulate a strategy.
@@ -75,11 +117,16 @@ def simulate(strategy: any, base_path: str) -> tuple:
         i += 1 
         logger.info(f"***********************[{i}]/[{len(path_list)}]***********************")
         return_value = []
-        simulator_thread = threading.Thread(target=start_simulator, args=(data_path, return_value))
-        strategy_thread = threading.Thread(target=start_strategy, args=(strategy,))
+        ready = queue.Queue()
+        simulator_thread = threading.Thread(target=start_simulator, args=(data_path, return_value, ready))
         simulator_thread.start()
         logger.info(f"Simulator started.")
-        sleep(2)
+        address = ready.get()
+        if address is None:
+            simulator_thread.join()
+            raise RuntimeError("Simulator could not be started")
+        port, session = address
+        strategy_thread = threading.Thread(target=start_strategy, kwargs={"strategy": strategy, "model_kwargs": {}, "port": port, "session": session})
         strategy_thread.start()
         logger.info(f"Strategy started.")
         simulator_thread.join()
@@ -108,27 +155,34 @@ def live_trade():
 
 def get_benchmark():
     # benchmark measure 12-9-6-3-1 months, 2 weeks and last 3 days
+    # With benchmark_anchored the month windows start on the first day of
+    # their month and the 2 week window on a Monday, so from one day to the
+    # next they keep their start and the backtests of the previous day are
+    # extended by the new day only
+    anchored = get_config().get('benchmark_anchored', False)
     
     # get current date YYYY-MM-DD
     cur = datetime.datetime.now() - datetime.timedelta(days=1)
     cur = cur.strftime("%Y-%m-%d")
     # get 12 months ago
     start = datetime.datetime.strptime(cur, "%Y-%m-%d") - datetime.timedelta(days=365)
-    start = start.strftime("%Y-%m-%d")
+    start = (start.replace(day=1) if anchored else start).strftime("%Y-%m-%d")
     # get 9 months ago
     start2 = datetime.datetime.strptime(cur, "%Y-%m-%d") - datetime.timedelta(days=270)
-    start2 = start2.strftime("%Y-%m-%d")
+    start2 = (start2.replace(day=1) if anchored else start2).strftime("%Y-%m-%d")
     # get 6 months ago
     start3 = datetime.datetime.strptime(cur, "%Y-%m-%d") - datetime.timedelta(days=180)
-    start3 = start3.strftime("%Y-%m-%d")
+    start3 = (start3.replace(day=1) if anchored else start3).strftime("%Y-%m-%d")
     # get 3 months ago
     start4 = datetime.datetime.strptime(cur, "%Y-%m-%d") - datetime.timedelta(days=90)
-    start4 = start4.strftime("%Y-%m-%d")
+    start4 = (start4.replace(day=1) if anchored else start4).strftime("%Y-%m-%d")
     # get 1 month ago
     start5 = datetime.datetime.strptime(cur, "%Y-%m-%d") - datetime.timedelta(days=30)
-    start5 = start5.strftime("%Y-%m-%d")
+    start5 = (start5.replace(day=1) if anchored else start5).strftime("%Y-%m-%d")
     # get 2 weeks ago
     start6 = datetime.datetime.strptime(cur, "%Y-%m-%d") - datetime.timedelta(days=14)
+    if anchored:
+        start6 -= datetime.timedelta(days=start6.weekday())
     start6 = start6.strftime("%Y-%m-%d")
     # get 3 days ago
     start7 = datetime.datetime.strptime(cur, "%Y-%m-%d") - datetime.timedelta(days=3)
@@ -165,40 +219,318 @@ def open_browser(host, port):
         
 
 
-def start_backtester(interval:any, start_date:str, final_date:str, pair:str, return_value:list, ready:list):
+def start_backtester(interval:any, start_date:str, final_date:str, pair:str, return_value:list, ready:queue.Queue):
     """Start the backtester. This function is called by a thread
 
     Args:
         interval (any): interval of the data
         start_date (str): start date of the data
         final_date (str): final date of the data
-        return_value (list): list to store the order book
+        return_value (list): list to store the order book, or the error the backtest stopped on
+        ready (queue.Queue): receives the port and session token once the
+            backtester is listening, or None if it failed to start
 
     Returns:
         list: order book
     """
-    backtester = Backtester(interval=interval, start_date=start_date, final_date=final_date, pair=pair)
-    loaded = backtester.load_data()
-    ready.append(loaded)
-    ready.append(backtester.port)
+    try:
+        backtester = Backtester(interval=interval, start_date=start_date, final_date=final_date, pair=pair)
+        backtester.load_data()
+    except Exception:
+        ready.put(None)
+        raise
+    ready.put((backtester.port, backtester.session))
     backtester.start()
-    order_book = backtester.disconnect()
+    try:
+        order_book = backtester.disconnect()
+    except Exception as e:
+        # Raised again in the thread that waits for the result
+        return_value.append(e)
+        return
     return_value.append(order_book)
     logger.info("Backtester stopped")
 
 
-def start_simulator(data_path: str, return_value:list) -> None:
+def run_inprocess(strategy: any, quad: tuple, model_kwargs: dict = {}, resume: bool = False, extend: bool = False) -> OrderBook:
+    """Run the backtester and the strategy in the calling thread, without sockets.
+
+    Args:
+        strategy (any): strategy class to backtest
+        quad (tuple): interval, start date, final date and pair
+        model_kwargs (dict): keyword arguments of the strategy
+        resume (bool): continue from the last checkpoint of this backtest
+        extend (bool): only run the bars after the last finished backtest with the same start
+
+    Returns:
+        OrderBook: order book
+    """
+    interval, start_date, final_date, pair = quad
+    backtester = Backtester(interval=interval, start_date=start_date, final_date=final_date, pair=pair, bind=False)
+    backtester.load_data()
+    st = strategy(**model_kwargs)
+    checkpoint = get_checkpoint(strategy, quad, model_kwargs, resume)
+    final = get_final_checkpoint([strategy], quad, [model_kwargs]) if extend else None
+    order_book = backtester.run(st, checkpoint, final)
+    if checkpoint is not None:
+        # The backtest finished, nothing left to resume
+        checkpoint.remove()
+    logger.info("Backtester stopped")
+    return order_book
+
+
+def get_checkpoint(strategy: any, quad: tuple, model_kwargs: dict, resume: bool) -> Checkpoint:
+    """Checkpoint of a backtest, None if checkpoints are off and it is not resumed.
+
+    Every strategy version, dataset, set of parameters and trading settings
+    has its own checkpoint directory, so a resumed backtest finds the one it
+    left.
+
+    Args:
+        strategy (any): strategy class to backtest
+        quad (tuple): interval, start date, final date and pair
+        model_kwargs (dict): keyword arguments of the strategy
+        resume (bool): keep the existing checkpoint to resume from it
+
+    Returns:
+        Checkpoint: checkpoint
+    """
+    config = get_config()
+    interval = config.get('checkpoint_interval', 0)
+    if not interval and not resume:
+        return None
+    name = "_".join([strategy.__name__, *quad, run_key([strategy], [model_kwargs], config)])
+    checkpoint = Checkpoint(os.path.join(config.get('checkpoint_dir', 'checkpoints'), name), interval or float('inf'))
+    if not resume:
+        checkpoint.remove()
+    return checkpoint
+
+
+def get_final_checkpoint(strategies: list, quad: tuple, model_kwargs: list) -> Checkpoint:
+    """Final state of the finished backtests of strategies, kept to extend them.
+
+    The directory is named without the final date, so a backtest ending a
+    day later finds the state of the previous one.
+
+    Args:
+        strategies (list): strategy classes to backtest
+        quad (tuple): interval, start date, final date and pair
+        model_kwargs (list): keyword arguments of each strategy
+
+    Returns:
+        Checkpoint: checkpoint
+    """
+    interval, start_date, _, pair = quad
+    config = get_config()
+    name = "_".join(["+".join(strategy.__name__ for strategy in strategies), interval, start_date, pair,
+                     run_key(strategies, model_kwargs, config)])
+    return Checkpoint(os.path.join(config.get('checkpoint_dir', 'checkpoints'), 'final', name), float('inf'))
+
+
+# Settings of config.yaml a saved backtest state depends on
+RUN_CONFIG_KEYS = ('balance', 'check_fee', 'fee_percent', 'include_fee', 'margin_check', 'market_type',
+                   'leverage', 'maintenance_margin')
+
+
+def run_key(strategies: list, model_kwargs: list, config: dict) -> str:
+    """Hash of everything the saved state of a backtest depends on besides its data.
+
+    The parameters, the trading settings of config.yaml and the source of the
+    modules of the strategies, so that a state saved by another version of a
+    strategy or with other fees is never continued.
+
+    Args:
+        strategies (list): strategy classes
+        model_kwargs (list): keyword arguments of each strategy
+        config (dict): config.yaml
+
+    Returns:
+        str: 8 hex digits
+    """
+    key = hashlib.md5(repr([sorted(kwargs.items()) for kwargs in model_kwargs]).encode())
+    key.update(repr([(name, config.get(name)) for name in RUN_CONFIG_KEYS]).encode())
+    for strategy in strategies:
+        try:
+            key.update(inspect.getsource(inspect.getmodule(strategy)).encode())
+        except (OSError, TypeError):
+            # Defined where the source can't be read, e.g. an interactive session
+            key.update(strategy.__qualname__.encode())
+    return key.hexdigest()[:8]
+
+
+def run_signals(strategy: any, quad: tuple, model_kwargs: dict = {}) -> OrderBook:
+    """Backtest a strategy from the signal arrays of its generate_signals method.
+
+    Args:
+        strategy (any): strategy class to backtest
+        quad (tuple): interval, start date, final date and pair
+        model_kwargs (dict): keyword arguments of the strategy
+
+    Returns:
+        OrderBook: order book
+    """
+    interval, start_date, final_date, pair = quad
+    backtester = Backtester(interval=interval, start_date=start_date, final_date=final_date, pair=pair, bind=False)
+    backtester.load_data()
+    order_book = backtester.run_signals(strategy(**model_kwargs))
+    logger.info("Backtester stopped")
+    return order_book
+
+
+def run_parallel(strategy: any, quad: tuple, model_kwargs: dict = {}) -> OrderBook:
+    """Run the strategy over chunks of the data in several processes and stitch the results.
+
+    Args:
+        strategy (any): strategy class to backtest, declaring its warmup
+        quad (tuple): interval, start date, final date and pair
+        model_kwargs (dict): keyword arguments of the strategy
+
+    Returns:
+        OrderBook: order book
+    """
+    if strategy.warmup is None:
+        logger.warning(f"{strategy.__name__} declares no warmup, it runs in one process")
+        return run_inprocess(strategy, quad, model_kwargs)
+    config = get_config()
+    order_book = TimeSlices(quad, config.get('parallel_processes', 0)).run(strategy, model_kwargs, config.get('parallel_verify', 0))
+    logger.info("Backtester stopped")
+    return order_book
+
+
+def run_inprocess_many(strategies: list, quad: tuple, model_kwargs: list, extend: bool = False) -> list:
+    """Run several strategies in the calling thread on one backtester.
+
+    Args:
+        strategies (list): strategy classes to backtest
+        quad (tuple): interval, start date, final date and pair
+        model_kwargs (list): keyword arguments of each strategy
+        extend (bool): only run the bars after the last finished backtest with the same start
+
+    Returns:
+        list: order book of each strategy
+    """
+    interval, start_date, final_date, pair = quad
+    backtester = Backtester(interval=interval, start_date=start_date, final_date=final_date, pair=pair, bind=False)
+    backtester.load_data()
+    final = get_final_checkpoint(strategies, quad, model_kwargs) if extend else None
+    order_books = backtester.run_many([strategy(**kwargs) for strategy, kwargs in zip(strategies, model_kwargs)], final=final)
+    logger.info("Backtester stopped")
+    return order_books
+
+
+def run_portfolio(strategy: any, quad: tuple, model_kwargs: dict = {}) -> dict:
+    """Run one strategy over several pairs against a shared balance.
+
+    Args:
+        strategy (any): strategy class to backtest
+        quad (tuple): interval, start date, final date and list of pairs
+        model_kwargs (dict): keyword arguments of the strategy
+
+    Returns:
+        dict: order book of every pair
+    """
+    interval, start_date, final_date, pairs = quad
+    portfolio = Portfolio(interval=interval, start_date=start_date, final_date=final_date, pairs=pairs)
+    # Single pair strategies get an instance for every pair
+    order_books = portfolio.run(strategy(**model_kwargs) if strategy.portfolio else PerPair(strategy, model_kwargs, pairs))
+    logger.info("Portfolio backtest stopped")
+    return order_books
+
+
+def run_shm(strategy: any, quad: tuple, model_kwargs: dict = {}) -> OrderBook:
+    """Run the strategy in its own process, talking to the backtester over shared memory.
+
+    Args:
+        strategy (any): strategy class to backtest
+        quad (tuple): interval, start date, final date and pair
+        model_kwargs (dict): keyword arguments of the strategy
+
+    Returns:
+        OrderBook: order book
+    """
+    interval, start_date, final_date, pair = quad
+    backtester = Backtester(interval=interval, start_date=start_date, final_date=final_date, pair=pair, bind=False)
+    backtester.load_data()
+    channel = ShmChannel()
+    strategy_process = multiprocessing.Process(target=start_strategy_process, args=(strategy, model_kwargs, channel))
+    strategy_process.start()
+    backtester.start(channel=channel.server_end(strategy_process))
+    order_book = backtester.disconnect()
+    strategy_process.join()
+    channel.close()
+    logger.info("Backtester stopped")
+    return order_book
+
+
+def start_strategy_process(strategy: any, model_kwargs: dict, channel: ShmChannel) -> None:
+    """Start the strategy on the client end of a shared memory channel.
+    This function is the target of the strategy process.
+
+    Args:
+        strategy (any): strategy class
+        model_kwargs (dict): keyword arguments of the strategy
+        channel (ShmChannel): channel created by the backtester process
+    """
+    st = strategy(**model_kwargs)
+    st.connect(channel=channel.client_end())
+    st.disconnect()
+    channel.close()
+
+
+def run_sessions(jobs: list) -> list:
+    """Run many backtests concurrently on one asyncio event loop.
+
+    Every job gets its own Backtester session on a shared AsyncServer and its
+    strategy is driven by an AsyncClient on the same loop, so no thread is
+    started per backtest.
+
+    Args:
+        jobs (list): (strategy, quad, model_kwargs) tuples
+
+    Returns:
+        list: order books, in the order of the jobs
+    """
+    backtesters = []
+    for strategy, quad, model_kwargs in jobs:
+        interval, start_date, final_date, pair = quad
+        backtester = Backtester(interval=interval, start_date=start_date, final_date=final_date, pair=pair, bind=False)
+        backtester.load_data()
+        backtesters.append(backtester)
+    return asyncio.run(_run_sessions(jobs, backtesters))
+
+
+async def _run_sessions(jobs: list, backtesters: list) -> list:
+    server = AsyncServer()
+    await server.start()
+    clients = []
+    for (strategy, quad, model_kwargs), backtester in zip(jobs, backtesters):
+        session = server.register(backtester)
+        client = AsyncClient(strategy(**model_kwargs))
+        clients.append(client.run(server.host, server.port, session=session))
+    await asyncio.gather(*clients)
+    await server.join()
+    logger.info(f"{len(backtesters)} backtester sessions stopped")
+    return [backtester.OrderBook for backtester in backtesters]
+
+
+def start_simulator(data_path: str, return_value:list, ready:queue.Queue) -> None:
     """Start the simulator
 
     Args:
         data_path (str): path to the data
-        return_value (list): list to store the order book
+        return_value (list): list to store the order book, or the error the backtest stopped on
+        ready (queue.Queue): receives the port and session token once the
+            simulator is listening, or None if it failed to start
 
     Returns:
         list: order book
     """
-    simulator = Simulator(data_path=data_path)
-    simulator.load_data()
+    try:
+        simulator = Simulator(data_path=data_path)
+        simulator.load_data()
+    except Exception:
+        ready.put(None)
+        raise
+    ready.put((simulator.port, simulator.session))
     simulator.start()
     order_book = simulator.disconnect()
     logger.info("Simulator stopped")
@@ -272,26 +604,184 @@ def generate_survivorship_bias_report(base_path: str, results: dict) -> None:
     pass
 
 
-def _backtest(strategy: any, base_path: str, quad: tuple, verbose:bool = False, model_kwargs:dict = {}) -> dict:
+def _backtest(strategy: any, base_path: str, quad: tuple, verbose:bool = False, model_kwargs:dict = {}, engine:str = None, resume:bool = False, extend:bool = False) -> dict:
+    interval, start, end, pair = quad
+    # inprocess: strategy is called directly by the backtester
+    # signals: strategy's generate_signals is evaluated once, only bars with
+    # a signal or an SL/TP hit go through the order book
+    # shm: strategy runs in its own process, connected through shared memory
+    # asyncio: strategy and backtester are sessions on an asyncio event loop
+    # parallel: strategy runs over chunks of the data in several processes
+    # socket: strategy runs as a client connected to the backtester server
+    if engine is None:
+        engine = get_config().get('engine', 'socket')
+    if (resume or extend) and engine != 'inprocess':
+        logger.warning(f"Only the inprocess engine takes checkpoints, the {engine} engine starts over")
+    if engine == 'inprocess':
+        order_book = run_inprocess(strategy, quad, model_kwargs, resume, extend)
+    elif engine == 'signals':
+        order_book = run_signals(strategy, quad, model_kwargs)
+    elif engine == 'shm':
+        order_book = run_shm(strategy, quad, model_kwargs)
+    elif engine == 'asyncio':
+        order_book = run_sessions([(strategy, quad, model_kwargs)])[0]
+    elif engine == 'parallel':
+        order_book = run_parallel(strategy, quad, model_kwargs)
+    else:
+        return_value = []
+        ready = queue.Queue()
+        backtester_thread = threading.Thread(target=start_backtester, args=(interval, start, end, pair, return_value, ready))
+        backtester_thread.start()
+        address = ready.get()
+        if address is None:
+            backtester_thread.join()
+            raise RuntimeError("Backtester could not be started")
+        port, session = address
+        kwargs = {"strategy": strategy, "model_kwargs": model_kwargs, "port": port, "session": session}
+        strategy_thread = threading.Thread(target=start_strategy, kwargs=kwargs)
+        strategy_thread.start()
+        backtester_thread.join()
+        strategy_thread.join()
+        order_book = return_value[0]
+        if isinstance(order_book, Exception):
+            raise order_book
+    return _analyse_backtest(order_book, base_path, quad, verbose, model_kwargs)
+
+
+def _backtest_many(strategies: list, base_paths: list, quad: tuple, verbose:bool = False, model_kwargs:list = None, extend:bool = False) -> list:
+    """Backtest several strategies on a single pass over the data.
+
+    The data is loaded once and every bar is fanned out to all the strategies
+    in the calling thread, each one trading on its own order book.
+
+    Args:
+        strategies (list): strategy classes to backtest
+        base_paths (list): result directory of each strategy
+        quad (tuple): interval, start date, final date and pair
+        verbose (bool): print the metrics of each strategy
+        model_kwargs (list): keyword arguments of each strategy
+        extend (bool): only run the bars after the last finished backtest with the same start
+
+    Returns:
+        list: (metrics, order book) of each strategy
+    """
+    if model_kwargs is None:
+        model_kwargs = [{} for _ in strategies]
+    order_books = run_inprocess_many(strategies, quad, model_kwargs, extend)
+    return [_analyse_backtest(order_book, base_path, quad, verbose, kwargs)
+            for order_book, base_path, kwargs in zip(order_books, base_paths, model_kwargs)]
+
+
+def _backtest_benchmark(strategies: list, base_paths: list, benchmark: list, pair: str) -> list:
+    """Backtest strategies over benchmark windows ending on the same day.
+
+    The longest window is loaded once and the others are views of its arrays
+    (see Backtester.view), backtested concurrently in forked processes.
+    Engines other than inprocess, streamed datasets and platforms without
+    fork backtest every window from its own dataset.
+
+    Args:
+        strategies (list): strategy classes to backtest
+        base_paths (list): result directory of each strategy
+        benchmark (list): interval, start date and final date of every window
+        pair (str): pair to backtest
+
+    Returns:
+        list: (metrics, order book) of each strategy, for every window
+    """
+    config = get_config()
+    # Only anchored windows start where the backtests of the previous day did
+    extend = config.get('benchmark_anchored', False)
+    if (config.get('chunk_size', 0) or 'fork' not in multiprocessing.get_all_start_methods()
+            or (len(strategies) == 1 and config.get('engine', 'socket') != 'inprocess')):
+        if len(strategies) == 1:
+            return [[_backtest(strategies[0], base_paths[0], (interval, start, final, pair), verbose=True, extend=extend)]
+                    for interval, start, final in benchmark]
+        return [_backtest_many(strategies, base_paths, (interval, start, final, pair), verbose=True, extend=extend)
+                for interval, start, final in benchmark]
+    interval, _, final = benchmark[0]
+    first = min(start for _, start, _ in benchmark)
+    backtester = Backtester(interval=interval, start_date=first, final_date=final, pair=pair, bind=False)
+    backtester.load_data()
+    _benchmark_data['backtester'] = backtester
+    quads = [(interval, start, final, pair) for _, start, _ in benchmark]
+    try:
+        with ProcessPoolExecutor(max_workers=config.get('parallel_processes', 0) or None,
+                                 mp_context=multiprocessing.get_context('fork')) as pool:
+            results = list(pool.map(_benchmark_window, repeat(strategies), repeat(base_paths), quads))
+    finally:
+        _benchmark_data.clear()
+    # The workers send the order books back without the data
+    for quad, window_results in zip(quads, results):
+        df = backtester.view(quad[1]).df
+        for _, order_book in window_results:
+            order_book.df = df
+    return results
+
+
+def _benchmark_window(strategies: list, base_paths: list, quad: tuple) -> list:
+    """Backtest strategies over one window of the data loaded by _backtest_benchmark."""
+    backtester = _benchmark_data['backtester'].view(quad[1])
+    model_kwargs = [{} for _ in strategies]
+    final = get_final_checkpoint(strategies, quad, model_kwargs) if get_config().get('benchmark_anchored', False) else None
+    order_books = backtester.run_many([strategy() for strategy in strategies], final=final)
+    results = [_analyse_backtest(order_book, base_path, quad, True, kwargs)
+               for order_book, base_path, kwargs in zip(order_books, base_paths, model_kwargs)]
+    for _, order_book in results:
+        order_book.df = None
+    return results
+
+
+def _backtest_sweep(strategy: any, base_paths: list, quad: tuple, model_kwargs: list, verbose:bool = False) -> list:
+    """Backtest one strategy with several sets of parameters in a single strategy process.
+
+    Args:
+        strategy (any): strategy class to backtest
+        base_paths (list): result directory of each parameter set
+        quad (tuple): interval, start date, final date and pair
+        model_kwargs (list): keyword arguments of each run
+        verbose (bool): print the metrics of each run
+
+    Returns:
+        list: (metrics, order book) of each run
+    """
+    session = StrategySession(strategy)
+    results = []
+    try:
+        for base_path, kwargs in zip(base_paths, model_kwargs):
+            # export_csv matches these lines to the results folder that follows
+            logger.info(f"Model kwargs: {kwargs}")
+            order_book = session.run(quad, kwargs)
+            results.append(_analyse_backtest(order_book, base_path, quad, verbose, kwargs))
+    finally:
+        session.close()
+    return results
+
+
+def _backtest_portfolio(strategy: any, base_path: str, quad: tuple, verbose:bool = False, model_kwargs:dict = {}) -> dict:
+    """Backtest one strategy over several pairs as one portfolio.
+
+    Every pair is analysed on its own, in its own results folder under
+    base_path, while all of them traded against the same balance.
+
+    Args:
+        strategy (any): strategy class to backtest
+        base_path (str): result directory of the portfolio
+        quad (tuple): interval, start date, final date and list of pairs
+        verbose (bool): print the metrics of each pair
+        model_kwargs (dict): keyword arguments of the strategy
+
+    Returns:
+        dict: (metrics, order book) of every pair
+    """
+    interval, start, end, pairs = quad
+    order_books = run_portfolio(strategy, quad, model_kwargs)
+    return {pair: _analyse_backtest(order_book, base_path, (interval, start, end, pair), verbose, model_kwargs)
+            for pair, order_book in order_books.items()}
+
+
+def _analyse_backtest(order_book: OrderBook, base_path: str, quad: tuple, verbose:bool, model_kwargs:dict) -> tuple:
     interval, start, end, pair = quad
-    return_value = []
-    ready_value = []
-    backtester_thread = threading.Thread(target=start_backtester, args=(interval, start, end, pair, return_value, ready_value))
-    kwargs = {"strategy": strategy, "model_kwargs": model_kwargs}
-    strategy_thread = threading.Thread(target=start_strategy, kwargs=kwargs)
-    backtester_thread.start()
-
-    while len(ready_value) == 0:
-        try:
-            if ready_value != [] and ready_value[0]:
-                break
-        except:
-            sleep(1)
-    sleep(2)
-    strategy_thread.start()
-    backtester_thread.join()
-    strategy_thread.join()
-    order_book = return_value[0]
     order_book.set_stop_loss(model_kwargs["stop_loss"] if "stop_loss" in model_kwargs and model_kwargs["stop_loss"] else 0.0)
     fig_save_path = ensure_dir(os.path.join(base_path, "backtest_{}_{}_{}_{}".format(interval, pair, start, end)))
     M = analysis(order_book=order_book, cumulative_results=None, save_path=fig_save_path, verbose=verbose)
@@ -449,8 +939,8 @@ def start_strategy(**kwargs):
     model_kwargs = kwargs["model_kwargs"]
     # create an instance of the strategy
     st = strategy(**model_kwargs)
-    # start the strategy
-    st.connect()
+    # start the strategy on the port and session handed out by the server
+    st.connect(port=kwargs.get("port"), session=kwargs.get("session"))
     st.disconnect()
 
 def is_valid_date(date: str) -> bool:
@@ -41,6 +41,14 @@ class BinanceSpot:
     def get_columns(self):
         return ['date','open','high','low','close','volume','close time','quote asset volume','number of trades','taker buy base asset volume','taker buy quote asset volume','ignore']
 
+    def has_header(self):
+        # The processed csv is written without a header row
+        return False
+
+    def day_start(self, date):
+        """Open time in epoch seconds of the first bar of date, daily files start at midnight UTC."""
+        return int(pd.Timestamp(date, tz='UTC').timestamp())
+
     def get_path(self):
         if self.concat_path == None:
             raise Exception("DataCollector has not been initialized yet.")
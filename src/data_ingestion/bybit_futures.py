@@ -66,6 +66,14 @@ class BybitFutures:
     def get_columns(self):
             return ['structured_date','date', 'open', 'high', 'low', 'close', 'volume', 'turnover']
 
+    def has_header(self):
+        return True
+
+    def day_start(self, date):
+        """Open time in epoch seconds of the first bar of date, days are fetched from local midnight."""
+        year, month, day = date.split('-')
+        return int(dt(int(year), int(month), int(day)).timestamp())
+
     def get_path(self):
         if self.concat_path == None:
             raise Exception("DataCollector has not been initialized yet.")
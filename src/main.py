@@ -13,7 +13,7 @@ handle_strategy_folder_exceptions()
 # Continue importing
 from _logger import init_logger
 from _utils import select_strategy, backtest, simulate, open_browser, \
-        backtest_benchmark, available_strategies, survivorship_bias, _backtest, select_strategy_with_name
+        backtest_benchmark, backtest_benchmark_many, available_strategies, survivorship_bias, _backtest, _backtest_sweep, _backtest_portfolio, select_strategy_with_name
 from time import sleep
 from argparse import ArgumentParser
 
@@ -40,17 +40,39 @@ parser.add_argument('-b', '--beginning_date', help='Specify the beginning date t
 # End date
 parser.add_argument('-ed', '--end_date', help='Specify the end date to be used.')
 # Pair 
-parser.add_argument('-p', '--pair', help='Specify the pair to be used.')
+parser.add_argument('-p', '--pair', help='Specify the pair to be used. Comma separated pairs are backtested as one portfolio.')
 # Temporarily enable an option to pass stop loss to strategy (optional)
-parser.add_argument('-mp', '--model_parameters', help='Specify the model parameters to be used.')
+parser.add_argument('-mp', '--model_parameters', action='append', help='Specify the model parameters to be used. Repeat it to run a parameter sweep in one strategy process.')
+# Engine (optional), overrides the engine in config.yaml
+parser.add_argument('-en', '--engine', choices=['inprocess', 'signals', 'shm', 'asyncio', 'socket', 'parallel'], help='Specify the backtest engine to be used.')
+# Resume (optional), continue an interrupted backtest from its last checkpoint
+parser.add_argument('--resume', action='store_true', help='Continue the backtest from its last checkpoint (inprocess engine, see checkpoint_interval in config.yaml).')
+# Extend (optional), run only the bars added since the last finished backtest
+parser.add_argument('--extend', action='store_true', help='Only run the bars after the last finished backtest with the same start (inprocess engine).')
 
 
 # Example usage
 # python src/main.py -s FibonacciRetracements -e bybit -m futures -t 1h -b 2023-06-01 -ed 2023-06-07 -p BTCUSDT
+# python src/main.py -s FibonacciRetracements -e bybit -m futures -t 1h -b 2023-06-01 -ed 2023-06-07 -p BTCUSDT,ETHUSDT,SOLUSDT
 
 def parse_args():
     # Parse arguments
     args = parser.parse_args()
+    # A parameter sweep runs every set of parameters in one strategy process
+    # over shared memory, without checkpoints
+    if len(args.model_parameters or []) > 1:
+        if args.engine not in (None, 'shm'):
+            parser.error(f"a parameter sweep (-mp given more than once) runs on the shm engine, not {args.engine}")
+        if args.resume or args.extend:
+            parser.error("a parameter sweep (-mp given more than once) can't --resume or --extend")
+    # A portfolio runs in the calling thread, every pair against one balance
+    if args.pair is not None and ',' in args.pair:
+        if len(args.model_parameters or []) > 1:
+            parser.error("a parameter sweep (-mp given more than once) runs on one pair, not a portfolio")
+        if args.engine not in (None, 'inprocess'):
+            parser.error(f"a portfolio (comma separated pairs) runs on the inprocess engine, not {args.engine}")
+        if args.resume or args.extend:
+            parser.error("a portfolio (comma separated pairs) can't --resume or --extend")
 
 
     # If strategy is given, check if it is available
@@ -143,17 +165,32 @@ def parse_args():
             strategy = select_strategy_with_name(strategy_name)
             # usage is: -mp param1 value1 param2 value2 ... paramN valueN
             model_kwargs = {}
-            if args.model_parameters:
+            model_kwargs_list = []
+            for model_parameters in args.model_parameters or []:
                 model_kwargs = {}
-                args.model_parameters = args.model_parameters.split()
-                for i in range(0,len(args.model_parameters),2):
-                    model_kwargs[args.model_parameters[i]] = eval(args.model_parameters[i+1])
-
+                model_parameters = model_parameters.split()
+                for i in range(0,len(model_parameters),2):
+                    model_kwargs[model_parameters[i]] = eval(model_parameters[i+1])
+                model_kwargs_list.append(model_kwargs)
+
+            if strategy and len(model_kwargs_list) > 1:
+                # Every parameter set gets its own results folder
+                base_paths = [f"{base_path}-{i}" for i in range(len(model_kwargs_list))]
+                _backtest_sweep(strategy=strategy, base_paths=base_paths,
+                                quad=(time_interval, beginning_date, end_date, pair),
+                                model_kwargs=model_kwargs_list, verbose=True)
+                sys.exit(0)
             logger.info(f"Model kwargs: {model_kwargs}")
+            if strategy and ',' in pair:
+                # All pairs trade against one balance in a single run
+                _backtest_portfolio(strategy=strategy, base_path=base_path,
+                                    quad=(time_interval, beginning_date, end_date, pair.split(',')),
+                                    verbose=True, model_kwargs=model_kwargs)
+                sys.exit(0)
             if strategy:
                 order_book = _backtest(strategy=strategy, base_path=base_path, 
                                     quad=(time_interval, beginning_date, end_date, pair), 
-                                    verbose=True, model_kwargs=model_kwargs)
+                                    verbose=True, model_kwargs=model_kwargs, engine=args.engine, resume=args.resume, extend=args.extend)
             else:
                 raise Exception("Strategy is not found.")
             sys.exit(0)
@@ -351,27 +388,26 @@ you can check the README.md file on the GitHub repository.
             if ans == 'y':
                 logger.info("************* Benchmark backtesting all the strategies *************")
                 avail_strats = available_strategies()
-                for strategy in avail_strats:
-                    print(f"\033[1;31;38m************* Backtesting {strategy.__name__} *************\033[0m")
-                    if strategy != '__pycache__' and strategy != '__init__.py':
-                        strategy_selected = False
-                        current_time = datetime.datetime.now().strftime("%Y-%m-%d-%H-%M-%S")
-                        base_path = None 
-                        config = {
-                            'strategy' : strategy.__name__,
-                            'state': 'info'}
-                        # initialize logger
-                        logger = init_logger(config=config)
-                        logger = logging.getLogger('IPC')
-                        base_path = os.path.join("results", exchange.capitalize() + "_" + market_type.capitalize(),f"{strategy.__name__}", f"simtest-{current_time}")
-                        strategy_selected = True
-                        logger.info("BENCHMARK SETTINGS: [12-9-6-3-1 Months, 2 weeks and 3 days] periods, with the specified time interval i.e [1m, 15m, 30m, 1h...]:")
-                        order_book_list,performance = backtest_benchmark(strategy=strategy, base_path=base_path)
-                        try:
-                            if performance >= 60:
-                                best_performing_strategies.append((strategy.__name__,performance))
-                        except Exception as e:
-                            print(e)
+                current_time = datetime.datetime.now().strftime("%Y-%m-%d-%H-%M-%S")
+                # All strategies are fed from one data pass, so they share one log
+                config = {
+                    'strategy' : 'FullBacktest',
+                    'state': 'info'}
+                # initialize logger
+                logger = init_logger(config=config)
+                logger = logging.getLogger('IPC')
+                base_paths = [os.path.join("results", exchange.capitalize() + "_" + market_type.capitalize(),f"{strategy.__name__}", f"simtest-{current_time}") for strategy in avail_strats]
+                print(f"\033[1;31;38m************* Backtesting {', '.join(strategy.__name__ for strategy in avail_strats)} *************\033[0m")
+                logger.info("BENCHMARK SETTINGS: [12-9-6-3-1 Months, 2 weeks and 3 days] periods, with the specified time interval i.e [1m, 15m, 30m, 1h...]:")
+                # export_csv reads the parameters of every strategy's results from this log
+                logger.info("Model kwargs: {}")
+                order_book_lists, performances = backtest_benchmark_many(strategies=avail_strats, base_paths=base_paths)
+                for strategy, performance in zip(avail_strats, performances):
+                    try:
+                        if performance >= 60:
+                            best_performing_strategies.append((strategy.__name__,performance))
+                    except Exception as e:
+                        print(e)
         elif choice == '10':
             print("\033[1;31;38mSimTest will try to open the dasboard, but this won't work unless you run the report.py file in parallel.\033[0m")
             logger.info("Opening browser...")
@@ -0,0 +1,135 @@
+import os
+import sys
+import threading
+
+import numpy as np
+import pandas as pd
+import pytest
+
+# The modules of the backtester import each other from src
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src'))
+import data_ingestion.binance_futures
+import data_ingestion.binance_spot
+import data_ingestion.bybit_futures
+from _backtester import Backtester
+from _base_strategy import BaseStrategy
+from _orders import OpenLong, OpenShort, CloseLong, CloseShort
+
+# 2023-01-01 00:00 UTC
+START = 1672531200
+QUAD = ('1m', '2023-01-01', '2023-01-02', 'BTCUSDT')
+
+
+class SyntheticData:
+    """Stands in for the data collectors, reads the csv the market fixture wrote for the pair."""
+    paths = {}
+
+    def __init__(self, start_date, final_date, interval, pair):
+        self.pair = pair
+
+    def get_path(self):
+        return self.paths[self.pair]
+
+    def get_columns(self):
+        return ['date', 'open', 'high', 'low', 'close', 'volume']
+
+    def has_header(self):
+        return True
+
+
+@pytest.fixture
+def market(tmp_path, monkeypatch):
+    """Write a random walk of 1m bars for a pair, every Backtester built in the test reads it.
+
+    Returns:
+        function: market(pair, bars, seed, start) writes the bars of pair
+    """
+    monkeypatch.setattr(SyntheticData, 'paths', {})
+    for module, name in ((data_ingestion.binance_futures, 'BinanceFutures'),
+                         (data_ingestion.binance_spot, 'BinanceSpot'),
+                         (data_ingestion.bybit_futures, 'BybitFutures')):
+        monkeypatch.setattr(module, name, SyntheticData)
+
+    def write(pair='BTCUSDT', bars=2000, seed=0, start=START):
+        random = np.random.default_rng(seed)
+        close = 100 * np.exp(np.cumsum(random.normal(0, 0.002, bars)))
+        open = np.r_[close[0], close[:-1]]
+        spread = np.abs(random.normal(0, 0.001, (2, bars))) * close
+        df = pd.DataFrame({'date': (start + 60 * np.arange(bars)) * 1000,
+                           'open': open, 'high': np.maximum(open, close) + spread[0],
+                           'low': np.minimum(open, close) - spread[1], 'close': close,
+                           'volume': random.uniform(1, 10, bars)})
+        path = tmp_path / f'{pair}.csv'
+        df.to_csv(path, index=False)
+        SyntheticData.paths[pair] = str(path)
+        return pair
+    return write
+
+
+def backtester(quad=QUAD, bind=False):
+    interval, start_date, final_date, pair = quad
+    backtester = Backtester(interval=interval, start_date=start_date, final_date=final_date, pair=pair, bind=bind)
+    backtester.load_data()
+    return backtester
+
+
+def run_socket(backtester, strategy):
+    """Run the strategy as a client of the backtester over TCP, as the socket engine does."""
+    client = threading.Thread(target=lambda: (strategy.connect(port=backtester.port, session=backtester.session),
+                                              strategy.disconnect()))
+    client.start()
+    backtester.start()
+    order_book = backtester.disconnect()
+    client.join()
+    return order_book
+
+
+def outcome(order_book):
+    """Order history and totals of a finished backtest, equal for runs that filled the same orders."""
+    history = [(order.order_id, order.order_type, str(order.order_time), order.order_price, order.order_size)
+               for order in order_book.order_history]
+    return (history, order_book.balance, order_book.paid_fee,
+            order_book.sl_triggered_order_count, order_book.liquidated_order_count)
+
+
+class Crossing(BaseStrategy):
+    """Moving average crossing with SL/TP, decided bar by bar or over the whole DataFrame alike."""
+    def __init__(self, fast=5, slow=20, size=50.0, SL=0.3, TP=0.6):
+        super().__init__()
+        self.fast, self.slow, self.size, self.SL, self.TP = fast, slow, size, SL, TP
+        self.closes = []
+        self.trend = 0
+        self.order_id = 0
+        # Orders opened since the last exit of each side
+        self.opened = {'long': [], 'short': []}
+
+    def direction(self, closes):
+        # 1 while the fast average is above the slow one, -1 below, 0 before the slow one has its bars
+        if len(closes) < self.slow:
+            return 0
+        return int(np.sign(sum(closes[-self.fast:]) / self.fast - sum(closes[-self.slow:]) / self.slow))
+
+    def on_receive(self, data):
+        self.closes = (self.closes + [data['price']])[-self.slow:]
+        trend = self.direction(self.closes)
+        time, price = data['time'], data['price']
+        orders = []
+        if trend and trend != self.trend:
+            side, Close, other, Open = ('long', CloseShort, 'short', OpenLong) if trend == 1 else ('short', CloseLong, 'long', OpenShort)
+            orders += [Close(order_id, time, price, self.size).to_dict() for order_id in self.opened[other]]
+            self.opened[other] = []
+            self.order_id += 1
+            self.opened[side].append(self.order_id)
+            orders.append(Open(self.order_id, time, price, self.size, self.SL, self.TP).to_dict())
+        self.trend = trend
+        self.send({'message': 'ORDERLIST', 'data': orders})
+
+    def generate_signals(self, df):
+        closes = df['close'].tolist()
+        trend = np.array([self.direction(closes[max(0, tick + 1 - self.slow):tick + 1]) for tick in range(len(closes))])
+        previous = np.r_[0, trend[:-1]]
+        long_entries = (trend == 1) & (previous != 1)
+        short_entries = (trend == -1) & (previous != -1)
+        return {'long_entries': long_entries, 'short_entries': short_entries,
+                'long_exits': short_entries, 'short_exits': long_entries,
+                'size': self.size, 'SL': self.SL, 'TP': self.TP}
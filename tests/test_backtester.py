@@ -0,0 +1,49 @@
+from collections import deque
+import logging
+import threading
+
+import pytest
+
+from _backtester import Backtester
+from _orders import OrderBook
+from _stats import TransportStats
+from conftest import Crossing, backtester, outcome, run_socket
+
+
+def batching_backtester(*firsts):
+    """Backtester with one batch of a bar in flight for every first tick."""
+    backtester = Backtester.__new__(Backtester)
+    backtester.logger = logging.getLogger('Backtester')
+    backtester.stats = TransportStats()
+    backtester.server_socket = backtester.client_socket = None
+    backtester.OrderBook = OrderBook()
+    backtester.ending, backtester.error, backtester.is_running = False, None, True
+    backtester.in_flight = deque([[{'tick': tick, 'time': str(tick), 'data': {'open': 1.0, 'high': 1.0, 'low': 1.0, 'close': 1.0}}]
+                                  for tick in firsts])
+    backtester.receive_thread = threading.Thread(target=lambda: None)
+    backtester.receive_thread.start()
+    return backtester
+
+
+def test_batch_reply_out_of_order_stops_the_session():
+    backtester = batching_backtester(0, 16)
+    backtester.on_receive({'message': 'ORDERLIST', 'seq': 16, 'data': []})
+    assert not backtester.is_running
+    with pytest.raises(ValueError, match='expected batch 0'):
+        backtester.disconnect()
+
+
+class BatchedCrossing(Crossing):
+    batching = True
+
+
+@pytest.mark.parametrize('batch_size, window', [(1, 4), (8, 4), (16, 1)])
+def test_batched_run_fills_the_orders_of_the_bar_by_bar_run(market, batch_size, window):
+    market()
+    bar_by_bar = outcome(run_socket(backtester(bind=True), Crossing()))
+    batched = backtester(bind=True)
+    batched.max_batch_size, batched.max_window = batch_size, window
+    assert outcome(run_socket(batched, BatchedCrossing())) == bar_by_bar
+    # The strategy asked for batches, they were sent
+    assert (batched.batch_size, batched.window) == (batch_size, window)
+    assert batched.stats.to_dict()['round_trip']['count'] == -(-len(batched.feed) // batch_size)
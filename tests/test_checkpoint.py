@@ -0,0 +1,39 @@
+import logging
+import os
+import threading
+
+from _checkpoint import Checkpoint
+from _orders import OrderBook, OpenLong
+
+
+def stop_out(book, time):
+    book.add_order(OpenLong(1, time, 100.0, 1.0, SL=5))
+    book.update_price({'open': 100.0, 'high': 100.0, 'low': 90.0, 'close': 100.0}, time)
+
+
+def test_restore_truncates_the_history_of_an_unfinished_checkpoint(tmp_path):
+    book = OrderBook()
+    stop_out(book, '0')
+    checkpoint = Checkpoint(str(tmp_path), 0)
+    checkpoint.save({'tick': 1, 'strategies': []}, [book])
+    size = os.path.getsize(tmp_path / 'history-0.pkl')
+    # A later checkpoint that appended its history and stopped
+    stop_out(book, '1')
+    checkpoint.save({'tick': 2, 'strategies': [threading.Lock()]}, [book])
+    assert os.path.getsize(tmp_path / 'history-0.pkl') > size
+
+    restored = OrderBook()
+    checkpoint = Checkpoint(str(tmp_path), 0)
+    checkpoint.restore(checkpoint.load(), [restored])
+    assert os.path.getsize(tmp_path / 'history-0.pkl') == size
+    assert len(restored.order_history) == 2
+    assert checkpoint.load()['tick'] == 1
+
+
+def test_unpicklable_strategy_attribute_disables_checkpoints(tmp_path, caplog):
+    checkpoint = Checkpoint(str(tmp_path), 0)
+    with caplog.at_level(logging.ERROR):
+        checkpoint.save({'tick': 1, 'strategies': [{'window': 5}, {'lock': threading.Lock()}]}, [OrderBook()])
+    assert "attribute 'lock' of strategy 1" in caplog.text
+    assert not checkpoint.due()
+    assert checkpoint.load() is None
@@ -0,0 +1,9 @@
+from conftest import QUAD, Crossing, backtester, outcome, run_socket
+
+
+def test_signals_engine_fills_the_orders_of_on_receive(market):
+    market()
+    bar_by_bar = outcome(backtester().run(Crossing()))
+    assert outcome(backtester().run_signals(Crossing())) == bar_by_bar
+    history, balance, fees, stop_losses, liquidations = bar_by_bar
+    assert len(history) > 100 and stop_losses
@@ -0,0 +1,142 @@
+import numpy as np
+import pytest
+
+from _orders import OrderBook, OpenLong, OpenShort, CloseLong, CloseShort, Ledger, OPEN_LONG, OPEN_SHORT
+
+
+def futures_book(leverage, Book=OrderBook):
+    book = Book()
+    book.futures = True
+    book.check_margin = False
+    book.fee_percent = 0.0
+    book.fee_included = False
+    book.maintenance_margin = 0.005
+    book.set_leverage(leverage)
+    return book
+
+
+def bar(low, high):
+    return {'open': 100.0, 'high': high, 'low': low, 'close': 100.0}
+
+
+def test_liquidation_before_far_stop_loss():
+    book = futures_book(100)
+    book.add_order(OpenLong(1, '0', 100.0, 10.0, SL=5))
+    liquidation = book.margins[1][2]
+    assert 99 < liquidation < 100
+    book.update_price(bar(94.0, 100.0), '60')
+    assert book.liquidated_order_count == 1
+    assert book.sl_triggered_order_count == 0
+    assert Ledger.REASONS[book.ledger.reason[0]] == 'LIQ'
+    assert book.ledger.close_price[0] == pytest.approx(liquidation)
+    # The loss stays within the margin posted
+    assert -10.0 <= book.ledger.pnl[0] < 0
+
+
+def test_stop_loss_before_liquidation():
+    book = futures_book(10)
+    book.add_order(OpenShort(1, '0', 100.0, 10.0, SL=5))
+    assert book.margins[1][2] > 105
+    book.update_price(bar(100.0, 120.0), '60')
+    assert book.liquidated_order_count == 0
+    assert book.sl_triggered_order_count == 1
+    assert book.ledger.close_price[0] == pytest.approx(105.0)
+
+
+def test_no_liquidation_without_leverage():
+    book = futures_book(1)
+    book.add_order(OpenShort(1, '0', 100.0, 10.0))
+    assert book.margins[1][2] is None
+    book.update_price(bar(100.0, 250.0), '60')
+    assert book.liquidated_order_count == 0
+    assert 1 in book.open_orders
+
+
+def test_extremes_of_the_open_orders():
+    book = futures_book(1)
+    book.update_price(dict(bar(100.0, 100.0), close=100.0), '0')
+    book.add_order(OpenLong(1, '0', 100.0, 10.0))
+    cost = book.position_cost()
+    assert book.max_position_cost == pytest.approx(cost)
+    assert book.max_position_size == pytest.approx(cost / 100.0)
+    # A close counts once the next bar comes in
+    book.update_price(dict(bar(90.0, 100.0), close=90.0), '60')
+    assert book.max_unrealized_loss == 0.0
+    book.update_price(dict(bar(90.0, 100.0), close=95.0), '120')
+    assert book.max_unrealized_loss == pytest.approx(-cost * 0.1)
+    # Bars skipped over are marked at their lowest and highest close
+    book.mark_bars(np.array([99.0, 80.0, 120.0]))
+    assert book.max_unrealized_loss == pytest.approx(-cost * 0.2)
+
+
+class ScanBook(OrderBook):
+    """OrderBook checking every open order on every bar, as it did before the trigger heaps."""
+    def handle_SL_TP(self, ohlcv, time):
+        low, high = ohlcv['low'], ohlcv['high']
+        for id, order in list(self.open_orders.items()):
+            liquidation = self.margins[id][2]
+            SL, TP = order.order_SL_price, order.order_TP_price
+            if order.code == OPEN_LONG:
+                Close, side = CloseLong, 'long'
+                liquidated = liquidation is not None and low <= liquidation and (SL is None or liquidation > SL)
+                stopped, taken = SL is not None and low <= SL, TP is not None and high >= TP
+            else:
+                Close, side = CloseShort, 'short'
+                liquidated = liquidation is not None and high >= liquidation and (SL is None or liquidation < SL)
+                stopped, taken = SL is not None and high >= SL, TP is not None and low <= TP
+            if liquidated:
+                self.handle_margin_call(order, time)
+            elif stopped or taken:
+                close_order = Close(id, time, SL if stopped else TP, order.order_size)
+                self.order_history.append(self.fill_close_order(close_order, 'SL' if stopped else 'TP'))
+                self.sl_tp_triggered_orders.add(id)
+                if stopped:
+                    self.sl_triggered_order_count += 1
+                    name = f'sl_triggered_order_count_{side}'
+                    setattr(self, name, getattr(self, name) + 1)
+
+
+def scanned_levels(book):
+    """Level of the open order hit first for every heap of next_levels, found by a scan."""
+    levels = {}
+    for name, sign in book.KEY_SIGNS.items():
+        side, kind = name.split('_')
+        code = OPEN_LONG if side == 'long' else OPEN_SHORT
+        prices = [book.margins[id][2] if kind == 'liq' else getattr(order, f'order_{kind}_price')
+                  for id, order in book.open_orders.items() if order.code == code]
+        prices = [price for price in prices if price is not None]
+        levels[name] = sign * min(sign * price for price in prices) if prices else None
+    return levels
+
+
+@pytest.mark.parametrize('leverage', [1, 20])
+def test_trigger_heaps_fill_what_a_scan_of_the_open_orders_fills(leverage):
+    heap, scan = futures_book(leverage), futures_book(leverage, ScanBook)
+    heap.fee_percent = scan.fee_percent = 0.0005
+    random = np.random.default_rng(1)
+    price, order_id = 100.0, 0
+    for tick in range(3000):
+        open = price
+        price = round(price * np.exp(random.normal(0, 0.004)), 1)
+        ohlcv = {'open': open, 'high': max(open, price) + 0.1, 'low': min(open, price) - 0.1, 'close': price}
+        orders = []
+        # Several orders at the same levels, some closed while still in the heaps
+        for _ in range(random.integers(0, 3)):
+            order_id += 1
+            Open = OpenLong if random.random() < 0.5 else OpenShort
+            orders.append(Open(order_id, str(tick), price, 1.0, random.choice([None, 0.5, 1.0]), random.choice([None, 0.5, 2.0])))
+        if heap.open_orders and random.random() < 0.2:
+            id = random.choice(list(heap.open_orders))
+            Close = CloseLong if heap.open_orders[id].code == OPEN_LONG else CloseShort
+            orders.append(Close(id, str(tick), price, 1.0))
+        for book in (heap, scan):
+            book.update_price(ohlcv, str(tick))
+            for order in orders:
+                book.add_order(order)
+        assert heap.next_levels() == scanned_levels(scan)
+    assert [(order.order_id, order.order_type, order.order_price) for order in heap.order_history] == \
+           [(order.order_id, order.order_type, order.order_price) for order in scan.order_history]
+    assert len(heap.order_history) > 2000 and heap.sl_triggered_order_count > 100
+    for counter in ('balance', 'paid_fee', 'sl_triggered_order_count', 'sl_triggered_order_count_long',
+                    'sl_triggered_order_count_short', 'liquidated_order_count'):
+        assert getattr(heap, counter) == getattr(scan, counter)
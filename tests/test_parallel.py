@@ -0,0 +1,28 @@
+import numpy as np
+
+from _parallel import Slice, TimeSlices
+
+
+def chunk(record, stop, balances, margins):
+    """Slice flat at every bar with these balances and margin checks since the previous bar."""
+    run = Slice(record, record, stop)
+    run.counters[:, 0] = balances
+    run.margins[:] = margins
+    return run
+
+
+def test_margins_hold_within_the_balance_shift():
+    first = chunk(0, 2, [100.0, 90.0, 80.0], [(np.inf, -np.inf), (5.0, -np.inf), (np.inf, -np.inf)])
+    # Started with the whole wallet, 20 more than the first chunk left
+    second = chunk(2, 4, [100.0, 100.0, 100.0], [(np.inf, -np.inf), (25.0, -30.0), (np.inf, -np.inf)])
+    assert TimeSlices.margins_hold([(first, 0, 2), (second, 2, 4)])
+
+
+def test_margins_fail_when_the_balance_shift_flips_a_check():
+    first = chunk(0, 2, [100.0, 90.0, 80.0], [(np.inf, -np.inf)] * 3)
+    # Passed with 10 left, it is short by 10 with 20 less
+    second = chunk(2, 4, [100.0, 100.0, 100.0], [(np.inf, -np.inf), (10.0, -np.inf), (np.inf, -np.inf)])
+    assert not TimeSlices.margins_hold([(first, 0, 2), (second, 2, 4)])
+    # Short by 10, it passes with 20 more
+    second = chunk(2, 4, [60.0, 60.0, 60.0], [(np.inf, -np.inf), (np.inf, -10.0), (np.inf, -np.inf)])
+    assert not TimeSlices.margins_hold([(first, 0, 2), (second, 2, 4)])
@@ -0,0 +1,58 @@
+from _base_strategy import BaseStrategy
+from _orders import OpenLong
+from _portfolio import Portfolio
+from _utils import get_config, run_portfolio
+from conftest import START, QUAD
+
+PAIRS = ['BTCUSDT', 'ETHUSDT']
+
+
+class Recorder(BaseStrategy):
+    """Portfolio strategy keeping its snapshots, on the first one it puts share of the balance in every pair."""
+    portfolio = True
+
+    def __init__(self, share=0.0):
+        super().__init__()
+        self.share = share
+        self.snapshots = []
+
+    def on_receive(self, data):
+        self.snapshots.append(data)
+        if len(self.snapshots) > 1 or not self.share:
+            return
+        orders = [dict(OpenLong(order_id, data['time'], bar['price'], self.share * get_config()['balance'] / bar['price']).to_dict(), pair=pair)
+                  for order_id, (pair, bar) in enumerate(data['data'].items(), 1)]
+        self.send({'message': 'ORDERLIST', 'data': orders})
+
+
+def portfolio_quad():
+    interval, start, end, _ = QUAD
+    return interval, start, end, PAIRS
+
+
+def test_bars_of_all_pairs_arrive_in_time_order(market):
+    # The second pair starts later and trades on the half minute
+    market(PAIRS[0], bars=100)
+    market(PAIRS[1], bars=50, seed=1, start=START + 30 * 60 + 30)
+    interval, start, end, pairs = portfolio_quad()
+    strategy = Recorder()
+    Portfolio(interval=interval, start_date=start, final_date=end, pairs=pairs).run(strategy)
+    snapshots = strategy.snapshots
+    times = [int(snapshot['time']) for snapshot in snapshots]
+    assert times == sorted(set(times))
+    bars = [(pair, bar['time']) for snapshot in snapshots for pair, bar in snapshot['data'].items()]
+    assert all(bar['time'] == snapshot['time'] for snapshot in snapshots for bar in snapshot['data'].values())
+    assert sorted(bars) == sorted([(PAIRS[0], str(START + 60 * i)) for i in range(100)] +
+                                  [(PAIRS[1], str(START + 30 * 60 + 30 + 60 * i)) for i in range(50)])
+
+
+def test_fills_of_all_pairs_are_charged_to_one_balance(market):
+    for seed, pair in enumerate(PAIRS):
+        market(pair, bars=100, seed=seed)
+    order_books = run_portfolio(Recorder, portfolio_quad(), {'share': 0.6})
+    first, second = (order_books[pair] for pair in PAIRS)
+    assert first.wallet is second.wallet
+    # Either order fits the balance alone, the second no longer fits after the first
+    assert len(first.order_history) == 2 and 1 not in first.margin_failed_orders
+    assert len(second.order_history) == 0 and 2 in second.margin_failed_orders
+    assert first.wallet.balance == first.wallet.initial_balance + first.balance_change + second.balance_change
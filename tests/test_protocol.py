@@ -0,0 +1,52 @@
+from _protocol import HEADER, Encoder, Decoder
+
+
+def decode_frames(decoder, data):
+    messages = []
+    while data:
+        (length,) = HEADER.unpack_from(data)
+        message = decoder.decode(data[HEADER.size:HEADER.size + length])
+        if message is not None:
+            messages.append(message)
+        data = data[HEADER.size + length:]
+    return messages
+
+
+def test_price_columns_keep_their_type():
+    encoder, decoder = Encoder(), Decoder()
+    bars = [{'price': 100.5, 'tick': tick, 'time': str(60 * tick), 'message': 'PRICE', 'size': 2,
+             'data': {'close': 100.5, 'trades': 42 + tick, 'closed': tick == 1}}
+            for tick in range(2)]
+    price = dict(bars[0], open_orders=0)
+    batch = {'message': 'PRICEBATCH', 'seq': 0, 'data': bars}
+    data = encoder.encode(price) + encoder.encode(batch)
+    # The batch reuses the schema of the PRICE
+    assert data.count(b'trades') == 1
+    decoded_price, decoded_batch = decode_frames(decoder, data)
+    assert decoded_price == price
+    assert decoded_batch == batch
+    assert [type(value) for value in decoded_batch['data'][1]['data'].values()] == [float, int, bool]
+
+
+def price(tick, data):
+    return {'price': 1.0, 'tick': tick, 'time': str(60 * tick), 'message': 'PRICE', 'size': 4,
+            'data': data, 'open_orders': 0}
+
+
+def test_schema_of_a_bar_sent_as_json_is_sent_again():
+    encoder, decoder = Encoder(), Decoder()
+    messages = [price(0, {'close': 1.0, 'vol': None}), price(1, {'close': 1.0, 'vol': 2.0})]
+    data = b''.join(encoder.encode(message) for message in messages)
+    assert decode_frames(decoder, data) == messages
+
+
+def test_schema_of_a_batch_sent_as_json_is_sent_again():
+    encoder, decoder = Encoder(), Decoder()
+    bars = [price(tick, {'close': 1.0, 'vol': vol}) for tick, vol in enumerate([2.0, 3])]
+    for bar in bars:
+        del bar['open_orders']
+    messages = [{'message': 'PRICEBATCH', 'seq': 0, 'data': bars},
+                {'message': 'PRICEBATCH', 'seq': 2, 'data': bars[:1]},
+                price(3, {'close': 1.0, 'vol': 4.0})]
+    data = b''.join(encoder.encode(message) for message in messages)
+    assert decode_frames(decoder, data) == messages
@@ -0,0 +1,15 @@
+from _session import StrategySession
+from conftest import QUAD, Crossing, backtester, outcome
+
+
+def test_configured_and_reset_runs_match_fresh_runs(market):
+    market()
+    session = StrategySession(Crossing)
+    try:
+        # CONFIGURE, RESET with the same parameters, CONFIGURE with new ones
+        runs = [(kwargs, outcome(session.run(QUAD, kwargs))) for kwargs in ({'SL': 0.3}, {'SL': 0.3}, {'SL': 0.5, 'TP': 1.0})]
+    finally:
+        session.close()
+    for kwargs, run in runs:
+        assert run == outcome(backtester().run(Crossing(**kwargs)))
+    assert runs[0][1] != runs[2][1]
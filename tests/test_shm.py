@@ -0,0 +1,42 @@
+import multiprocessing
+import os
+
+import pytest
+
+from _shm import ShmChannel, WRITES, READS
+
+
+def exit_at_once():
+    os._exit(3)
+
+
+def pending(ring, kind):
+    """Permits released for the writes or reads of a ring and not taken yet."""
+    return ring.signals[kind].get_value() - (ring.counters[kind] - ring.taken[kind])
+
+
+def test_permits_are_taken_one_per_write_and_read():
+    channel = ShmChannel(capacity=64)
+    server, client = channel.server_end(), channel.client_end()
+    for _ in range(5):
+        server.sendall(b'ab')
+    assert client.recv(4) == b'abab'
+    assert client.recv(64) == b'ababab'
+    for _ in range(40):
+        # The messages wrap around the end of the ring
+        client.sendall(b'0123456789')
+        assert server.recv(64) == b'0123456789'
+    for ring, kind in ((client.rx, WRITES), (server.tx, READS), (server.rx, WRITES), (client.tx, READS)):
+        assert pending(ring, kind) == 0
+    channel.close()
+
+
+def test_read_fails_once_the_peer_exited():
+    channel = ShmChannel(capacity=64)
+    process = multiprocessing.get_context('fork').Process(target=exit_at_once)
+    process.start()
+    server = channel.server_end(process)
+    with pytest.raises(ConnectionResetError):
+        server.recv(64)
+    process.join()
+    channel.close()
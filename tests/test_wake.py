@@ -0,0 +1,52 @@
+import pandas as pd
+import pytest
+
+from _backtester import Backtester
+from _base_socket import epoch_seconds
+from _base_strategy import BaseStrategy
+from _feed import Feed
+
+# 2023-01-01 00:00 UTC
+START = 1672531200
+
+
+class Recorder:
+    def __init__(self):
+        self.messages = []
+
+    def handle_message(self, data):
+        self.messages.append(data)
+
+
+def minute_feed(bars):
+    index = pd.Index([(START + 60 * i) * 1000 for i in range(bars)], name='date')
+    return Feed(pd.DataFrame({'open': 1.0, 'high': 1.0, 'low': 1.0, 'close': 1.0}, index=index))
+
+
+def test_epoch_seconds():
+    assert epoch_seconds(START) == START
+    assert epoch_seconds(str(START)) == START
+    assert epoch_seconds('2023-01-01 00:00') == START
+    assert epoch_seconds('2023-01-01T01:00+01:00') == START
+    with pytest.raises(ValueError):
+        epoch_seconds('tomorrow')
+
+
+def test_wake_sends_epoch_seconds():
+    strategy = BaseStrategy()
+    server = Recorder()
+    strategy.attach(server)
+    strategy.wake(at='2023-01-01 00:05')
+    assert server.messages[-1]['at'] == START + 300
+    with pytest.raises(ValueError):
+        strategy.wake(at='2023-01-01 noon')
+
+
+def test_wake_tick_at_date():
+    backtester = Backtester.__new__(Backtester)
+    backtester.feed = minute_feed(10)
+    assert backtester.wake_tick({'at': epoch_seconds('2023-01-01 00:05')}, 0) == 5
+    assert backtester.wake_tick({'at': START + 150}, 0) == 3
+    # Times before the current bar wake right away, after the data at its end
+    assert backtester.wake_tick({'at': START}, 4) == 4
+    assert backtester.wake_tick({'at': START + 3600}, 0) == 10